@@ -4,7 +4,13 @@ from fastapi import APIRouter
 from loguru import logger
 
 from .crud import db
-from .tasks import wait_for_paid_invoices
+from .tasks import (
+    wait_for_netted_payouts,
+    wait_for_paid_invoices,
+    wait_for_payouts,
+    wait_for_set_lists,
+    wait_for_track_changes,
+)
 from .views import livestream_generic_router
 from .views_api import livestream_api_router
 from .views_lnurl import livestream_lnurl_router
@@ -37,6 +43,18 @@ def livestream_start():
 
     task = create_permanent_unique_task("ext_livestream", wait_for_paid_invoices)
     scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_livestream_payouts", wait_for_netted_payouts
+    )
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_livestream_set_lists", wait_for_set_lists)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_livestream_outbox", wait_for_payouts)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_livestream_track_changes", wait_for_track_changes
+    )
+    scheduled_tasks.append(task)
 
 
 __all__ = [
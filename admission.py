@@ -0,0 +1,89 @@
+from time import monotonic
+from typing import Optional
+
+from fastapi import Request
+from lnbits.settings import settings
+
+from .cache import LRUCache
+
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens and refills `rate` tokens per second.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def refill(self, now: float) -> None:
+        if now <= self.updated:
+            # a bucket created after `now` was taken is full already
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    """
+    One token bucket per key. Buckets of keys that were not seen in a while
+    are dropped by the LRU, which is the same as refilling them.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 10_000):
+        self.rate = rate
+        self.burst = burst
+        self.throttled = 0
+        self._buckets: LRUCache[str, TokenBucket] = LRUCache(maxsize=maxsize)
+
+    def bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets.set(key, bucket)
+        return bucket
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+def admit(*limits: tuple[RateLimiter, str]) -> Optional[float]:
+    """
+    Takes a token from the bucket of every (limiter, key) pair, or from none
+    of them. Returns None when admitted, otherwise the seconds until the
+    first empty bucket, in the order of `limits`, has a token again.
+    """
+    now = monotonic()
+    buckets = []
+    for limiter, key in limits:
+        bucket = limiter.bucket(key)
+        bucket.refill(now)
+        if bucket.tokens < 1:
+            limiter.throttled += 1
+            return (1 - bucket.tokens) / bucket.rate
+        buckets.append(bucket)
+    for bucket in buckets:
+        bucket.tokens -= 1
+    return None
+
+
+def client_address(request: Request) -> str:
+    """
+    The address of the client behind the reverse proxies lnbits trusts, the
+    same way uvicorn reads X-Forwarded-For for lnbits. Reading it again after
+    uvicorn did gives the same address.
+    """
+    host = request.client.host if request.client else ""
+    trusted = {item.strip() for item in settings.forwarded_allow_ips.split(",")}
+    forwarded = request.headers.get("x-forwarded-for")
+    if not forwarded or ("*" not in trusted and host not in trusted):
+        return host
+    hosts = [item.strip() for item in forwarded.split(",")]
+    if "*" in trusted:
+        return hosts[0]
+    # the last address that wasn't added by a trusted proxy
+    return next((item for item in reversed(hosts) if item not in trusted), host)
@@ -0,0 +1,115 @@
+from asyncio import Future
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from time import monotonic
+from typing import TYPE_CHECKING, Generic, Optional, TypeVar
+
+from lnurl import Lnurl
+
+if TYPE_CHECKING:
+    from .models import TrackContext
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Small in-process LRU cache with an optional time-to-live per entry.
+
+    `epoch` is bumped on every invalidation. Callers that load a value from the
+    database pass the epoch they read before loading to `set()`, so a value
+    computed from data that was invalidated in the meantime is never stored.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.epoch = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if self.ttl is not None and expires_at < monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, epoch: Optional[int] = None) -> None:
+        if epoch is not None and epoch != self.epoch:
+            # invalidated while the value was being computed
+            return
+        expires_at = monotonic() + self.ttl if self.ttl is not None else 0.0
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: K) -> None:
+        self.epoch += 1
+        self._data.pop(key, None)
+
+    def evict(self, predicate: Callable[[K], bool]) -> None:
+        self.epoch += 1
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self) -> None:
+        self.epoch += 1
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+# LNURL-pay responses for the livestream QR, encoded as JSON, and the revision
+# of the livestream they were rendered at, keyed by (ls_id, base_url)
+pay_response_cache: LRUCache[tuple[str, str], tuple[int, str]] = LRUCache(
+    maxsize=1024, ttl=300
+)
+
+# tracks with their producer and livestream, served while the revision of the
+# livestream is unchanged, see crud.get_fresh_track_context
+track_contexts: "LRUCache[str, TrackContext]" = LRUCache(maxsize=4096)
+
+# bech32 encoded LNURLs, keyed by the URL they encode, which holds the id and host
+lnurl_cache: LRUCache[str, Lnurl] = LRUCache(maxsize=4096)
+
+# rendered QR images and their ETag, keyed by (id, base_url, format, scale)
+qr_cache: LRUCache[tuple[str, str, str, int], tuple[str, bytes]] = LRUCache(
+    maxsize=1024
+)
+
+# invoice responses of the LNURL callback, keyed by (client, track, amount,
+# comment, nonce), so retries within the TTL get the invoice that was already
+# issued. Short, a retry comes within seconds.
+invoice_requests: LRUCache[tuple[str, str, int, str, str], Future] = LRUCache(
+    maxsize=4096, ttl=10
+)
+
+# livestream ids keyed by wallet, see crud.resolve_livestream_id
+livestream_ids: LRUCache[str, str] = LRUCache(maxsize=8192)
+
+# (wallet, payment hash) of tips that were confirmed as settled by the download
+# redirect, a hash only unlocks the tracks of the wallet it was paid to
+confirmed_payments: LRUCache[tuple[str, str], bool] = LRUCache(maxsize=8192)
+
+
+def invalidate_livestream(ls_id: str) -> None:
+    """
+    Drops what this process cached about a livestream. Other processes notice
+    the change through the livestream's revision in the database.
+    """
+    pay_response_cache.evict(lambda key: key[0] == ls_id)
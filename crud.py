@@ -1,14 +1,52 @@
-from typing import Optional
+import asyncio
+import re
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from typing import Literal, Optional, Union
+from uuid import uuid4
+from weakref import WeakValueDictionary
 
-from lnbits.core.crud import create_account, create_wallet
-from lnbits.db import Database
+from lnbits.core.crud import create_account, create_wallet, delete_wallet, get_wallets
+from lnbits.core.models import Account
+from lnbits.db import (
+    SQLITE,
+    Connection,
+    Database,
+    TModel,
+    insert_query,
+    model_to_dict,
+    update_query,
+)
 from lnbits.helpers import urlsafe_short_hash
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 
-from .models import CreateTrack, Livestream, Producer, Track
+from .cache import invalidate_livestream, livestream_ids, qr_cache, track_contexts
+from .events import event_hub
+from .metrics import metrics
+from .models import (
+    CreateTrack,
+    LedgerEntry,
+    Livestream,
+    LivestreamTipStats,
+    NowPlaying,
+    Payout,
+    PendingPayout,
+    Producer,
+    SetListEntry,
+    Tip,
+    TipReportRow,
+    TipStats,
+    Track,
+    TrackContext,
+    UpdateSettlement,
+)
 
 db = Database("ext_livestream")
 
 
+@metrics.timed
 async def create_livestream(wallet_id: str) -> Livestream:
     livestream = Livestream(
         id=urlsafe_short_hash(),
@@ -18,6 +56,7 @@ async def create_livestream(wallet_id: str) -> Livestream:
     return livestream
 
 
+@metrics.timed
 async def get_livestream(ls_id: str) -> Optional[Livestream]:
     return await db.fetchone(
         "SELECT * FROM livestream.livestreams WHERE id = :id",
@@ -26,6 +65,7 @@ async def get_livestream(ls_id: str) -> Optional[Livestream]:
     )
 
 
+@metrics.timed
 async def get_livestream_by_track(track_id: str) -> Optional[Livestream]:
     return await db.fetchone(
         """
@@ -38,56 +78,250 @@ async def get_livestream_by_track(track_id: str) -> Optional[Livestream]:
     )
 
 
-async def get_or_create_livestream_by_wallet(wallet: str) -> Livestream:
-    livestream = await db.fetchone(
-        "SELECT * FROM livestream.livestreams WHERE wallet = :wallet",
+@metrics.timed
+async def get_livestream_id_by_wallet(wallet: str) -> Optional[str]:
+    row: Optional[Mapping] = await db.fetchone(
+        "SELECT id FROM livestream.livestreams WHERE wallet = :wallet",
         {"wallet": wallet},
-        Livestream,
     )
-    if livestream:
-        return livestream
+    return row["id"] if row else None
+
+
+async def resolve_livestream_id(wallet: str) -> str:
+    """
+    Id of the wallet's livestream, created on its first use. The pairing never
+    changes, so it is cached. Concurrent first requests of a wallet race on
+    the unique index of livestreams.wallet and all get the livestream that won.
+    """
+    ls_id = livestream_ids.get(wallet)
+    if ls_id:
+        return ls_id
+    ls_id = await get_livestream_id_by_wallet(wallet)
+    if not ls_id:
+        await db.execute(
+            """
+            INSERT INTO livestream.livestreams (id, wallet) VALUES (:id, :wallet)
+            ON CONFLICT (wallet) DO NOTHING
+            """,
+            {"id": urlsafe_short_hash(), "wallet": wallet},
+        )
+        ls_id = await get_livestream_id_by_wallet(wallet)
+        assert ls_id, "livestream was not created"
+    livestream_ids.set(wallet, ls_id)
+    return ls_id
+
+
+@metrics.timed
+async def get_or_create_livestream_by_wallet(wallet: str) -> Livestream:
+    livestream = await get_livestream(await resolve_livestream_id(wallet))
+    assert livestream, "livestream of the wallet was deleted"
+    return livestream
+
+
+@metrics.timed
+async def get_livestream_revision(ls_id: str) -> Optional[int]:
+    """
+    The coherence check of the caches: one primary key read of an integer.
+    """
+    row: Optional[Mapping] = await db.fetchone(
+        "SELECT revision FROM livestream.livestreams WHERE id = :id", {"id": ls_id}
+    )
+    return row["revision"] if row else None
+
+
+_BUMP_REVISION = (
+    "UPDATE livestream.livestreams SET revision = revision + 1 WHERE id = :id"
+)
 
-    # create on the fly
-    ls = await create_livestream(wallet)
-    return ls
 
+async def _bump_revision(ls_id: str) -> None:
+    await db.execute(_BUMP_REVISION, {"id": ls_id})
+    invalidate_livestream(ls_id)
 
+
+@metrics.timed
 async def update_current_track(ls_id: str, track_id: Optional[str]):
     await db.execute(
-        "UPDATE livestream.livestreams SET current_track = :track_id WHERE id = :id",
+        """
+        UPDATE livestream.livestreams
+        SET current_track = :track_id, revision = revision + 1
+        WHERE id = :id
+        """,
         {"track_id": track_id, "id": ls_id},
     )
+    invalidate_livestream(ls_id)
+    if event_hub.subscribers.get(ls_id):
+        ctx = await get_track_context(track_id) if track_id else None
+        event_hub.publish_track(ls_id, track_id, NowPlaying.from_context(ctx).dict())
+
+
+@metrics.timed
+async def get_current_tracks(ls_ids: list[str]) -> dict[str, Optional[str]]:
+    if not ls_ids:
+        return {}
+    params = {f"id{n}": ls_id for n, ls_id in enumerate(ls_ids)}
+    placeholders = ", ".join(f":{key}" for key in params)
+    rows: list[dict] = await db.fetchall(
+        f"""
+        SELECT id, current_track FROM livestream.livestreams
+        WHERE id IN ({placeholders})
+        """,
+        params,
+    )
+    return {row["id"]: row["current_track"] for row in rows}
 
 
+@metrics.timed
 async def update_livestream_fee(ls_id: str, fee_pct: int):
     await db.execute(
-        "UPDATE livestream.livestreams SET fee_pct = :fee_pct WHERE id = :id",
+        """
+        UPDATE livestream.livestreams
+        SET fee_pct = :fee_pct, revision = revision + 1
+        WHERE id = :id
+        """,
         {"fee_pct": fee_pct, "id": ls_id},
     )
+    invalidate_livestream(ls_id)
 
 
-async def create_track(
-    livestream: str,
-    producer: str,
-    data: CreateTrack,
-) -> Track:
+@metrics.timed
+async def update_livestream_settlement(ls_id: str, data: UpdateSettlement):
+    await db.execute(
+        """
+        UPDATE livestream.livestreams
+        SET settlement = :settlement, payout_interval = :payout_interval,
+            payout_threshold_msat = :payout_threshold_msat,
+            revision = revision + 1
+        WHERE id = :id
+        """,
+        {**data.dict(), "id": ls_id},
+    )
+    invalidate_livestream(ls_id)
+
+
+def _new_track(livestream: str, producer: Producer, data: CreateTrack) -> Track:
     track = Track(
         id=urlsafe_short_hash(),
         livestream=livestream,
-        producer=producer,
+        producer=producer.id,
         name=data.name,
         download_url=data.download_url,
-        price_msat=data.price_msat,
+        price_msat=data.price_msat or 0,
     )
-    await db.insert("livestream.tracks", track)
+    track.set_metadata(producer)
     return track
 
 
-async def update_track(track: Track) -> Track:
-    await db.update("livestream.tracks", track)
+async def _execute_in(
+    conn: Connection, query: str, values: Union[dict, list[dict]]
+) -> None:
+    """
+    Runs a statement, or a batch of it, in the open transaction of `conn`.
+    """
+    params = (
+        [conn.rewrite_values(value) for value in values]
+        if isinstance(values, list)
+        else conn.rewrite_values(values)
+    )
+    await conn.conn.execute(text(conn.rewrite_query(query)), params)
+
+
+async def _index_tracks(
+    conn: Connection, tracks: list[tuple[Track, Optional[Producer]]]
+) -> None:
+    """
+    Writes the search index entries of the tracks, replacing existing ones.
+    """
+    rows = [
+        {
+            "track": track.id,
+            "livestream": track.livestream,
+            "name": track.name,
+            "producer": producer.name if producer else "",
+        }
+        for track, producer in tracks
+    ]
+    if conn.type == SQLITE:
+        await _execute_in(
+            conn, "DELETE FROM livestream.tracks_fts WHERE track = :track", rows
+        )
+        await _execute_in(
+            conn,
+            """
+            INSERT INTO livestream.tracks_fts (track, livestream, name, producer)
+            VALUES (:track, :livestream, :name, :producer)
+            """,
+            rows,
+        )
+    else:
+        await _execute_in(
+            conn,
+            """
+            INSERT INTO livestream.track_search (track, livestream, document)
+            VALUES (
+                :track, :livestream,
+                setweight(to_tsvector('simple', :name), 'A')
+                    || setweight(to_tsvector('simple', :producer), 'B')
+            )
+            ON CONFLICT (track) DO UPDATE SET document = excluded.document
+            """,
+            rows,
+        )
+
+
+@metrics.timed
+async def create_track(
+    livestream: str,
+    producer: Producer,
+    data: CreateTrack,
+) -> Track:
+    created = await create_tracks(livestream, [(producer, data)])
+    return created[0]
+
+
+@metrics.timed
+async def create_tracks(
+    livestream: str, tracks: list[tuple[Producer, CreateTrack]]
+) -> list[Track]:
+    """
+    Inserts (producer, track) pairs and their search index entries with
+    batched statements and a single commit.
+    """
+    created = [_new_track(livestream, producer, data) for producer, data in tracks]
+    if not created:
+        return created
+    async with db.connect() as conn:
+        await _execute_in(
+            conn,
+            insert_query("livestream.tracks", created[0]),
+            [model_to_dict(track) for track in created],
+        )
+        await _index_tracks(
+            conn, [(track, producer) for track, (producer, _) in zip(created, tracks)]
+        )
+        await _execute_in(conn, _BUMP_REVISION, {"id": livestream})
+        await conn.conn.commit()
+    invalidate_livestream(livestream)
+    return created
+
+
+@metrics.timed
+async def update_track(track: Track, producer: Optional[Producer]) -> Track:
+    track.set_metadata(producer)
+    async with db.connect() as conn:
+        await _execute_in(
+            conn,
+            update_query("livestream.tracks", track),
+            model_to_dict(track),
+        )
+        await _index_tracks(conn, [(track, producer)])
+        await _execute_in(conn, _BUMP_REVISION, {"id": track.livestream})
+        await conn.conn.commit()
+    invalidate_livestream(track.livestream)
     return track
 
 
+@metrics.timed
 async def get_track(track_id: str) -> Optional[Track]:
     return await db.fetchone(
         "SELECT * FROM livestream.tracks WHERE id = :id",
@@ -96,6 +330,7 @@ async def get_track(track_id: str) -> Optional[Track]:
     )
 
 
+@metrics.timed
 async def get_tracks(livestream: str) -> list[Track]:
     return await db.fetchall(
         "SELECT * FROM livestream.tracks WHERE livestream = :livestream",
@@ -104,15 +339,135 @@ async def get_tracks(livestream: str) -> list[Track]:
     )
 
 
-async def delete_track_from_livestream(livestream: str, track_id: str):
-    await db.execute(
+def _aliased_columns(alias: str, model: type[BaseModel]) -> str:
+    return ", ".join(f'{alias}."{name}" AS {alias}_{name}' for name in model.__fields__)
+
+
+def _unalias_row(row: Mapping, alias: str, model: type[TModel]) -> TModel:
+    return model.parse_obj({name: row[f"{alias}_{name}"] for name in model.__fields__})
+
+
+@metrics.timed
+async def get_track_context(track_id: str) -> Optional[TrackContext]:
+    row: Optional[Mapping] = await db.fetchone(
+        f"""
+        SELECT {_aliased_columns("t", Track)},
+            {_aliased_columns("p", Producer)},
+            {_aliased_columns("l", Livestream)}
+        FROM livestream.tracks AS t
+        JOIN livestream.livestreams AS l ON l.id = t.livestream
+        LEFT JOIN livestream.producers AS p ON p.id = t.producer
+        WHERE t.id = :id
+        """,
+        {"id": track_id},
+    )
+    if not row:
+        return None
+    return TrackContext(
+        track=_unalias_row(row, "t", Track),
+        producer=_unalias_row(row, "p", Producer) if row["p_id"] else None,
+        livestream=_unalias_row(row, "l", Livestream),
+    )
+
+
+@metrics.timed
+async def get_fresh_track_context(track_id: str) -> Optional[TrackContext]:
+    """
+    get_track_context served from this process's cache as long as the
+    livestream's revision in the database is unchanged, so a change made by
+    another worker is seen on the next request.
+    """
+    cached = track_contexts.get(track_id)
+    if cached:
+        revision = await get_livestream_revision(cached.livestream.id)
+        if revision == cached.livestream.revision:
+            return cached
+    ctx = await get_track_context(track_id)
+    if ctx:
+        track_contexts.set(track_id, ctx)
+    return ctx
+
+
+@metrics.timed
+async def search_tracks(
+    livestream: str, query: str, limit: int = 50, offset: int = 0
+) -> list[Track]:
+    """
+    Tracks whose name or producer name has words starting with every word of
+    `query`, case-insensitive, best matches first. Names weigh more than
+    producers.
+    """
+    terms = re.findall(r"[^\W_]+", query.lower())
+    if not terms:
+        return []
+    values = {"livestream": livestream, "limit": limit, "offset": offset}
+    if db.type == SQLITE:
+        values["match"] = " ".join(f'"{term}"*' for term in terms)
+        sql = """
+            SELECT t.* FROM livestream.tracks_fts
+            JOIN livestream.tracks AS t ON t.id = tracks_fts.track
+            WHERE tracks_fts MATCH :match AND tracks_fts.livestream = :livestream
+            ORDER BY bm25(tracks_fts, 0, 0, 2, 1), t.id
+            LIMIT :limit OFFSET :offset
         """
-        DELETE FROM livestream.tracks WHERE livestream = :livestream AND id = :id
+    else:
+        values["match"] = " & ".join(f"{term}:*" for term in terms)
+        sql = """
+            SELECT t.* FROM livestream.track_search AS s
+            JOIN livestream.tracks AS t ON t.id = s.track
+            WHERE s.livestream = :livestream
+                AND s.document @@ to_tsquery('simple', :match)
+            ORDER BY ts_rank(s.document, to_tsquery('simple', :match)) DESC, t.id
+            LIMIT :limit OFFSET :offset
+        """
+    return await db.fetchall(sql, values, Track)
+
+
+@metrics.timed
+async def get_tracks_page(
+    livestream: str, after: Optional[str] = None, limit: int = 100
+) -> list[Track]:
+    return await db.fetchall(
+        """
+        SELECT * FROM livestream.tracks
+        WHERE livestream = :livestream AND id > :after
+        ORDER BY id LIMIT :limit
         """,
-        {"livestream": livestream, "id": track_id},
+        {"livestream": livestream, "after": after or "", "limit": limit},
+        Track,
     )
 
 
+@metrics.timed
+async def delete_track_from_livestream(livestream: str, track_id: str) -> bool:
+    values = {"livestream": livestream, "id": track_id}
+    search_table = "tracks_fts" if db.type == SQLITE else "track_search"
+    async with db.connect() as conn:
+        result = await conn.conn.execute(
+            text(
+                conn.rewrite_query(
+                    """
+                    DELETE FROM livestream.tracks
+                    WHERE livestream = :livestream AND id = :id
+                    """
+                )
+            ),
+            values,
+        )
+        if result.rowcount:
+            await _execute_in(
+                conn,
+                f"DELETE FROM livestream.{search_table} WHERE track = :id",
+                values,
+            )
+            await _execute_in(conn, _BUMP_REVISION, {"id": livestream})
+        await conn.conn.commit()
+    invalidate_livestream(livestream)
+    qr_cache.evict(lambda key: key[0] == track_id)
+    return bool(result.rowcount)
+
+
+@metrics.timed
 async def create_producer(livestream_id: str, name: str) -> Producer:
     name = name.strip()
     producer = await db.fetchone(
@@ -126,20 +481,85 @@ async def create_producer(livestream_id: str, name: str) -> Producer:
     if producer:
         return producer
 
-    user = await create_account()
-    wallet = await create_wallet(user_id=user.id, wallet_name="livestream: " + name)
-
-    producer = Producer(
-        id=urlsafe_short_hash(),
-        livestream=livestream_id,
-        user=user.id,
-        wallet=wallet.id,
-        name=name,
-    )
+    producer = Producer(id=urlsafe_short_hash(), livestream=livestream_id, name=name)
     await db.insert("livestream.producers", producer)
+    await _bump_revision(livestream_id)
     return producer
 
 
+# held while a producer's wallet is created, see provision_producer_wallet
+_provision_locks: WeakValueDictionary[str, asyncio.Lock] = WeakValueDictionary()
+
+
+@metrics.timed
+async def provision_producer_wallet(producer: Producer) -> Producer:
+    """
+    Returns the producer with an account and wallet, creating them on the
+    first call. Safe to call concurrently: in-process callers wait on a
+    per-producer lock and the conditional update makes sure that only one
+    wallet is ever stored, even across processes. The account id is random
+    and stored on the producer before the account is created, so processes
+    that race share it and the losing wallet is deleted from it, and a
+    wallet left by an attempt that died before storing it is reused.
+    """
+    if producer.wallet:
+        return producer
+
+    lock = _provision_locks.get(producer.id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _provision_locks[producer.id] = lock
+
+    async with lock:
+        current = await get_producer(producer.id)
+        assert current, f"producer {producer.id} was deleted"
+        if current.wallet:
+            return current
+
+        if not current.user:
+            # the account id is the owner's login, it must not be guessable
+            await db.execute(
+                """
+                UPDATE livestream.producers SET "user" = :user
+                WHERE id = :id AND "user" IS NULL
+                """,
+                {"id": current.id, "user": uuid4().hex},
+            )
+            current = await get_producer(current.id)
+            assert current and current.user
+        user_id = current.user
+        now = datetime.now(timezone.utc)
+        try:
+            await create_account(Account(id=user_id, created_at=now, updated_at=now))
+        except IntegrityError:
+            # created by another process, or by an earlier attempt
+            pass
+        wallets = await get_wallets(user_id, deleted=False)
+        wallet = wallets[0] if wallets else None
+        if not wallet:
+            wallet = await create_wallet(
+                user_id=user_id, wallet_name="livestream: " + current.name
+            )
+        result = await db.execute(
+            """
+            UPDATE livestream.producers SET "user" = :user, wallet = :wallet
+            WHERE id = :id AND wallet IS NULL
+            """,
+            {"id": current.id, "user": user_id, "wallet": wallet.id},
+        )
+        if result.rowcount != 1:
+            provisioned = await get_producer(current.id)
+            assert provisioned
+            if provisioned.wallet != wallet.id:
+                # another process stored its wallet first, drop this one
+                await delete_wallet(user_id=user_id, wallet_id=wallet.id)
+            return provisioned
+
+    await _bump_revision(current.livestream)
+    return current.copy(update={"user": user_id, "wallet": wallet.id})
+
+
+@metrics.timed
 async def get_producer(producer_id: str) -> Optional[Producer]:
     return await db.fetchone(
         "SELECT * FROM livestream.producers WHERE id = :id",
@@ -148,9 +568,565 @@ async def get_producer(producer_id: str) -> Optional[Producer]:
     )
 
 
+@metrics.timed
 async def get_producers(livestream: str) -> list[Producer]:
     return await db.fetchall(
         "SELECT * FROM livestream.producers WHERE livestream = :livestream",
         {"livestream": livestream},
         Producer,
     )
+
+
+@metrics.timed
+async def get_ledger_entries(
+    livestream: str,
+    producer: Optional[str] = None,
+    limit: int = 100,
+    offset: int = 0,
+) -> list[LedgerEntry]:
+    where = "AND producer = :producer" if producer else ""
+    return await db.fetchall(
+        f"""
+        SELECT * FROM livestream.ledger
+        WHERE livestream = :livestream {where}
+        ORDER BY created_at DESC, id
+        LIMIT :limit OFFSET :offset
+        """,
+        {
+            "livestream": livestream,
+            "producer": producer,
+            "limit": limit,
+            "offset": offset,
+        },
+        LedgerEntry,
+    )
+
+
+@metrics.timed
+async def get_pending_payouts() -> list[PendingPayout]:
+    return await db.fetchall(
+        """
+        SELECT e.livestream, e.producer,
+            SUM(e.amount_msat) AS amount_msat, MIN(e.created_at) AS oldest,
+            l.wallet AS livestream_wallet, p.wallet AS producer_wallet,
+            l.payout_interval, l.payout_threshold_msat
+        FROM livestream.ledger AS e
+        JOIN livestream.livestreams AS l ON l.id = e.livestream
+        JOIN livestream.producers AS p ON p.id = e.producer
+        WHERE e.payout IS NULL
+        GROUP BY e.livestream, e.producer, l.wallet, p.wallet,
+            l.payout_interval, l.payout_threshold_msat
+        """,
+        model=PendingPayout,
+    )
+
+
+@metrics.timed
+async def create_netted_payout(pending: PendingPayout) -> Optional[Payout]:
+    """
+    Claims every unsettled ledger entry of the producer for a new payout in
+    the outbox, in one transaction, so the claimed entries are paid by the
+    outbox's retries even if the process dies before paying them. Payouts
+    are whole sats: the msat remainder is carried to the next payout by a
+    pair of entries. Returns None, claiming nothing, below one sat.
+    """
+    payout_id = urlsafe_short_hash()
+    values = {
+        "livestream": pending.livestream,
+        "producer": pending.producer,
+        "payout": payout_id,
+    }
+    async with db.connect() as conn:
+        await _execute_in(
+            conn,
+            """
+            UPDATE livestream.ledger SET payout = :payout
+            WHERE livestream = :livestream AND producer = :producer
+                AND payout IS NULL
+            """,
+            values,
+        )
+        result = await conn.conn.execute(
+            text(
+                conn.rewrite_query(
+                    """
+                    SELECT COALESCE(SUM(amount_msat), 0) AS amount_msat
+                    FROM livestream.ledger WHERE payout = :payout
+                    """
+                )
+            ),
+            values,
+        )
+        claimed = int(result.mappings().one()["amount_msat"])
+        if claimed < 1000:
+            await conn.conn.rollback()
+            return None
+
+        remainder = claimed % 1000
+        payout = Payout(
+            id=payout_id,
+            livestream=pending.livestream,
+            producer=pending.producer,
+            track="",
+            wallet=pending.livestream_wallet,
+            amount_msat=claimed - remainder,
+            received_msat=claimed - remainder,
+            memo="Netted livestream revenue.",
+        )
+        if remainder:
+            carried = [
+                LedgerEntry(
+                    id=urlsafe_short_hash(),
+                    livestream=pending.livestream,
+                    producer=pending.producer,
+                    track="",
+                    amount_msat=amount,
+                    comment=comment,
+                    payout=payout_id if amount < 0 else None,
+                )
+                for amount, comment in (
+                    (-remainder, "Carried to the next payout."),
+                    (remainder, f"Carried from payout {payout_id}."),
+                )
+            ]
+            await _execute_in(
+                conn,
+                insert_query("livestream.ledger", carried[0]),
+                [model_to_dict(entry) for entry in carried],
+            )
+        await _execute_in(
+            conn, insert_query("livestream.payouts", payout), model_to_dict(payout)
+        )
+        await conn.conn.commit()
+    return payout
+
+
+@metrics.timed
+async def release_orphaned_ledger_entries() -> int:
+    """
+    Releases ledger entries claimed by a payout that isn't in the outbox,
+    left behind by a crash of versions that claimed entries before queueing
+    their payout, so they are paid with the next payout.
+    """
+    result = await db.execute(
+        """
+        UPDATE livestream.ledger SET payout = NULL
+        WHERE payout IS NOT NULL
+            AND payout NOT IN (SELECT id FROM livestream.payouts)
+        """
+    )
+    return result.rowcount
+
+
+@metrics.timed
+async def get_producers_page(
+    livestream: str, after: Optional[str] = None, limit: int = 100
+) -> list[Producer]:
+    return await db.fetchall(
+        """
+        SELECT * FROM livestream.producers
+        WHERE livestream = :livestream AND id > :after
+        ORDER BY id LIMIT :limit
+        """,
+        {"livestream": livestream, "after": after or "", "limit": limit},
+        Producer,
+    )
+
+
+# width of a tip statistics bucket in seconds
+TIP_STATS_BUCKET = 3600
+
+# tables with the names of the leaderboard entries, by scope
+_tip_stats_names = {"track": "livestream.tracks", "producer": "livestream.producers"}
+
+
+@metrics.timed
+async def create_tip(tip: Tip, share: Union[LedgerEntry, Payout]) -> bool:
+    """
+    Records the tip, adds it to the counters of its livestream, track and
+    producer and queues the producer's share on the ledger or the payout
+    outbox, all in one transaction. Returns False if the tip was recorded
+    already, in which case nothing is written.
+    """
+    hour = tip.created_at - tip.created_at % TIP_STATS_BUCKET
+    counters = [
+        {
+            "livestream": tip.livestream,
+            "scope": scope,
+            "ref": ref,
+            "bucket": bucket,
+            "amount_msat": tip.amount_msat,
+            "created_at": tip.created_at,
+        }
+        for scope, ref in (
+            ("livestream", tip.livestream),
+            ("track", tip.track),
+            ("producer", tip.producer),
+        )
+        for bucket in (0, hour)
+    ]
+    insert_tip = insert_query("livestream.tips", tip) + " ON CONFLICT (id) DO NOTHING"
+    async with db.connect() as conn:
+        result = await conn.conn.execute(
+            text(conn.rewrite_query(insert_tip)),
+            conn.rewrite_values(model_to_dict(tip)),
+        )
+        if result.rowcount != 1:
+            return False
+        await conn.conn.execute(
+            text(
+                conn.rewrite_query(
+                    """
+                    INSERT INTO livestream.tip_stats
+                        (livestream, scope, ref, bucket, count, total_msat, last_tip)
+                    VALUES (:livestream, :scope, :ref, :bucket, 1, :amount_msat,
+                        :created_at)
+                    ON CONFLICT (livestream, scope, ref, bucket) DO UPDATE SET
+                        count = tip_stats.count + 1,
+                        total_msat = tip_stats.total_msat + excluded.total_msat,
+                        last_tip = CASE
+                            WHEN excluded.last_tip > tip_stats.last_tip
+                            THEN excluded.last_tip ELSE tip_stats.last_tip
+                        END
+                    """
+                )
+            ),
+            counters,
+        )
+        table = (
+            "livestream.ledger"
+            if isinstance(share, LedgerEntry)
+            else "livestream.payouts"
+        )
+        await conn.conn.execute(
+            text(conn.rewrite_query(insert_query(table, share))),
+            conn.rewrite_values(model_to_dict(share)),
+        )
+        await conn.conn.commit()
+    return True
+
+
+@metrics.timed
+async def get_leaderboard(
+    livestream: str,
+    scope: Literal["track", "producer"],
+    since: Optional[int] = None,
+    limit: int = 10,
+) -> list[TipStats]:
+    """
+    Top tracks or producers by tipped amount, for all time or since the start
+    of the hour of `since`. Reads only the counters, never the tips.
+    """
+    names = _tip_stats_names[scope]
+    if since is None:
+        query = f"""
+            SELECT s.ref AS id, n.name, s.count, s.total_msat, s.last_tip
+            FROM livestream.tip_stats s LEFT JOIN {names} n ON n.id = s.ref
+            WHERE s.livestream = :livestream AND s.scope = :scope AND s.bucket = 0
+            ORDER BY s.total_msat DESC LIMIT :limit
+            """
+    else:
+        query = f"""
+            SELECT s.ref AS id, MAX(n.name) AS name, SUM(s.count) AS count,
+                SUM(s.total_msat) AS total_msat, MAX(s.last_tip) AS last_tip
+            FROM livestream.tip_stats s LEFT JOIN {names} n ON n.id = s.ref
+            WHERE s.livestream = :livestream AND s.scope = :scope
+                AND s.bucket >= :since AND s.bucket > 0
+            GROUP BY s.ref
+            ORDER BY total_msat DESC LIMIT :limit
+            """
+    return await db.fetchall(
+        query,
+        {
+            "livestream": livestream,
+            "scope": scope,
+            "since": (since or 0) - (since or 0) % TIP_STATS_BUCKET,
+            "limit": limit,
+        },
+        TipStats,
+    )
+
+
+@metrics.timed
+async def get_tip_report_page(
+    livestream: str,
+    producer: Optional[str] = None,
+    since: int = 0,
+    until: Optional[int] = None,
+    after: Optional[tuple[int, str]] = None,
+    limit: int = 500,
+) -> list[TipReportRow]:
+    """
+    Tips oldest first, from `since` up to but excluding `until`. Pages are
+    continued after the (created_at, id) of the last tip of the previous page.
+    """
+    created_at, tip_id = after or (since, "")
+    where = "AND t.producer = :producer" if producer else ""
+    if until is not None:
+        where += " AND t.created_at < :until"
+    return await db.fetchall(
+        f"""
+        SELECT t.id, t.created_at, t.track, tr.name AS track_name, t.producer,
+            p.name AS producer_name, t.amount_msat, t.fee_msat, t.share_msat,
+            t.comment
+        FROM livestream.tips AS t
+        LEFT JOIN livestream.tracks AS tr ON tr.id = t.track
+        LEFT JOIN livestream.producers AS p ON p.id = t.producer
+        WHERE t.livestream = :livestream {where}
+            AND (t.created_at > :created_at
+                OR (t.created_at = :created_at AND t.id > :id))
+        ORDER BY t.created_at, t.id
+        LIMIT :limit
+        """,
+        {
+            "livestream": livestream,
+            "producer": producer,
+            "until": until,
+            "created_at": created_at,
+            "id": tip_id,
+            "limit": limit,
+        },
+        TipReportRow,
+    )
+
+
+@metrics.timed
+async def get_tip_stats(livestream: str, since: int, until: int) -> LivestreamTipStats:
+    """
+    All-time totals of the livestream and its hourly buckets between `since`
+    and `until`.
+    """
+    rows = await db.fetchall(
+        """
+        SELECT ref AS id, bucket, count, total_msat, last_tip
+        FROM livestream.tip_stats
+        WHERE livestream = :livestream AND scope = 'livestream' AND ref = :livestream
+            AND (bucket = 0 OR (bucket >= :since AND bucket <= :until))
+        ORDER BY bucket
+        """,
+        {
+            "livestream": livestream,
+            "since": since - since % TIP_STATS_BUCKET,
+            "until": until,
+        },
+        TipStats,
+    )
+    if rows and rows[0].bucket == 0:
+        return LivestreamTipStats(total=rows[0], hourly=rows[1:])
+    return LivestreamTipStats(total=TipStats(id=livestream), hourly=rows)
+
+
+@metrics.timed
+async def replace_set_list(livestream: str, entries: list[SetListEntry]) -> None:
+    """
+    Replaces the entries of the livestream that didn't start yet.
+    """
+    async with db.connect() as conn:
+        await _execute_in(
+            conn,
+            """
+            DELETE FROM livestream.set_list
+            WHERE livestream = :livestream AND applied_at IS NULL
+            """,
+            {"livestream": livestream},
+        )
+        if entries:
+            await _execute_in(
+                conn,
+                insert_query("livestream.set_list", entries[0]),
+                [model_to_dict(entry) for entry in entries],
+            )
+        await conn.conn.commit()
+
+
+@metrics.timed
+async def get_set_list(livestream: str) -> list[SetListEntry]:
+    return await db.fetchall(
+        """
+        SELECT * FROM livestream.set_list
+        WHERE livestream = :livestream AND applied_at IS NULL
+        ORDER BY starts_at
+        """,
+        {"livestream": livestream},
+        SetListEntry,
+    )
+
+
+@metrics.timed
+async def get_pending_set_list_entries() -> list[SetListEntry]:
+    return await db.fetchall(
+        "SELECT * FROM livestream.set_list WHERE applied_at IS NULL",
+        model=SetListEntry,
+    )
+
+
+@metrics.timed
+async def claim_set_list_entry(entry_id: str, now: int) -> bool:
+    """
+    Marks the entry as applied. Returns False if it was applied by someone
+    else or removed from the set list in the meantime.
+    """
+    result = await db.execute(
+        """
+        UPDATE livestream.set_list SET applied_at = :now
+        WHERE id = :id AND applied_at IS NULL
+        """,
+        {"id": entry_id, "now": now},
+    )
+    return result.rowcount == 1
+
+
+@metrics.timed
+async def get_payout(payout_id: str) -> Optional[Payout]:
+    return await db.fetchone(
+        "SELECT * FROM livestream.payouts WHERE id = :id", {"id": payout_id}, Payout
+    )
+
+
+@metrics.timed
+async def get_payouts(
+    livestream: str,
+    status: Optional[str] = None,
+    limit: int = 100,
+    offset: int = 0,
+) -> list[Payout]:
+    where = "AND status = :status" if status else ""
+    return await db.fetchall(
+        f"""
+        SELECT * FROM livestream.payouts WHERE livestream = :livestream {where}
+        ORDER BY created_at DESC LIMIT :limit OFFSET :offset
+        """,
+        {"livestream": livestream, "status": status, "limit": limit, "offset": offset},
+        Payout,
+    )
+
+
+@metrics.timed
+async def get_due_payouts(now: int, limit: int = 100) -> list[Payout]:
+    return await db.fetchall(
+        """
+        SELECT * FROM livestream.payouts
+        WHERE status = 'pending' AND next_attempt_at <= :now
+        ORDER BY next_attempt_at LIMIT :limit
+        """,
+        {"now": now, "limit": limit},
+        Payout,
+    )
+
+
+@metrics.timed
+async def claim_payout(payout_id: str, now: int, lease_until: int) -> bool:
+    """
+    Takes a due payout until `lease_until`, so no other worker or process pays
+    it at the same time. A worker that dies lets the lease run out and the
+    payout is retried.
+    """
+    result = await db.execute(
+        """
+        UPDATE livestream.payouts SET next_attempt_at = :lease_until
+        WHERE id = :id AND status = 'pending' AND next_attempt_at <= :now
+        """,
+        {"id": payout_id, "now": now, "lease_until": lease_until},
+    )
+    return result.rowcount == 1
+
+
+@metrics.timed
+async def set_payout_invoice(
+    payout_id: str, producer_wallet: str, invoice: str, payment_hash: str
+) -> None:
+    await db.execute(
+        """
+        UPDATE livestream.payouts
+        SET producer_wallet = :producer_wallet, invoice = :invoice,
+            payment_hash = :payment_hash
+        WHERE id = :id
+        """,
+        {
+            "id": payout_id,
+            "producer_wallet": producer_wallet,
+            "invoice": invoice,
+            "payment_hash": payment_hash,
+        },
+    )
+
+
+@metrics.timed
+async def mark_payout_paid(payout_id: str, now: int) -> None:
+    await db.execute(
+        """
+        UPDATE livestream.payouts SET status = 'paid', paid_at = :now, error = NULL
+        WHERE id = :id
+        """,
+        {"id": payout_id, "now": now},
+    )
+
+
+@metrics.timed
+async def mark_payout_failed(
+    payout_id: str, attempts: int, next_attempt_at: Optional[int], error: str
+) -> None:
+    """
+    Schedules the next attempt, or gives up if `next_attempt_at` is None.
+    """
+    await db.execute(
+        """
+        UPDATE livestream.payouts
+        SET attempts = :attempts, status = :status, error = :error,
+            next_attempt_at = COALESCE(:next_attempt_at, next_attempt_at)
+        WHERE id = :id
+        """,
+        {
+            "id": payout_id,
+            "attempts": attempts,
+            "status": "pending" if next_attempt_at else "failed",
+            "next_attempt_at": next_attempt_at,
+            "error": error,
+        },
+    )
+
+
+@metrics.timed
+async def get_recorded_tips(tip_ids: list[str]) -> set[str]:
+    if not tip_ids:
+        return set()
+    params = {f"id{n}": tip_id for n, tip_id in enumerate(tip_ids)}
+    placeholders = ", ".join(f":{key}" for key in params)
+    rows: list[dict] = await db.fetchall(
+        f"SELECT id FROM livestream.tips WHERE id IN ({placeholders})", params
+    )
+    return {row["id"] for row in rows}
+
+
+@metrics.timed
+async def get_livestreams_page(
+    after: Optional[str] = None, limit: int = 100
+) -> list[Livestream]:
+    return await db.fetchall(
+        """
+        SELECT * FROM livestream.livestreams WHERE id > :after
+        ORDER BY id LIMIT :limit
+        """,
+        {"after": after or "", "limit": limit},
+        Livestream,
+    )
+
+
+@metrics.timed
+async def get_checkpoint(checkpoint_id: str) -> Optional[int]:
+    row: Optional[Mapping] = await db.fetchone(
+        "SELECT value FROM livestream.checkpoints WHERE id = :id",
+        {"id": checkpoint_id},
+    )
+    return int(row["value"]) if row else None
+
+
+@metrics.timed
+async def set_checkpoint(checkpoint_id: str, value: int) -> None:
+    await db.execute(
+        """
+        UPDATE livestream.checkpoints SET value = :value
+        WHERE id = :id AND value < :value
+        """,
+        {"id": checkpoint_id, "value": value},
+    )
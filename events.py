@@ -0,0 +1,115 @@
+import asyncio
+import json
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from typing import Optional
+
+from loguru import logger
+
+# seconds between keep-alive comments on an idle stream
+HEARTBEAT_INTERVAL = 15
+# events buffered per subscriber before it is considered too slow and dropped
+SUBSCRIBER_QUEUE_SIZE = 64
+
+
+class LivestreamEventHub:
+    """
+    In-process fan-out of livestream events to Server-Sent Events subscribers.
+
+    Every event is serialized once and pushed to the queue of each subscriber
+    of that livestream, so the number of subscribers doesn't add any database
+    work. A subscriber whose queue is full gets disconnected instead of
+    holding back the others.
+
+    The hub only reaches the streams of its own process. Track changes made
+    in other processes are picked up by polling the database, see
+    tasks.announce_track_changes. Tips are announced by the process that
+    splits them.
+    """
+
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: defaultdict[str, set[asyncio.Queue[Optional[str]]]] = (
+            defaultdict(set)
+        )
+        self.evicted = 0
+        # the track last announced to the streams of each livestream
+        self.announced: dict[str, Optional[str]] = {}
+
+    def subscribe(self, ls_id: str) -> asyncio.Queue[Optional[str]]:
+        queue: asyncio.Queue[Optional[str]] = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers[ls_id].add(queue)
+        return queue
+
+    def unsubscribe(self, ls_id: str, queue: asyncio.Queue[Optional[str]]) -> None:
+        queues = self.subscribers.get(ls_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[ls_id]
+            self.announced.pop(ls_id, None)
+
+    def publish(self, ls_id: str, event: str, data: dict) -> None:
+        queues = self.subscribers.get(ls_id)
+        if not queues:
+            return
+        frame = format_sse(event, data)
+        for queue in list(queues):
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._evict(ls_id, queue)
+
+    def publish_track(self, ls_id: str, track_id: Optional[str], data: dict) -> None:
+        if ls_id not in self.subscribers:
+            return
+        self.announced[ls_id] = track_id
+        self.publish(ls_id, "track", data)
+
+    def _evict(self, ls_id: str, queue: asyncio.Queue[Optional[str]]) -> None:
+        logger.debug(f"livestream: dropping slow event subscriber of {ls_id}")
+        self.evicted += 1
+        self.unsubscribe(ls_id, queue)
+        while not queue.empty():
+            queue.get_nowait()
+        # tells the stream to close
+        queue.put_nowait(None)
+
+    async def stream(
+        self, ls_id: str, first: Optional[str] = None, track_id: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        Yields `first`, the announcement of `track_id`, and the events that
+        follow it.
+        """
+        queue = self.subscribe(ls_id)
+        self.announced.setdefault(ls_id, track_id)
+        try:
+            if first:
+                yield first
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            self.unsubscribe(ls_id, queue)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "livestreams": len(self.subscribers),
+            "subscribers": sum(len(queues) for queues in self.subscribers.values()),
+            "evicted": self.evicted,
+        }
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+event_hub = LivestreamEventHub()
@@ -1,4 +1,7 @@
-from lnbits.db import Connection
+from time import time
+
+from lnbits.db import SQLITE, Connection
+from sqlalchemy import text
 
 
 async def m001_initial(db: Connection):
@@ -40,3 +43,475 @@ async def m001_initial(db: Connection):
         );
         """
     )
+
+
+async def m002_settlement(db: Connection):
+    """
+    Netted settlement mode: tips accrue to a per-producer ledger and are paid
+    out in batches.
+    """
+    await db.execute(
+        """
+        ALTER TABLE livestream.livestreams
+        ADD COLUMN settlement TEXT NOT NULL DEFAULT 'instant';
+        """
+    )
+    await db.execute(
+        """
+        ALTER TABLE livestream.livestreams
+        ADD COLUMN payout_interval INTEGER NOT NULL DEFAULT 3600;
+        """
+    )
+    await db.execute(
+        f"""
+        ALTER TABLE livestream.livestreams
+        ADD COLUMN payout_threshold_msat {db.big_int} NOT NULL DEFAULT 0;
+        """
+    )
+
+    await db.execute(
+        f"""
+        CREATE TABLE livestream.ledger (
+            id TEXT PRIMARY KEY,
+            livestream TEXT NOT NULL,
+            producer TEXT NOT NULL,
+            track TEXT NOT NULL,
+            amount_msat {db.big_int} NOT NULL,
+            comment TEXT,
+            payout TEXT,
+            created_at INTEGER NOT NULL
+        );
+        """
+    )
+
+
+async def m003_indexes(db: Connection):
+    """
+    Indexes for the lookup columns, one livestream per wallet and a TEXT
+    current_track column.
+    """
+    await _merge_duplicate_livestreams(db)
+
+    if db.type == SQLITE:
+        # sqlite can't change a column type, so the table is rebuilt
+        await db.execute(
+            f"""
+            CREATE TABLE livestream.livestreams_m003 (
+                id TEXT PRIMARY KEY,
+                wallet TEXT NOT NULL,
+                fee_pct INTEGER NOT NULL DEFAULT 10,
+                current_track TEXT,
+                settlement TEXT NOT NULL DEFAULT 'instant',
+                payout_interval INTEGER NOT NULL DEFAULT 3600,
+                payout_threshold_msat {db.big_int} NOT NULL DEFAULT 0
+            );
+            """
+        )
+        await db.execute(
+            """
+            INSERT INTO livestream.livestreams_m003
+            SELECT id, wallet, fee_pct, CAST(current_track AS TEXT), settlement,
+                payout_interval, payout_threshold_msat
+            FROM livestream.livestreams;
+            """
+        )
+        await db.execute("DROP TABLE livestream.livestreams;")
+        await db.execute(
+            "ALTER TABLE livestream.livestreams_m003 RENAME TO livestreams;"
+        )
+    else:
+        await db.execute(
+            """
+            ALTER TABLE livestream.livestreams
+            ALTER COLUMN current_track TYPE TEXT USING current_track::text;
+            """
+        )
+
+    await create_index(db, "livestreams_wallet_idx", "livestreams", "wallet", True)
+    await create_index(db, "tracks_livestream_idx", "tracks", "livestream")
+    await create_index(
+        db, "producers_livestream_name_idx", "producers", "livestream, lower(name)"
+    )
+    await create_index(db, "ledger_producer_idx", "ledger", "livestream, producer")
+    await create_index(db, "ledger_payout_idx", "ledger", "payout")
+
+
+async def create_index(
+    db: Connection, name: str, table: str, columns: str, unique: bool = False
+):
+    # sqlite wants the schema on the index name, postgres on the table name
+    if db.type == SQLITE:
+        name, table = f"livestream.{name}", table
+    else:
+        name, table = name, f"livestream.{table}"
+    await db.execute(
+        f"""
+        CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS {name}
+        ON {table} ({columns});
+        """
+    )
+
+
+async def _merge_duplicate_livestreams(db: Connection):
+    """
+    Concurrent first requests could create several livestreams for one
+    wallet. Keep the one with the most tracks and move everything else to it.
+    """
+    rows: list[dict] = await db.fetchall(
+        """
+        SELECT l.id, l.wallet, COUNT(t.id) AS tracks
+        FROM livestream.livestreams AS l
+        LEFT JOIN livestream.tracks AS t ON t.livestream = l.id
+        WHERE l.wallet IN (
+            SELECT wallet FROM livestream.livestreams
+            GROUP BY wallet HAVING COUNT(*) > 1
+        )
+        GROUP BY l.id, l.wallet
+        ORDER BY l.wallet, COUNT(t.id) DESC, l.id
+        """
+    )
+    keep: dict[str, str] = {}
+    for row in rows:
+        if row["wallet"] not in keep:
+            keep[row["wallet"]] = row["id"]
+            continue
+        values = {"keep": keep[row["wallet"]], "drop": row["id"]}
+        for table in ("tracks", "producers", "ledger"):
+            await db.execute(
+                f"""
+                UPDATE livestream.{table} SET livestream = :keep
+                WHERE livestream = :drop
+                """,
+                values,
+            )
+        await db.execute("DELETE FROM livestream.livestreams WHERE id = :drop", values)
+
+
+async def m004_keyset_indexes(db: Connection):
+    """
+    (livestream, id) indexes for the keyset paginated listings. They also
+    cover the plain livestream lookups, so the m003 track index goes.
+    """
+    await create_index(db, "tracks_livestream_id_idx", "tracks", "livestream, id")
+    await create_index(db, "producers_livestream_id_idx", "producers", "livestream, id")
+    await db.execute("DROP INDEX IF EXISTS livestream.tracks_livestream_idx;")
+
+
+async def m005_lazy_producer_wallets(db: Connection):
+    """
+    Producer accounts and wallets are created on their first payout, so the
+    columns become nullable. Existing producers keep their wallets.
+    """
+    if db.type == SQLITE:
+        await db.execute(
+            """
+            CREATE TABLE livestream.producers_m005 (
+                id TEXT PRIMARY KEY,
+                livestream TEXT NOT NULL,
+                "user" TEXT,
+                wallet TEXT,
+                name TEXT NOT NULL
+            );
+            """
+        )
+        await db.execute(
+            """
+            INSERT INTO livestream.producers_m005
+            SELECT id, livestream, "user", wallet, name FROM livestream.producers;
+            """
+        )
+        await db.execute("DROP TABLE livestream.producers;")
+        await db.execute("ALTER TABLE livestream.producers_m005 RENAME TO producers;")
+        await create_index(
+            db, "producers_livestream_name_idx", "producers", "livestream, lower(name)"
+        )
+        await create_index(
+            db, "producers_livestream_id_idx", "producers", "livestream, id"
+        )
+    else:
+        await db.execute(
+            """
+            ALTER TABLE livestream.producers
+            ALTER COLUMN "user" DROP NOT NULL,
+            ALTER COLUMN wallet DROP NOT NULL;
+            """
+        )
+
+
+async def m006_tips(db: Connection):
+    """
+    Every tip, plus counters per livestream, track and producer that are
+    updated with each tip, for all time and per hour.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE livestream.tips (
+            id TEXT PRIMARY KEY,
+            livestream TEXT NOT NULL,
+            track TEXT NOT NULL,
+            producer TEXT NOT NULL,
+            amount_msat {db.big_int} NOT NULL,
+            fee_msat {db.big_int} NOT NULL,
+            share_msat {db.big_int} NOT NULL,
+            comment TEXT,
+            created_at INTEGER NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE livestream.tip_stats (
+            livestream TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            ref TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            total_msat {db.big_int} NOT NULL,
+            last_tip INTEGER NOT NULL,
+            PRIMARY KEY (livestream, scope, ref, bucket)
+        );
+        """
+    )
+    await create_index(
+        db, "tips_livestream_created_idx", "tips", "livestream, created_at"
+    )
+    await create_index(
+        db,
+        "tip_stats_leaderboard_idx",
+        "tip_stats",
+        "livestream, scope, bucket, total_msat",
+    )
+
+
+async def m007_set_lists(db: Connection):
+    """
+    Scheduled set lists: each entry makes a track current at `starts_at`.
+    """
+    await db.execute(
+        """
+        CREATE TABLE livestream.set_list (
+            id TEXT PRIMARY KEY,
+            livestream TEXT NOT NULL,
+            track TEXT NOT NULL,
+            starts_at INTEGER NOT NULL,
+            applied_at INTEGER
+        );
+        """
+    )
+    await create_index(db, "set_list_pending_idx", "set_list", "applied_at, starts_at")
+    await create_index(
+        db, "set_list_livestream_idx", "set_list", "livestream, starts_at"
+    )
+
+
+async def m008_payout_outbox(db: Connection):
+    """
+    Outbox of the producer payouts of instant splits, retried until paid, and
+    the checkpoint of the scan for tips that were paid but never split. Tips
+    received before this migration are not scanned.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE livestream.payouts (
+            id TEXT PRIMARY KEY,
+            livestream TEXT NOT NULL,
+            producer TEXT NOT NULL,
+            track TEXT NOT NULL,
+            wallet TEXT NOT NULL,
+            amount_msat {db.big_int} NOT NULL,
+            received_msat {db.big_int} NOT NULL,
+            memo TEXT NOT NULL,
+            comment TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            producer_wallet TEXT,
+            invoice TEXT,
+            payment_hash TEXT,
+            error TEXT,
+            created_at INTEGER NOT NULL,
+            paid_at INTEGER
+        );
+        """
+    )
+    await create_index(db, "payouts_pending_idx", "payouts", "status, next_attempt_at")
+    await create_index(
+        db, "payouts_livestream_idx", "payouts", "livestream, created_at"
+    )
+    await db.execute(
+        """
+        CREATE TABLE livestream.checkpoints (
+            id TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        "INSERT INTO livestream.checkpoints (id, value) VALUES (:id, :value)",
+        {"id": "tips_scan", "value": int(time())},
+    )
+
+
+async def m009_track_metadata(db: Connection):
+    """
+    LNURL-pay metadata and description hash stored on the tracks, so the LNURL
+    endpoints don't rebuild them on every request. Existing tracks are
+    backfilled in pages.
+    """
+    await db.execute("ALTER TABLE livestream.tracks ADD COLUMN metadata TEXT;")
+    await db.execute("ALTER TABLE livestream.tracks ADD COLUMN description_hash TEXT;")
+    await _backfill_track_metadata(db)
+
+
+async def _backfill_track_metadata(db: Connection):
+    from .models import Producer, Track
+
+    after = ""
+    while True:
+        rows: list[dict] = await db.fetchall(
+            """
+            SELECT t.id, t.livestream, t.producer, t.name, t.download_url,
+                t.price_msat, p.name AS producer_name
+            FROM livestream.tracks AS t
+            LEFT JOIN livestream.producers AS p ON p.id = t.producer
+            WHERE t.metadata IS NULL AND t.id > :after
+            ORDER BY t.id LIMIT 1000
+            """,
+            {"after": after},
+        )
+        if not rows:
+            break
+        values = []
+        for row in rows:
+            track = Track(**{k: v for k, v in row.items() if k != "producer_name"})
+            producer = None
+            if row["producer_name"] is not None:
+                producer = Producer(
+                    id=row["producer"],
+                    livestream=row["livestream"],
+                    name=row["producer_name"],
+                )
+            track.set_metadata(producer)
+            values.append(
+                {
+                    "id": track.id,
+                    "metadata": track.metadata,
+                    "description_hash": track.description_hash,
+                }
+            )
+        await db.conn.execute(
+            text(
+                db.rewrite_query(
+                    """
+                    UPDATE livestream.tracks
+                    SET metadata = :metadata, description_hash = :description_hash
+                    WHERE id = :id
+                    """
+                )
+            ),
+            values,
+        )
+        await db.conn.commit()
+        after = rows[-1]["id"]
+
+
+async def m010_livestream_revision(db: Connection):
+    """
+    Revision of a livestream, bumped on every change to it, its tracks or its
+    producers, so processes can tell whether their caches are current.
+    """
+    await db.execute(
+        """
+        ALTER TABLE livestream.livestreams
+        ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;
+        """
+    )
+
+
+async def m011_tips_producer_index(db: Connection):
+    """
+    Index for the tip reports of a single producer.
+    """
+    await create_index(
+        db,
+        "tips_livestream_producer_created_idx",
+        "tips",
+        "livestream, producer, created_at",
+    )
+
+
+async def m012_track_search(db: Connection):
+    """
+    Full text index over the names of the tracks and their producers: FTS5 on
+    SQLite, a weighted tsvector with a GIN index on Postgres. Filled from the
+    existing tracks.
+    """
+    if db.type == SQLITE:
+        await db.execute(
+            """
+            CREATE VIRTUAL TABLE livestream.tracks_fts USING fts5(
+                track UNINDEXED,
+                livestream UNINDEXED,
+                name,
+                producer,
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+            """
+        )
+        await db.execute(
+            """
+            INSERT INTO livestream.tracks_fts (track, livestream, name, producer)
+            SELECT t.id, t.livestream, t.name, COALESCE(p.name, '')
+            FROM livestream.tracks AS t
+            LEFT JOIN livestream.producers AS p ON p.id = t.producer;
+            """
+        )
+    else:
+        await db.execute(
+            """
+            CREATE TABLE livestream.track_search (
+                track TEXT PRIMARY KEY,
+                livestream TEXT NOT NULL,
+                document TSVECTOR NOT NULL
+            );
+            """
+        )
+        await db.execute(
+            """
+            CREATE INDEX track_search_document_idx
+            ON livestream.track_search USING GIN (document);
+            """
+        )
+        await create_index(
+            db, "track_search_livestream_idx", "track_search", "livestream"
+        )
+        await db.execute(
+            """
+            INSERT INTO livestream.track_search (track, livestream, document)
+            SELECT t.id, t.livestream,
+                setweight(to_tsvector('simple', t.name), 'A')
+                    || setweight(to_tsvector('simple', COALESCE(p.name, '')), 'B')
+            FROM livestream.tracks AS t
+            LEFT JOIN livestream.producers AS p ON p.id = t.producer;
+            """
+        )
+
+
+async def m013_track_files(db: Connection):
+    """
+    Name and size of the track files hosted by the extension.
+    """
+    await db.execute("ALTER TABLE livestream.tracks ADD COLUMN file_name TEXT;")
+    await db.execute(
+        f"ALTER TABLE livestream.tracks ADD COLUMN file_size {db.big_int};"
+    )
+
+
+async def m014_rehash_track_metadata(db: Connection):
+    """
+    The description hash of tracks with markup in their names was taken before
+    lnbits stripped it from the stored metadata, so it never matched. The
+    metadata of all tracks is rebuilt from their stored names.
+    """
+    await db.execute("UPDATE livestream.tracks SET metadata = NULL;")
+    await _backfill_track_metadata(db)
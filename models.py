@@ -1,19 +1,82 @@
+import hashlib
 import json
-from typing import Optional
+import re
+from time import time
+from typing import Literal, Optional
 
 from fastapi import Query, Request
 from lnurl import Lnurl
 from lnurl import encode as lnurl_encode
 from lnurl.types import LnurlPayMetadata
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from .cache import lnurl_cache
+
+# lnbits strips markup and entities from every string it writes, see
+# Connection.rewrite_values. The stored metadata is hashed as it will be stored.
+_STRIPPED_ON_WRITE = re.compile("<.*?>|&([a-z0-9]+|#[0-9]{1,6}|#x[0-9a-f]{1,6});")
+
+
+def _encode_lnurl(url: str) -> Lnurl:
+    # bech32 encoding is pure but not free, and the URLs of a host never change
+    lnurl = lnurl_cache.get(url)
+    if lnurl is None:
+        lnurl = lnurl_encode(url)
+        lnurl_cache.set(url, lnurl)
+    return lnurl
 
 
 class CreateTrack(BaseModel):
     name: str = Query(...)
-    download_url: str = Query(None)
-    price_msat: int = Query(None, ge=0)
-    producer_id: str = Query(None)
-    producer_name: str = Query(None)
+    download_url: Optional[str] = Query(None)
+    price_msat: Optional[int] = Query(None, ge=0)
+    producer_id: Optional[str] = Query(None)
+    producer_name: Optional[str] = Query(None)
+
+
+class ImportTrack(BaseModel):
+    name: str = Field(..., min_length=1)
+    producer: str = Field(..., min_length=1)
+    price_msat: int = Field(0, ge=0)
+    download_url: Optional[str] = None
+
+    class Config:
+        anystr_strip_whitespace = True
+
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+
+class ImportReport(BaseModel):
+    tracks: list["Track"]
+    producers_created: int
+    errors: list[ImportRowError]
+
+
+class UpdateSettlement(BaseModel):
+    settlement: Literal["instant", "netted"] = "instant"
+    payout_interval: int = Query(3600, ge=60)
+    payout_threshold_msat: int = Query(0, ge=0)
+
+
+class CreateSetListEntry(BaseModel):
+    track_id: str
+    offset: int = Query(..., ge=0)  # seconds after the start of the set
+
+
+class CreateSetList(BaseModel):
+    start: Optional[int] = None  # unix time, defaults to now
+    tracks: list[CreateSetListEntry]
+
+
+class SetListEntry(BaseModel):
+    id: str
+    livestream: str
+    track: str
+    starts_at: int
+    applied_at: Optional[int] = None
 
 
 class Livestream(BaseModel):
@@ -21,10 +84,17 @@ class Livestream(BaseModel):
     wallet: str
     fee_pct: int = 10
     current_track: Optional[str] = None
+    # "instant" pays every tip to the producer right away, "netted" accrues
+    # tips to the ledger and pays one sum per interval or threshold
+    settlement: str = "instant"
+    payout_interval: int = 3600
+    payout_threshold_msat: int = 0
+    # bumped on every change to the livestream, its tracks or its producers
+    revision: int = 0
 
     def lnurl(self, request: Request) -> Lnurl:
         url = str(request.url_for("livestream.lnurl_livestream", ls_id=self.id))
-        return lnurl_encode(url)
+        return _encode_lnurl(url)
 
 
 class Track(BaseModel):
@@ -34,6 +104,17 @@ class Track(BaseModel):
     name: str
     download_url: Optional[str] = None
     price_msat: int = 0
+    # LNURL-pay metadata and its SHA-256 in hex, stored whenever the name,
+    # price, download URL or producer of the track change
+    metadata: Optional[str] = None
+    description_hash: Optional[str] = None
+    # name and size of the file hosted by the extension, see storage.py
+    file_name: Optional[str] = None
+    file_size: Optional[int] = None
+
+    @property
+    def downloadable(self) -> bool:
+        return bool(self.download_url or self.file_name)
 
     @property
     def min_sendable(self) -> int:
@@ -45,25 +126,19 @@ class Track(BaseModel):
 
     def lnurl(self, request: Request) -> Lnurl:
         url = str(request.url_for("livestream.lnurl_track", track_id=self.id))
-        return lnurl_encode(url)
-
-    async def fullname(self) -> str:
-        from .crud import get_producer
-
-        producer = await get_producer(self.producer)
-        if producer:
-            producer_name = producer.name
-        else:
-            producer_name = "unknown author"
+        return _encode_lnurl(url)
 
+    def fullname_for(self, producer: Optional["Producer"]) -> str:
+        producer_name = producer.name if producer else "unknown author"
         return f"'{self.name}', from {producer_name}."
 
-    async def lnurlpay_metadata(self) -> LnurlPayMetadata:
+    def lnurlpay_metadata_for(self, producer: Optional["Producer"]) -> LnurlPayMetadata:
         description = (
-            await self.fullname()
-        ) + " Like this track? Send some sats in appreciation."
+            self.fullname_for(producer)
+            + " Like this track? Send some sats in appreciation."
+        )
 
-        if self.download_url:
+        if self.downloadable:
             description += (
                 f"Send {round(self.price_msat/1000)} "
                 "sats or more and you can download it."
@@ -71,17 +146,230 @@ class Track(BaseModel):
 
         return LnurlPayMetadata(json.dumps([["text/plain", description]]))
 
+    def set_metadata(self, producer: Optional["Producer"]) -> None:
+        metadata = _STRIPPED_ON_WRITE.sub("", str(self.lnurlpay_metadata_for(producer)))
+        self.metadata = metadata
+        self.description_hash = hashlib.sha256(metadata.encode()).hexdigest()
+
+    async def fullname(self) -> str:
+        from .crud import get_producer
+
+        return self.fullname_for(await get_producer(self.producer))
+
+    async def lnurlpay_metadata(self) -> LnurlPayMetadata:
+        from .crud import get_producer
+
+        return self.lnurlpay_metadata_for(await get_producer(self.producer))
+
 
 class Producer(BaseModel):
     id: str
     livestream: str
-    user: str
-    wallet: str
+    # account and wallet are created on the first payout
+    user: Optional[str] = None
+    wallet: Optional[str] = None
     name: str
 
 
+class TrackContext(BaseModel):
+    """
+    A track together with its producer and livestream, loaded in one query.
+    """
+
+    track: Track
+    producer: Optional[Producer] = None
+    livestream: Livestream
+
+    @property
+    def fullname(self) -> str:
+        return self.track.fullname_for(self.producer)
+
+    @property
+    def metadata(self) -> str:
+        if self.track.metadata is None:
+            return str(self.track.lnurlpay_metadata_for(self.producer))
+        return self.track.metadata
+
+    @property
+    def lnurlpay_metadata(self) -> LnurlPayMetadata:
+        if self.track.metadata is None:
+            return self.track.lnurlpay_metadata_for(self.producer)
+        return LnurlPayMetadata(self.track.metadata)
+
+    @property
+    def description(self) -> tuple[bytes, bytes]:
+        """
+        The metadata as bytes and its SHA-256, as create_invoice takes them.
+        """
+        if self.track.metadata is None or self.track.description_hash is None:
+            metadata = self.track.lnurlpay_metadata_for(self.producer).encode()
+            return metadata, hashlib.sha256(metadata).digest()
+        return (
+            self.track.metadata.encode(),
+            bytes.fromhex(self.track.description_hash),
+        )
+
+
+class NowPlaying(BaseModel):
+    track: Optional[str] = None
+    name: Optional[str] = None
+    producer: Optional[str] = None
+
+    @classmethod
+    def from_context(cls, ctx: Optional[TrackContext]) -> "NowPlaying":
+        if not ctx:
+            return cls()
+        return cls(
+            track=ctx.track.id,
+            name=ctx.track.name,
+            producer=ctx.producer.name if ctx.producer else None,
+        )
+
+
+class TipEvent(BaseModel):
+    track: str
+    name: str
+    amount_msat: int
+    comment: Optional[str] = None
+
+
+class LedgerEntry(BaseModel):
+    id: str  # payment hash of the tip
+    livestream: str
+    producer: str
+    track: str
+    amount_msat: int
+    comment: Optional[str] = None
+    payout: Optional[str] = None
+    created_at: int = Field(default_factory=lambda: int(time()))
+
+
+class Tip(BaseModel):
+    id: str  # payment hash of the tip
+    livestream: str
+    track: str
+    producer: str
+    amount_msat: int
+    fee_msat: int
+    share_msat: int
+    comment: Optional[str] = None
+    created_at: int = Field(default_factory=lambda: int(time()))
+
+
+class TipReportRow(BaseModel):
+    """
+    A tip with the names of its track and producer, as exported.
+    """
+
+    id: str
+    created_at: int
+    track: str
+    track_name: Optional[str] = None
+    producer: str
+    producer_name: Optional[str] = None
+    amount_msat: int
+    fee_msat: int
+    share_msat: int
+    comment: Optional[str] = None
+
+
+class TipStats(BaseModel):
+    id: str  # livestream, track or producer id
+    name: Optional[str] = None
+    bucket: int = 0  # start of the hour, 0 for all time
+    count: int = 0
+    total_msat: int = 0
+    last_tip: Optional[int] = None
+
+
+class LivestreamTipStats(BaseModel):
+    total: TipStats
+    hourly: list[TipStats]
+
+
+class Payout(BaseModel):
+    """
+    Producer share of one tip in instant settlement. The tip's payment hash
+    is the id, so a tip can only ever have one payout.
+    """
+
+    id: str
+    livestream: str
+    producer: str
+    track: str
+    wallet: str  # livestream wallet the share is paid from
+    amount_msat: int
+    received_msat: int
+    memo: str
+    comment: Optional[str] = None
+    status: str = "pending"  # "pending", "paid" or "failed"
+    attempts: int = 0
+    next_attempt_at: int = Field(default_factory=lambda: int(time()))
+    producer_wallet: Optional[str] = None
+    invoice: Optional[str] = None
+    payment_hash: Optional[str] = None
+    error: Optional[str] = None
+    created_at: int = Field(default_factory=lambda: int(time()))
+    paid_at: Optional[int] = None
+
+
+class PendingPayout(BaseModel):
+    livestream: str
+    producer: str
+    amount_msat: int
+    oldest: int
+    livestream_wallet: str
+    producer_wallet: Optional[str] = None
+    payout_interval: int
+    payout_threshold_msat: int
+
+    def is_due(self, now: int) -> bool:
+        if (
+            self.payout_threshold_msat
+            and self.amount_msat >= self.payout_threshold_msat
+        ):
+            return True
+        return now - self.oldest >= self.payout_interval
+
+
+class SplitWorkerStats(BaseModel):
+    workers: int
+    queue_depth: int
+    overflow_depth: int
+    in_flight: int
+    processed: int
+    failed: int
+    overflowed: int
+    spilled: int
+    latency_avg_ms: float
+    latency_p95_ms: float
+
+
 class LivestreamOverview(BaseModel):
     lnurl: str
     livestream: Livestream
     tracks: list[Track]
     producers: list[Producer]
+
+
+class LivestreamSummary(BaseModel):
+    lnurl: str
+    livestream: Livestream
+
+
+class TrackPage(BaseModel):
+    data: list[Track]
+    next: Optional[str] = None
+
+
+class TrackSearchPage(BaseModel):
+    data: list[Track]
+    next_offset: Optional[int] = None
+
+
+class ProducerPage(BaseModel):
+    data: list[Producer]
+    next: Optional[str] = None
+
+
+ImportReport.update_forward_refs()
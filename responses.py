@@ -0,0 +1,79 @@
+"""
+LNURL-pay responses written straight to JSON. They match what the lnurl
+models produce byte for byte (see tests/test_responses.py), without building
+and validating a model and without FastAPI encoding the result again.
+"""
+
+import json
+from typing import Optional, Union
+
+from fastapi import Response
+from lnurl.types import ClearnetUrl, DebugUrl, OnionUrl
+from pydantic import parse_obj_as
+
+from .cache import LRUCache
+
+COMMENT_ALLOWED = 300
+
+# base URLs whose LNURLs passed the lnurl URL types unchanged
+_checked_base_urls: LRUCache[str, bool] = LRUCache(maxsize=256)
+
+# the same output as FastAPI's JSONResponse
+encode_json = json.JSONEncoder(
+    ensure_ascii=False, allow_nan=False, separators=(",", ":")
+).encode
+
+
+def check_url(url: str, base_url: str) -> str:
+    """
+    Validates `url` like the lnurl models do, once per base URL: the paths
+    and queries of this extension's URLs don't change the outcome. Raises
+    the model's ValidationError for URLs the models would reject.
+    """
+    if _checked_base_urls.get(base_url):
+        return url
+    parsed = parse_obj_as(Union[DebugUrl, OnionUrl, ClearnetUrl], url)  # type: ignore
+    if str(parsed) != url:
+        # the model rewrote the URL, keep doing that for this host
+        return str(parsed)
+    _checked_base_urls.set(base_url, True)
+    return url
+
+
+def json_response(content: Union[dict, str]) -> Response:
+    """
+    Response of a dict or of its already encoded JSON.
+    """
+    body = content if isinstance(content, str) else encode_json(content)
+    return Response(content=body, media_type="application/json")
+
+
+def pay_response(
+    callback: str, min_sendable: int, max_sendable: int, metadata: str
+) -> dict:
+    return {
+        "tag": "payRequest",
+        "callback": callback,
+        "minSendable": min_sendable,
+        "maxSendable": max_sendable,
+        "metadata": metadata,
+        "commentAllowed": COMMENT_ALLOWED,
+    }
+
+
+def pay_action_response(
+    invoice: str, success_url: Optional[str], description: str
+) -> dict:
+    success_action = None
+    if success_url:
+        success_action = {"tag": "url", "url": success_url, "description": description}
+    return {
+        "pr": invoice,
+        "successAction": success_action,
+        "routes": [],
+        "verify": None,
+    }
+
+
+def error_response(reason: str) -> dict:
+    return {"status": "ERROR", "reason": reason}
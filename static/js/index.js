@@ -4,6 +4,7 @@ window.app = Vue.createApp({
   data() {
     return {
       cancelListener: () => {},
+      trackEvents: null,
       selectedWallet: null,
       nextCurrentTrack: null,
       livestream: {
@@ -61,11 +62,25 @@ window.app = Vue.createApp({
         .then(response => {
           this.livestream = response.data
           this.nextCurrentTrack = this.livestream.livestream.current_track
+          this.startTrackEvents()
         })
         .catch(err => {
           LNbits.utils.notifyApiError(err)
         })
     },
+    startTrackEvents() {
+      if (this.trackEvents) this.trackEvents.close()
+
+      // the current track can also be changed through the API, follow it
+      this.trackEvents = new EventSource(
+        `/livestream/api/v1/livestream/${this.livestream.livestream.id}/events`
+      )
+      this.trackEvents.addEventListener('track', event => {
+        let {track} = JSON.parse(event.data)
+        this.livestream.livestream.current_track = track
+        this.nextCurrentTrack = track
+      })
+    },
     startPaymentNotifier() {
       this.cancelListener()
 
@@ -0,0 +1,155 @@
+"""
+Track files hosted by the extension itself, as an alternative to an external
+download_url. Files are stored in the LNbits data folder under the id of their
+track and go through in chunks both ways, so large lossless files are never
+held in memory.
+"""
+
+import os
+from collections.abc import AsyncIterator, Callable
+from pathlib import Path
+from typing import Optional
+
+import anyio
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.settings import settings
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
+
+STORAGE_DIR = Path(settings.lnbits_data_folder, "livestream", "tracks")
+
+# uploads above this size are refused
+MAX_FILE_SIZE = 2 * 1024**3
+
+# concurrent downloads of one track, further ones are asked to retry
+DOWNLOADS_PER_TRACK = 4
+DOWNLOAD_RETRY_AFTER = 5
+
+# the ASGI extension for handing a file descriptor to the server's sendfile
+ZEROCOPY_SEND = "http.response.zerocopysend"
+
+
+class FileTooLargeError(ValueError):
+    pass
+
+
+def track_path(track_id: str) -> Path:
+    # track ids are url safe hashes, they can't leave the storage folder
+    return STORAGE_DIR / track_id
+
+
+async def store_track_file(track_id: str, chunks: AsyncIterator[bytes]) -> int:
+    """
+    Writes the uploaded chunks to the track's file and returns its size. The
+    file is replaced only once the upload is complete, downloads that are
+    running keep reading the previous one.
+    """
+    STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+    path = track_path(track_id)
+    partial = path.with_name(f"{track_id}.{urlsafe_short_hash()}.part")
+    size = 0
+    try:
+        async with await anyio.open_file(partial, "wb") as file:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise FileTooLargeError(
+                        f"Track files can't be larger than {MAX_FILE_SIZE} bytes."
+                    )
+                await file.write(chunk)
+        os.replace(partial, path)
+    finally:
+        partial.unlink(missing_ok=True)
+    return size
+
+
+def remove_track_file(track_id: str) -> None:
+    track_path(track_id).unlink(missing_ok=True)
+
+
+class DownloadSlots:
+    """
+    Counts the running downloads of every track and refuses a download once
+    its track has `per_track` of them.
+    """
+
+    def __init__(self, per_track: int):
+        self.per_track = per_track
+        self.refused = 0
+        self._running: dict[str, int] = {}
+
+    @property
+    def active(self) -> int:
+        return sum(self._running.values())
+
+    def acquire(self, track_id: str) -> bool:
+        running = self._running.get(track_id, 0)
+        if running >= self.per_track:
+            self.refused += 1
+            return False
+        self._running[track_id] = running + 1
+        return True
+
+    def release(self, track_id: str) -> None:
+        running = self._running.pop(track_id, 0) - 1
+        if running > 0:
+            self._running[track_id] = running
+
+
+download_slots = DownloadSlots(DOWNLOADS_PER_TRACK)
+
+
+class TrackFileResponse(FileResponse):
+    """
+    Starlette's FileResponse, which answers Range and If-Range requests, so
+    interrupted downloads can be resumed. The download slot of the track is
+    released when the transfer ends. Servers that offer the zero copy
+    extension get the file descriptor to sendfile instead of the chunks.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path: Path, filename: str, release: Callable[[], None]):
+        super().__init__(path, filename=filename)
+        self.release = release
+        self.zerocopy = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.zerocopy = ZEROCOPY_SEND in scope.get("extensions", {})
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+    async def _handle_simple(self, send: Send, send_header_only: bool) -> None:
+        if not self.zerocopy or send_header_only:
+            return await super()._handle_simple(send, send_header_only)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        await self._sendfile(send, 0, None)
+
+    async def _handle_single_range(
+        self, send: Send, start: int, end: int, file_size: int, send_header_only: bool
+    ) -> None:
+        if not self.zerocopy or send_header_only:
+            return await super()._handle_single_range(
+                send, start, end, file_size, send_header_only
+            )
+        self.headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        self.headers["content-length"] = str(end - start)
+        await send(
+            {"type": "http.response.start", "status": 206, "headers": self.raw_headers}
+        )
+        await self._sendfile(send, start, end - start)
+
+    async def _sendfile(self, send: Send, offset: int, count: Optional[int]) -> None:
+        message = {"type": ZEROCOPY_SEND, "offset": offset, "more_body": False}
+        if count is not None:
+            message["count"] = count
+        async with await anyio.open_file(self.path, "rb") as file:
+            await send({**message, "file": file.wrapped})
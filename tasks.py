@@ -1,68 +1,649 @@
 import asyncio
+import heapq
+from collections import deque
+from time import perf_counter, time
+from typing import Optional, Union
 
+from lnbits.core.crud import get_payments, get_wallet_payment
 from lnbits.core.models import Payment
 from lnbits.core.services import create_invoice, pay_invoice
 from lnbits.tasks import register_invoice_listener
 from loguru import logger
 
-from .crud import get_livestream_by_track, get_producer, get_track
+from .crud import (
+    claim_payout,
+    claim_set_list_entry,
+    create_netted_payout,
+    create_tip,
+    get_checkpoint,
+    get_current_tracks,
+    get_due_payouts,
+    get_livestreams_page,
+    get_pending_payouts,
+    get_pending_set_list_entries,
+    get_producer,
+    get_recorded_tips,
+    get_track_context,
+    mark_payout_failed,
+    mark_payout_paid,
+    provision_producer_wallet,
+    release_orphaned_ledger_entries,
+    set_checkpoint,
+    set_payout_invoice,
+    update_current_track,
+)
+from .events import event_hub
+from .metrics import metrics
+from .models import (
+    LedgerEntry,
+    NowPlaying,
+    Payout,
+    PendingPayout,
+    Producer,
+    SetListEntry,
+    SplitWorkerStats,
+    Tip,
+    TipEvent,
+    TrackContext,
+)
+
+# number of concurrent split workers and how many splits each one may queue,
+# further splits wait by payment hash in the worker's overflow, and once that
+# is full too they are left to the catch-up scan
+SPLIT_WORKERS = 8
+SPLIT_QUEUE_SIZE = 100
+SPLIT_OVERFLOW_SIZE = 10_000
+# how often netted ledgers are checked for due payouts, in seconds
+PAYOUT_CHECK_INTERVAL = 60
+# how often failed instant payouts are retried, and their backoff: the delay
+# doubles from PAYOUT_RETRY_BASE up to PAYOUT_RETRY_MAX, in seconds
+PAYOUT_RETRY_INTERVAL = 15
+PAYOUT_RETRY_BASE = 30
+PAYOUT_RETRY_MAX = 3600
+PAYOUT_MAX_ATTEMPTS = 10
+# how long a worker may take to pay a payout before another one may retry it
+PAYOUT_LEASE = 300
+# the scan for tips that were never split, see catch_up_unsplit_tips
+CATCH_UP_CHECKPOINT = "tips_scan"
+CATCH_UP_BATCH = 100
+CATCH_UP_OVERLAP = 24 * 60 * 60
+# how often the scheduler reloads pending set lists, which picks up set lists
+# uploaded to other processes, in seconds
+SET_LIST_RELOAD_INTERVAL = 300
+# how often the event streams of this process check for track changes made in
+# other processes, in seconds
+TRACK_POLL_INTERVAL = 2
+
+
+class SplitWorkerPool:
+    """
+    Runs revenue splits concurrently with a fixed number of workers.
+
+    Payments are sharded by producer, so the splits of one producer are paid
+    in the order they were received while different producers are paid in
+    parallel. A failing split is logged and does not affect the others. A
+    full shard never holds up the invoice listener: further splits wait in
+    its overflow by payment hash and are reloaded into the shard, in order,
+    as it drains.
+    """
+
+    def __init__(
+        self,
+        workers: int = SPLIT_WORKERS,
+        queue_size: int = SPLIT_QUEUE_SIZE,
+        overflow_size: int = SPLIT_OVERFLOW_SIZE,
+    ):
+        self.queues: list[asyncio.Queue[tuple[Payment, TrackContext]]] = [
+            asyncio.Queue(maxsize=queue_size) for _ in range(workers)
+        ]
+        # (wallet id, payment hash) of the splits that didn't fit a shard
+        self.overflows: list[deque[tuple[str, str]]] = [deque() for _ in range(workers)]
+        self.overflow_size = overflow_size
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.overflowed = 0
+        self.spilled = 0
+        self.latencies: deque[float] = deque(maxlen=1000)
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._work(shard))
+                for shard in range(len(self.queues))
+            ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, payment: Payment, ctx: TrackContext) -> bool:
+        """
+        Queues the split, or returns False and counts it as spilled if both
+        the shard and its overflow are full.
+        """
+        # one producer has one wallet, so the producer id is a stable shard key
+        shard = hash(ctx.track.producer) % len(self.queues)
+        queue, overflow = self.queues[shard], self.overflows[shard]
+        if not overflow:
+            try:
+                queue.put_nowait((payment, ctx))
+                return True
+            except asyncio.QueueFull:
+                pass
+        # behind the splits that are waiting already, to keep them in order
+        if len(overflow) >= self.overflow_size:
+            self.spilled += 1
+            return False
+        overflow.append((payment.wallet_id, payment.payment_hash))
+        self.overflowed += 1
+        return True
+
+    async def join(self) -> None:
+        for queue in self.queues:
+            await queue.join()
+
+    async def _work(self, shard: int):
+        queue = self.queues[shard]
+        while True:
+            payment, ctx = await queue.get()
+            self.in_flight += 1
+            start = perf_counter()
+            try:
+                await split_payment(payment, ctx)
+            except Exception as exc:
+                self.failed += 1
+                logger.error(
+                    f"livestream: split of {payment.payment_hash} failed: {exc!s}"
+                )
+            else:
+                self.processed += 1
+            finally:
+                self.in_flight -= 1
+                self.latencies.append(perf_counter() - start)
+            try:
+                await self._refill(shard)
+            finally:
+                # after the refill, so join doesn't return with an overflow left
+                queue.task_done()
+
+    async def _refill(self, shard: int) -> None:
+        queue, overflow = self.queues[shard], self.overflows[shard]
+        while overflow and not queue.full():
+            # taken off the overflow only once queued, so newer splits keep
+            # going to the overflow in the meantime
+            wallet_id, payment_hash = overflow[0]
+            try:
+                payment = await get_wallet_payment(wallet_id, payment_hash)
+                ctx = await load_split_context(payment) if payment else None
+            except Exception as exc:
+                # left to the catch-up scan at the next start
+                logger.error(f"livestream: could not reload {payment_hash}: {exc!s}")
+                payment = ctx = None
+            overflow.popleft()
+            if payment and ctx:
+                queue.put_nowait((payment, ctx))
+
+    def stats(self) -> SplitWorkerStats:
+        latencies = sorted(self.latencies)
+        return SplitWorkerStats(
+            workers=len(self.queues),
+            queue_depth=sum(queue.qsize() for queue in self.queues),
+            overflow_depth=sum(len(overflow) for overflow in self.overflows),
+            in_flight=self.in_flight,
+            processed=self.processed,
+            failed=self.failed,
+            overflowed=self.overflowed,
+            spilled=self.spilled,
+            latency_avg_ms=(
+                sum(latencies) / len(latencies) * 1000 if latencies else 0.0
+            ),
+            latency_p95_ms=(
+                latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0
+            ),
+        )
+
+
+split_pool = SplitWorkerPool()
 
 
 async def wait_for_paid_invoices():
     invoice_queue = asyncio.Queue()
     register_invoice_listener(invoice_queue, "ext_livestream")
 
-    while True:
-        payment = await invoice_queue.get()
-        await on_invoice_paid(payment)
+    split_pool.start()
+    try:
+        while True:
+            payment = await invoice_queue.get()
+            try:
+                ctx = await load_split_context(payment)
+                if ctx and not split_pool.submit(payment, ctx):
+                    logger.warning(
+                        f"livestream: split overflow full, {payment.payment_hash} "
+                        "is left to the catch-up scan"
+                    )
+            except Exception as exc:
+                logger.error(f"livestream: could not queue {payment.payment_hash}")
+                logger.error(exc)
+    finally:
+        await split_pool.stop()
 
 
 async def on_invoice_paid(payment: Payment) -> None:
+    ctx = await load_split_context(payment)
+    if ctx:
+        await split_payment(payment, ctx)
 
+
+async def load_split_context(payment: Payment) -> Optional[TrackContext]:
     if not payment.extra or payment.extra.get("tag") != "livestream":
         # not a livestream invoice
-        return
+        return None
 
-    track = await get_track(payment.extra.get("track", -1))
-    if not track:
+    with metrics.span("split_payment", "context"):
+        ctx = await get_track_context(payment.extra.get("track", -1))
+    if not ctx:
         logger.error("this should never happen", payment)
-        return
+        return None
 
     if payment.extra.get("shared_with"):
         logger.error("payment was shared already", payment)
-        return
+        return None
+
+    return ctx
 
-    producer = await get_producer(track.producer)
-    assert producer, f"track {track.id} is not associated with a producer"
 
-    ls = await get_livestream_by_track(track.id)
-    assert ls, f"track {track.id} is not associated with a livestream"
+async def split_payment(payment: Payment, ctx: TrackContext) -> None:
+    track, producer, ls = ctx.track, ctx.producer, ctx.livestream
+    assert producer, f"track {track.id} is not associated with a producer"
 
     amount = int(payment.amount * (100 - ls.fee_pct) / 100)
+    comment = payment.extra.get("comment")
+    # splits can run long after the payment, after a restart or a spill
+    paid_at = int(payment.time.timestamp())
+    share: Union[LedgerEntry, Payout]
+    if ls.settlement == "netted":
+        share = LedgerEntry(
+            id=payment.payment_hash,
+            livestream=ls.id,
+            producer=producer.id,
+            track=track.id,
+            amount_msat=amount,
+            comment=comment,
+            created_at=paid_at,
+        )
+    else:
+        share = Payout(
+            id=payment.payment_hash,
+            livestream=ls.id,
+            producer=producer.id,
+            track=track.id,
+            wallet=payment.wallet_id,
+            amount_msat=amount,
+            received_msat=payment.amount,
+            memo=f"Revenue from '{track.name}'.",
+            comment=comment,
+            created_at=paid_at,
+            # taken by this worker right away, retried if it dies on the way
+            next_attempt_at=int(time()) + PAYOUT_LEASE,
+        )
 
-    payment = await create_invoice(
-        wallet_id=producer.wallet,
-        amount=int(amount / 1000),
-        internal=True,
-        memo=f"Revenue from '{track.name}'.",
-    )
-    logger.debug(
-        f"livestream: producer invoice created: {payment.payment_hash}, {amount} msats"
-    )
+    with metrics.span("split_payment", "tip"):
+        recorded = await create_tip(
+            Tip(
+                id=payment.payment_hash,
+                livestream=ls.id,
+                track=track.id,
+                producer=producer.id,
+                amount_msat=payment.amount,
+                fee_msat=payment.amount - amount,
+                share_msat=amount,
+                comment=comment,
+                created_at=paid_at,
+            ),
+            share,
+        )
+    if not recorded:
+        # a replay, the share was queued and the tip announced the first time
+        return
 
-    payment = await pay_invoice(
-        payment_request=payment.bolt11,
-        wallet_id=payment.wallet_id,
-        extra={
-            **payment.extra,
-            "shared_with": f"Producer ID: {producer.id}",
-            "received": payment.amount,
-        },
+    tip = TipEvent(
+        track=track.id,
+        name=track.name,
+        amount_msat=payment.amount,
+        comment=comment,
     )
-    logger.debug(f"livestream: producer invoice paid: {payment.checking_id}")
+    event_hub.publish(ls.id, "tip", tip.dict())
+
+    if isinstance(share, LedgerEntry):
+        logger.debug(f"livestream: {amount} msats accrued to producer {producer.id}")
+        return
+
+    await pay_payout(share, producer)
 
     # so the flow is the following:
     # - we receive, say, 1000 satoshis
     # - if the fee_pct is, say, 30%, the amount we will send is 700
     # - we change the amount of receiving payment on the database from 1000 to 300
     # - we create a new payment on the producer's wallet with amount 700
+
+
+async def pay_payout(payout: Payout, producer: Optional[Producer] = None) -> None:
+    """
+    Pays a payout from the outbox, the caller has to hold its lease. The
+    producer invoice is stored before it is paid and reused by every retry,
+    and a retry first checks whether it was paid already, so a payout is
+    never paid twice.
+    """
+    try:
+        if payout.invoice and payout.payment_hash and payout.producer_wallet:
+            existing = await get_wallet_payment(
+                payout.producer_wallet, payout.payment_hash
+            )
+            if existing and existing.success:
+                await mark_payout_paid(payout.id, int(time()))
+                return
+            bolt11 = payout.invoice
+        else:
+            with metrics.span("split_payment", "provision"):
+                producer = producer or await get_producer(payout.producer)
+                assert producer, f"producer {payout.producer} does not exist"
+                producer = await provision_producer_wallet(producer)
+            assert producer.wallet
+            with metrics.span("split_payment", "create_invoice"):
+                invoice = await create_invoice(
+                    wallet_id=producer.wallet,
+                    amount=int(payout.amount_msat / 1000),
+                    internal=True,
+                    memo=payout.memo,
+                )
+            await set_payout_invoice(
+                payout.id, producer.wallet, invoice.bolt11, invoice.payment_hash
+            )
+            bolt11 = invoice.bolt11
+            logger.debug(
+                f"livestream: producer invoice created: {invoice.payment_hash}, "
+                f"{payout.amount_msat} msats"
+            )
+
+        with metrics.span("split_payment", "pay_invoice"):
+            paid = await pay_invoice(
+                payment_request=bolt11,
+                wallet_id=payout.wallet,
+                extra={
+                    "tag": "livestream",
+                    "track": payout.track,
+                    "comment": payout.comment,
+                    "payout": payout.id,
+                    "shared_with": f"Producer ID: {payout.producer}",
+                    "received": payout.received_msat,
+                },
+            )
+    except Exception as exc:
+        attempts = payout.attempts + 1
+        retry_at = None
+        if attempts < PAYOUT_MAX_ATTEMPTS:
+            retry_at = int(time()) + min(
+                PAYOUT_RETRY_BASE * 2 ** (attempts - 1), PAYOUT_RETRY_MAX
+            )
+        await mark_payout_failed(payout.id, attempts, retry_at, str(exc))
+        raise
+
+    await mark_payout_paid(payout.id, int(time()))
+    logger.debug(f"livestream: producer invoice paid: {paid.checking_id}")
+
+
+async def wait_for_payouts():
+    spilled = split_pool.spilled
+    await _catch_up()
+    while True:
+        spilled = await catch_up_spilled_splits(spilled)
+        await retry_due_payouts()
+        await asyncio.sleep(PAYOUT_RETRY_INTERVAL)
+
+
+async def catch_up_spilled_splits(scanned: int) -> int:
+    """
+    Runs the catch-up scan if the split pool spilled splits since it had
+    spilled `scanned` of them, and returns the new count.
+    """
+    spilled = split_pool.spilled
+    if spilled != scanned:
+        await _catch_up()
+    return spilled
+
+
+async def _catch_up() -> None:
+    try:
+        await catch_up_unsplit_tips()
+    except Exception as exc:
+        logger.error(f"livestream: scan for unsplit tips failed: {exc!s}")
+
+
+async def retry_due_payouts() -> None:
+    for payout in await get_due_payouts(int(time()), CATCH_UP_BATCH):
+        now = int(time())
+        if not await claim_payout(payout.id, now, now + PAYOUT_LEASE):
+            # taken by another worker in the meantime
+            continue
+        try:
+            await pay_payout(payout)
+        except Exception as exc:
+            logger.warning(f"livestream: payout {payout.id} failed: {exc!s}")
+
+
+async def catch_up_unsplit_tips() -> int:
+    """
+    Splits tips that were paid while the extension wasn't listening, for
+    example when LNbits restarted between the payment and its split. Scans
+    the incoming payments of every livestream wallet in batches, starting a
+    while before the previous scan. Returns the number of tips it split.
+    """
+    started = int(time())
+    since = await get_checkpoint(CATCH_UP_CHECKPOINT)
+    if since is None:
+        return 0
+
+    split = 0
+    after = None
+    while True:
+        livestreams = await get_livestreams_page(after, CATCH_UP_BATCH)
+        for ls in livestreams:
+            offset = 0
+            while True:
+                payments = await get_payments(
+                    wallet_id=ls.wallet,
+                    complete=True,
+                    incoming=True,
+                    since=since,
+                    limit=CATCH_UP_BATCH,
+                    offset=offset,
+                )
+                tips = [
+                    payment
+                    for payment in payments
+                    if payment.success
+                    and payment.extra
+                    and payment.extra.get("tag") == "livestream"
+                ]
+                recorded = await get_recorded_tips([tip.payment_hash for tip in tips])
+                for tip in tips:
+                    if tip.payment_hash in recorded:
+                        continue
+                    try:
+                        await on_invoice_paid(tip)
+                        split += 1
+                    except Exception as exc:
+                        logger.error(
+                            f"livestream: catching up {tip.payment_hash} failed: "
+                            f"{exc!s}"
+                        )
+                if len(payments) < CATCH_UP_BATCH:
+                    break
+                offset += CATCH_UP_BATCH
+        if len(livestreams) < CATCH_UP_BATCH:
+            break
+        after = livestreams[-1].id
+
+    # invoices are timestamped when they are created, so one that was paid
+    # late is still found by the next scan
+    await set_checkpoint(CATCH_UP_CHECKPOINT, started - CATCH_UP_OVERLAP)
+    if split:
+        logger.info(f"livestream: split {split} tips that were missed")
+    return split
+
+
+async def wait_for_netted_payouts():
+    try:
+        released = await release_orphaned_ledger_entries()
+        if released:
+            logger.info(f"livestream: released {released} stranded ledger entries")
+    except Exception as exc:
+        logger.error(f"livestream: releasing ledger entries failed: {exc!s}")
+    while True:
+        await settle_netted_payouts()
+        await asyncio.sleep(PAYOUT_CHECK_INTERVAL)
+
+
+async def settle_netted_payouts() -> None:
+    now = int(time())
+    for pending in await get_pending_payouts():
+        if not pending.is_due(now):
+            continue
+        try:
+            await pay_netted_payout(pending)
+        except Exception as exc:
+            logger.error(
+                f"livestream: payout to producer {pending.producer} failed: {exc!s}"
+            )
+
+
+async def pay_netted_payout(pending: PendingPayout) -> None:
+    """
+    Queues the producer's unsettled entries as one payout in the outbox and
+    pays it. A payout that fails, or isn't paid because the process stopped,
+    is retried by the outbox like the payouts of instant splits.
+    """
+    payout = await create_netted_payout(pending)
+    if not payout:
+        # nothing payable yet, keep accruing
+        return
+    now = int(time())
+    if not await claim_payout(payout.id, now, now + PAYOUT_LEASE):
+        return
+    await pay_payout(payout)
+    logger.debug(
+        f"livestream: netted payout {payout.id} of {payout.amount_msat} msats "
+        f"to producer {pending.producer}"
+    )
+
+
+class TrackScheduler:
+    """
+    Advances the current track of every livestream along its set list.
+
+    All pending entries sit in one heap ordered by start time, so one task
+    sleeps until the next entry of any livestream is due. Entries are claimed
+    in the database before they are applied, so each one is applied once even
+    with several processes, and entries that were replaced in the meantime
+    are skipped. Pending entries are loaded from the database on start, which
+    resumes the set lists after a restart.
+    """
+
+    def __init__(self, reload_interval: float = SET_LIST_RELOAD_INTERVAL):
+        self.reload_interval = reload_interval
+        self.heap: list[tuple[int, str, str, str]] = []
+        self._wake = asyncio.Event()
+        self._reloaded_at = 0.0
+
+    def schedule(self, entries: list[SetListEntry]) -> None:
+        for entry in entries:
+            heapq.heappush(
+                self.heap, (entry.starts_at, entry.id, entry.livestream, entry.track)
+            )
+        self._wake.set()
+
+    async def reload(self) -> None:
+        self.heap = []
+        self.schedule(await get_pending_set_list_entries())
+        self._reloaded_at = time()
+
+    async def run(self) -> None:
+        while True:
+            now = time()
+            if now - self._reloaded_at >= self.reload_interval:
+                await self.reload()
+            delay = self.reload_interval - (now - self._reloaded_at)
+            if self.heap:
+                delay = min(delay, self.heap[0][0] - now)
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._wake.clear()
+            await self.apply_due(int(time()))
+
+    async def apply_due(self, now: int) -> None:
+        # only the latest due entry of a livestream is played, the ones before
+        # it were missed while the scheduler was down
+        latest: dict[str, tuple[int, str, str, str]] = {}
+        while self.heap and self.heap[0][0] <= now:
+            item = heapq.heappop(self.heap)
+            ls_id = item[2]
+            previous = latest.get(ls_id)
+            if previous:
+                await claim_set_list_entry(previous[1], now)
+            latest[ls_id] = item
+
+        for _, entry_id, ls_id, track_id in latest.values():
+            try:
+                if await claim_set_list_entry(entry_id, now):
+                    await update_current_track(ls_id, track_id)
+            except Exception as exc:
+                logger.error(
+                    f"livestream: set list entry {entry_id} of {ls_id} failed: "
+                    f"{exc!s}"
+                )
+
+
+track_scheduler = TrackScheduler()
+
+
+async def wait_for_set_lists():
+    await track_scheduler.run()
+
+
+async def wait_for_track_changes():
+    while True:
+        try:
+            await announce_track_changes()
+        except Exception as exc:
+            logger.error(f"livestream: polling track changes failed: {exc!s}")
+        await asyncio.sleep(TRACK_POLL_INTERVAL)
+
+
+async def announce_track_changes() -> int:
+    """
+    Announces the current track of every livestream with event streams in
+    this process, if it changed since it was last announced here. Changes
+    made in this process are announced right away by update_current_track,
+    this picks up the ones made by other processes. Returns the number of
+    livestreams whose track was announced.
+    """
+    announced = dict(event_hub.announced)
+    current = await get_current_tracks(list(event_hub.subscribers))
+    changed = 0
+    for ls_id, track_id in current.items():
+        if announced.get(ls_id, track_id) == track_id:
+            continue
+        ctx = await get_track_context(track_id) if track_id else None
+        if event_hub.announced.get(ls_id) != announced[ls_id]:
+            # changed in this process meanwhile, which announced it already
+            continue
+        event_hub.publish_track(ls_id, track_id, NowPlaying.from_context(ctx).dict())
+        changed += 1
+    return changed
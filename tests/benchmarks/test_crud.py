@@ -0,0 +1,177 @@
+"""
+pytest-benchmark timings of the crud and payment split paths at growing
+catalog sizes. Run with `make bench`, which saves the results as JSON under
+.benchmarks/ so two runs can be compared with `pytest-benchmark compare`.
+"""
+
+import pytest
+from lnbits.core.models import Payment
+from lnbits.helpers import urlsafe_short_hash
+from sqlalchemy import text
+
+from ... import tasks
+from ...crud import (
+    create_livestream,
+    create_producer,
+    get_producers,
+    get_tracks,
+    get_tracks_page,
+    search_tracks,
+    update_livestream_settlement,
+)
+from ...models import UpdateSettlement
+from ..helpers import fake_create_invoice
+
+CATALOG_SIZES = [10, 1_000, 100_000]
+
+
+async def _fill_catalog(db, size: int) -> str:
+    """
+    Livestream with `size` producers and `size` tracks, one per producer.
+    """
+    ls = await create_livestream(f"bench-{urlsafe_short_hash()}")
+    producers = [
+        {
+            "id": urlsafe_short_hash(),
+            "livestream": ls.id,
+            "user": "bench",
+            "wallet": "bench",
+            "name": f"Producer {n}",
+        }
+        for n in range(size)
+    ]
+    tracks = [
+        {
+            "id": urlsafe_short_hash(),
+            "livestream": ls.id,
+            "producer": producer["id"],
+            "name": f"Track {n}",
+            "price_msat": 0,
+        }
+        for n, producer in enumerate(producers)
+    ]
+    async with db.connect() as conn:
+        await conn.conn.execute(
+            text(
+                """
+                INSERT INTO livestream.producers (id, livestream, "user", wallet, name)
+                VALUES (:id, :livestream, :user, :wallet, :name)
+                """
+            ),
+            producers,
+        )
+        await conn.conn.execute(
+            text(
+                """
+                INSERT INTO livestream.tracks
+                    (id, livestream, producer, name, price_msat)
+                VALUES (:id, :livestream, :producer, :name, :price_msat)
+                """
+            ),
+            tracks,
+        )
+        await conn.conn.execute(
+            text(
+                """
+                INSERT INTO livestream.tracks_fts (track, livestream, name, producer)
+                SELECT t.id, t.livestream, t.name, p.name
+                FROM livestream.tracks AS t
+                JOIN livestream.producers AS p ON p.id = t.producer
+                WHERE t.livestream = :livestream
+                """
+            ),
+            {"livestream": ls.id},
+        )
+        await conn.conn.commit()
+    return ls.id
+
+
+@pytest.fixture(scope="module")
+def catalogs(database, event_loop) -> dict[int, str]:
+    return {
+        size: event_loop.run_until_complete(_fill_catalog(database, size))
+        for size in CATALOG_SIZES
+    }
+
+
+@pytest.fixture
+def run(event_loop):
+    return lambda fn, *args, **kwargs: event_loop.run_until_complete(
+        fn(*args, **kwargs)
+    )
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize("size", CATALOG_SIZES)
+def test_get_tracks(benchmark, catalogs, run, size):
+    benchmark.group = "get_tracks"
+    tracks = benchmark(run, get_tracks, catalogs[size])
+    assert len(tracks) == size
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize("size", CATALOG_SIZES)
+def test_get_producers(benchmark, catalogs, run, size):
+    benchmark.group = "get_producers"
+    producers = benchmark(run, get_producers, catalogs[size])
+    assert len(producers) == size
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize("size", CATALOG_SIZES)
+def test_create_producer_dedup(benchmark, catalogs, run, size):
+    benchmark.group = "create_producer"
+    # an existing producer, so every round is a lookup without an insert
+    name = f"PRODUCER {size // 2}"
+    producer = benchmark(run, create_producer, catalogs[size], name)
+    assert producer.name == f"Producer {size // 2}"
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize("size", CATALOG_SIZES)
+def test_search_tracks(benchmark, catalogs, run, size):
+    benchmark.group = "search_tracks"
+    # "Track 1", "Track 10", "Track 100", ...: a prefix match in every catalog
+    tracks = benchmark(run, search_tracks, catalogs[size], "track 1", limit=50)
+    assert tracks
+    assert all(track.name.startswith("Track 1") for track in tracks)
+
+
+@pytest.fixture
+def stub_payments(monkeypatch, run):
+    """
+    create_invoice and pay_invoice without the core database. Every split
+    gets the same invoice, so the benchmark only measures the extension.
+    """
+    invoice = run(fake_create_invoice, wallet_id="producer", amount=900)
+
+    async def create_invoice(**_):
+        return invoice
+
+    async def pay_invoice(**_):
+        return invoice
+
+    monkeypatch.setattr(tasks, "create_invoice", create_invoice)
+    monkeypatch.setattr(tasks, "pay_invoice", pay_invoice)
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize("settlement", ["instant", "netted"])
+def test_on_invoice_paid(benchmark, catalogs, run, stub_payments, settlement):
+    benchmark.group = "on_invoice_paid"
+    ls_id = catalogs[CATALOG_SIZES[-1]]
+    run(update_livestream_settlement, ls_id, UpdateSettlement(settlement=settlement))
+    track = run(get_tracks_page, ls_id, limit=1)[0]
+    tip = run(fake_create_invoice, wallet_id="livestream", amount=1000)
+    tip.extra = {"tag": "livestream", "track": track.id, "comment": ""}
+
+    def new_tip() -> tuple[tuple[Payment], dict]:
+        # a new payment hash per round, replays would skip the tip insert
+        return (tip.copy(update={"payment_hash": urlsafe_short_hash()}),), {}
+
+    benchmark.pedantic(
+        lambda payment: run(tasks.on_invoice_paid, payment),
+        setup=new_tip,
+        rounds=500,
+        warmup_rounds=10,
+    )
@@ -0,0 +1,124 @@
+"""
+Lookup time of the hot queries at 100k tracks, with and without the m003
+indexes. Run with `pytest tests/benchmarks/test_indexes.py --run-bench -s`.
+"""
+
+import statistics
+from time import perf_counter
+
+import pytest
+from lnbits.db import SQLITE
+from lnbits.helpers import urlsafe_short_hash
+from sqlalchemy import text
+
+from ...crud import create_producer, get_livestream_id_by_wallet, get_tracks
+from ...migrations import create_index
+
+LIVESTREAMS = 10_000
+TRACKS_PER_LIVESTREAM = 10
+PRODUCERS_PER_LIVESTREAM = 5
+ROUNDS = 50
+
+INDEXES = [
+    ("livestreams_wallet_idx", "livestreams", "wallet", True),
+    ("tracks_livestream_id_idx", "tracks", "livestream, id", False),
+    ("producers_livestream_name_idx", "producers", "livestream, lower(name)", False),
+]
+
+
+async def _fill(db) -> tuple[str, str]:
+    livestreams, producers, tracks = [], [], []
+    for n in range(LIVESTREAMS):
+        ls_id = urlsafe_short_hash()
+        livestreams.append({"id": ls_id, "wallet": f"bench-wallet-{n}"})
+        for p in range(PRODUCERS_PER_LIVESTREAM):
+            producers.append(
+                {
+                    "id": urlsafe_short_hash(),
+                    "livestream": ls_id,
+                    "user": "bench",
+                    "wallet": "bench",
+                    "name": f"Producer {p}",
+                }
+            )
+        for t in range(TRACKS_PER_LIVESTREAM):
+            tracks.append(
+                {
+                    "id": urlsafe_short_hash(),
+                    "livestream": ls_id,
+                    "producer": producers[-1]["id"],
+                    "name": f"Track {t}",
+                }
+            )
+    async with db.connect() as conn:
+        await conn.conn.execute(
+            text(
+                "INSERT INTO livestream.livestreams (id, wallet) VALUES (:id, :wallet)"
+            ),
+            livestreams,
+        )
+        await conn.conn.execute(
+            text(
+                """
+                INSERT INTO livestream.producers (id, livestream, "user", wallet, name)
+                VALUES (:id, :livestream, :user, :wallet, :name)
+                """
+            ),
+            producers,
+        )
+        await conn.conn.execute(
+            text(
+                """
+                INSERT INTO livestream.tracks (id, livestream, producer, name)
+                VALUES (:id, :livestream, :producer, :name)
+                """
+            ),
+            tracks,
+        )
+        await conn.conn.commit()
+    middle = livestreams[LIVESTREAMS // 2]
+    return middle["id"], middle["wallet"]
+
+
+async def _median_ms(fn) -> float:
+    timings = []
+    for _ in range(ROUNDS):
+        start = perf_counter()
+        await fn()
+        timings.append(perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def _measure(ls_id: str, wallet: str) -> dict[str, float]:
+    return {
+        "get_tracks": await _median_ms(lambda: get_tracks(ls_id)),
+        "livestream_by_wallet": await _median_ms(
+            lambda: get_livestream_id_by_wallet(wallet)
+        ),
+        "producer_by_name": await _median_ms(
+            lambda: create_producer(ls_id, "PRODUCER 3")
+        ),
+    }
+
+
+@pytest.mark.bench
+@pytest.mark.asyncio
+async def test_index_lookups_at_100k_tracks(database, capsys):
+    ls_id, wallet = await _fill(database)
+
+    after = await _measure(ls_id, wallet)
+    for name, *_ in INDEXES:
+        index = f"livestream.{name}" if database.type == SQLITE else name
+        await database.execute(f"DROP INDEX {index}")
+    before = await _measure(ls_id, wallet)
+    async with database.connect() as conn:
+        for args in INDEXES:
+            await create_index(conn, *args)
+
+    with capsys.disabled():
+        print(f"\n{'query':<24}{'no index (ms)':>16}{'m003 (ms)':>12}")
+        for query, ms in before.items():
+            print(f"{query:<24}{ms:>16.3f}{after[query]:>12.3f}")
+
+    for query in before:
+        assert after[query] < before[query]
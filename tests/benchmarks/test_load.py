@@ -0,0 +1,199 @@
+"""
+Replays the traffic of a concert in-process: a burst of QR scans of the
+livestream, a share of them paying the track, the paid invoices going through
+wait_for_paid_invoices and the DJ switching tracks during the burst. Reports
+latency percentiles and throughput per endpoint.
+
+Run with `pytest tests/benchmarks/test_load.py --run-bench -s`.
+"""
+
+import asyncio
+import random
+import statistics
+from collections import defaultdict
+from time import perf_counter
+
+import pytest
+from lnbits.core.models import Payment
+from lnbits.helpers import urlsafe_short_hash
+
+from ... import tasks, views_lnurl
+from ...admission import RateLimiter
+from ...crud import create_track
+from ...models import CreateTrack
+from ..helpers import create_playing_track, fake_create_invoice
+
+SCANS = 5_000
+# share of the scans that go on to pay
+CONVERSION = 0.2
+# phones hitting the server at the same time
+CONCURRENCY = 200
+TRACK_SWITCHES = 5
+# the same fans convert on every run
+SEED = 21
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.errors: defaultdict[str, int] = defaultdict(int)
+
+    def add(self, endpoint: str, seconds: float, ok: bool = True) -> None:
+        self.latencies[endpoint].append(seconds)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def report(self, duration: float) -> str:
+        lines = [
+            f"{'endpoint':<22}{'count':>7}{'errors':>8}{'p50 ms':>9}"
+            f"{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}"
+        ]
+        for endpoint, latencies in self.latencies.items():
+            p = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else []
+            p50, p95, p99 = (p[49], p[94], p[98]) if p else (latencies[0],) * 3
+            lines.append(
+                f"{endpoint:<22}{len(latencies):>7}{self.errors[endpoint]:>8}"
+                f"{p50 * 1000:>9.2f}{p95 * 1000:>9.2f}{p99 * 1000:>9.2f}"
+                f"{len(latencies) / duration:>9.1f}"
+            )
+        return "\n".join(lines)
+
+
+@pytest.fixture
+def stub_invoices(monkeypatch, event_loop):
+    """
+    Invoice services without the core database. All invoices share one bolt11
+    but get their own payment hash, so every paid invoice is a separate tip.
+    Invoices are returned by their comment, which identifies the fan.
+    """
+    template = event_loop.run_until_complete(
+        fake_create_invoice(wallet_id="", amount=1)
+    )
+    created: dict[str, Payment] = {}
+
+    async def create_invoice(*, wallet_id: str, amount: float, **kwargs):
+        payment = template.copy(
+            update={
+                "payment_hash": urlsafe_short_hash(),
+                "wallet_id": wallet_id,
+                "amount": int(amount * 1000),
+                "extra": kwargs.get("extra") or {},
+            }
+        )
+        created[payment.extra.get("comment", "")] = payment
+        return payment
+
+    async def pay_invoice(**_):
+        return template
+
+    monkeypatch.setattr(views_lnurl, "create_invoice", create_invoice)
+    monkeypatch.setattr(tasks, "create_invoice", create_invoice)
+    monkeypatch.setattr(tasks, "pay_invoice", pay_invoice)
+    return created
+
+
+@pytest.fixture
+def invoice_listener(monkeypatch):
+    """
+    Captures the queue wait_for_paid_invoices registers, so the test can
+    feed it paid invoices like LNbits does.
+    """
+    queues: list[asyncio.Queue] = []
+    monkeypatch.setattr(
+        tasks, "register_invoice_listener", lambda queue, _: queues.append(queue)
+    )
+    return queues
+
+
+@pytest.mark.bench
+@pytest.mark.asyncio
+async def test_concert_burst(
+    client, invoice_listener, monkeypatch, stub_invoices, wallet_id, capsys
+):
+    ls, producer, track = await create_playing_track(wallet_id)
+    tracks = [track] + [
+        await create_track(ls.id, producer, CreateTrack(name=f"Track {n}"))
+        for n in range(TRACK_SWITCHES)
+    ]
+    stats = LoadStats()
+    rng = random.Random(SEED)
+    # all fans share the address of the test client, so only the
+    # per-livestream admission control applies
+    monkeypatch.setattr(views_lnurl, "client_limiter", RateLimiter(SCANS, SCANS))
+    throttled: list[int] = []
+
+    paid_at: dict[str, float] = {}
+    split_payment = tasks.split_payment
+
+    async def timed_split(payment, ctx):
+        ok = False
+        try:
+            await split_payment(payment, ctx)
+            ok = True
+        finally:
+            seconds = perf_counter() - paid_at[payment.payment_hash]
+            stats.add("split (paid->done)", seconds, ok)
+
+    monkeypatch.setattr(tasks, "split_payment", timed_split)
+    listener = asyncio.create_task(tasks.wait_for_paid_invoices())
+    await asyncio.sleep(0)
+    invoices = invoice_listener[0]
+
+    async def request(endpoint: str, method: str, url: str, **kwargs):
+        start = perf_counter()
+        res = await client.request(method, url, **kwargs)
+        stats.add(endpoint, perf_counter() - start, res.is_success)
+        return res
+
+    async def fan(n: int):
+        res = await request("GET /lnurl/{ls_id}", "GET", f"/livestream/lnurl/{ls.id}")
+        if not res.is_success or rng.random() >= CONVERSION:
+            return
+        pay = res.json()
+        res = await request(
+            "GET /lnurl/cb/{track}",
+            "GET",
+            pay["callback"],
+            params={"amount": pay["minSendable"] * 10, "comment": f"fan {n}"},
+        )
+        if not res.is_success:
+            return
+        if res.json().get("status") == "ERROR":
+            throttled.append(n)
+            return
+        payment = stub_invoices[f"fan {n}"]
+        paid_at[payment.payment_hash] = perf_counter()
+        await invoices.put(payment.copy(update={"status": "success"}))
+
+    async def dj():
+        for next_track in tracks[1:]:
+            await asyncio.sleep(0.2)
+            await request(
+                "PUT /track/{track}",
+                "PUT",
+                f"/livestream/api/v1/livestream/track/{next_track.id}",
+                headers={"X-Api-Key": wallet_id},
+            )
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def limited(n: int):
+        async with semaphore:
+            await fan(n)
+
+    start = perf_counter()
+    await asyncio.gather(dj(), *(limited(n) for n in range(SCANS)))
+    while len(stats.latencies["split (paid->done)"]) < len(paid_at):
+        await asyncio.sleep(0.01)
+    duration = perf_counter() - start
+
+    listener.cancel()
+    await asyncio.gather(listener, return_exceptions=True)
+
+    with capsys.disabled():
+        print(f"\n{SCANS} scans in {duration:.2f}s, concurrency {CONCURRENCY}")
+        print(stats.report(duration))
+        print(f"{len(throttled)} callbacks refused by admission control")
+
+    assert not any(stats.errors.values())
+    assert len(stats.latencies["PUT /track/{track}"]) == TRACK_SWITCHES
@@ -0,0 +1,188 @@
+import asyncio
+import inspect
+import os
+import re
+
+import pytest
+import pytest_asyncio
+from fastapi import FastAPI, Request
+from httpx import ASGITransport, AsyncClient
+from lnbits.core.models import KeyType, Payment, Wallet, WalletTypeInfo
+from lnbits.decorators import require_admin_key, require_invoice_key
+from lnbits.helpers import urlsafe_short_hash
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from .. import livestream_ext, migrations, views_lnurl
+from ..crud import db
+from .helpers import fake_create_invoice
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--run-bench",
+        action="store_true",
+        default=False,
+        help="run the benchmarks in tests/benchmarks",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-bench"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, use --run-bench to run")
+    for item in items:
+        if "bench" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+async def run_migrations():
+    steps = sorted(
+        (name, fn)
+        for name, fn in inspect.getmembers(migrations, inspect.iscoroutinefunction)
+        if re.match(r"m\d{3}_", name)
+    )
+    async with db.connect() as conn:
+        for _, migration in steps:
+            await migration(conn)
+
+
+@pytest_asyncio.fixture(scope="session")
+async def database():
+    if os.path.exists(db.path):
+        os.remove(db.path)
+    await run_migrations()
+    yield db
+    await db.engine.dispose()
+    os.remove(db.path)
+
+
+def _wallet_from_key(request: Request) -> WalletTypeInfo:
+    # the api key is used as wallet id, so every key is a separate livestream
+    key = request.headers.get("X-Api-Key", "")
+    wallet = Wallet(id=key, user="user", name="test", adminkey=key, inkey=key)
+    return WalletTypeInfo(KeyType.admin, wallet)
+
+
+@pytest_asyncio.fixture
+async def client(database):
+    # every test client has the same address
+    views_lnurl.client_limiter.clear()
+    views_lnurl.livestream_limiter.clear()
+    app = FastAPI()
+    app.include_router(livestream_ext)
+    app.dependency_overrides[require_admin_key] = _wallet_from_key
+    app.dependency_overrides[require_invoice_key] = _wallet_from_key
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="https://example.com") as c:
+        yield c
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements: list[str] = []
+
+    def __call__(self, _conn, _cursor, statement, *_):
+        if not statement.lstrip().upper().startswith("ATTACH"):
+            self.statements.append(statement)
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+@pytest.fixture
+def count_queries(database):
+    counter = QueryCounter()
+    event.listen(database.engine.sync_engine, "before_cursor_execute", counter)
+    yield counter
+    event.remove(database.engine.sync_engine, "before_cursor_execute", counter)
+
+
+@pytest.fixture
+def fake_invoices(monkeypatch):
+    from .. import tasks
+
+    created: list[Payment] = []
+    paid: list[dict] = []
+
+    async def create_invoice(**kwargs) -> Payment:
+        payment = await fake_create_invoice(**kwargs)
+        created.append(payment)
+        return payment
+
+    async def pay_invoice(**kwargs) -> Payment:
+        paid.append(kwargs)
+        payment = next(p for p in created if p.bolt11 == kwargs["payment_request"])
+        return payment.copy(update={"status": "success"})
+
+    async def get_wallet_payment(wallet_id: str, payment_hash: str):
+        payment = next(
+            (
+                p
+                for p in created
+                if p.wallet_id == wallet_id and p.payment_hash == payment_hash
+            ),
+            None,
+        )
+        if payment and any(p["payment_request"] == payment.bolt11 for p in paid):
+            return payment.copy(update={"status": "success"})
+        return payment
+
+    monkeypatch.setattr(views_lnurl, "create_invoice", create_invoice)
+    monkeypatch.setattr(tasks, "create_invoice", create_invoice)
+    monkeypatch.setattr(tasks, "pay_invoice", pay_invoice)
+    monkeypatch.setattr(tasks, "get_wallet_payment", get_wallet_payment)
+    return created, paid
+
+
+@pytest.fixture
+def fake_accounts(monkeypatch):
+    """
+    Producer accounts and wallets without the core database.
+    """
+    from .. import crud
+
+    wallets: list[Wallet] = []
+    accounts: set[str] = set()
+
+    async def create_account(account):
+        if account.id in accounts:
+            raise IntegrityError("INSERT INTO accounts", {}, Exception("UNIQUE"))
+        accounts.add(account.id)
+        return account
+
+    async def get_wallets(user_id: str, deleted=None):
+        return [wallet for wallet in wallets if wallet.user == user_id]
+
+    async def create_wallet(*, user_id: str, wallet_name: str):
+        wallet = Wallet(
+            id=urlsafe_short_hash(),
+            user=user_id,
+            name=wallet_name,
+            adminkey=urlsafe_short_hash(),
+            inkey=urlsafe_short_hash(),
+        )
+        wallets.append(wallet)
+        return wallet
+
+    async def delete_wallet(*, user_id: str, wallet_id: str):
+        wallets[:] = [wallet for wallet in wallets if wallet.id != wallet_id]
+
+    monkeypatch.setattr(crud, "create_account", create_account)
+    monkeypatch.setattr(crud, "create_wallet", create_wallet)
+    monkeypatch.setattr(crud, "get_wallets", get_wallets)
+    monkeypatch.setattr(crud, "delete_wallet", delete_wallet)
+    return wallets
+
+
+@pytest.fixture
+def wallet_id() -> str:
+    return urlsafe_short_hash()
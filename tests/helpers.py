@@ -0,0 +1,64 @@
+from lnbits.core.models import Payment
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.wallets.fake import FakeWallet
+
+from ..crud import create_livestream, create_track, db, update_current_track
+from ..models import CreateTrack, Livestream, Producer, Track
+
+
+async def fake_create_invoice(*, wallet_id: str, amount: float, **kwargs) -> Payment:
+    invoice = await FakeWallet().create_invoice(
+        int(amount),
+        kwargs.get("memo"),
+        description_hash=kwargs.get("description_hash"),
+        unhashed_description=kwargs.get("unhashed_description"),
+    )
+    assert invoice.payment_request and invoice.checking_id
+    return Payment(
+        checking_id=invoice.checking_id,
+        payment_hash=invoice.checking_id,
+        wallet_id=wallet_id,
+        amount=int(amount * 1000),
+        fee=0,
+        bolt11=invoice.payment_request,
+        memo=kwargs.get("memo"),
+        extra=kwargs.get("extra") or {},
+    )
+
+
+async def fake_tip(wallet_id: str, track_id: str, amount_msat: int) -> Payment:
+    return await fake_create_invoice(
+        wallet_id=wallet_id,
+        amount=amount_msat / 1000,
+        memo="tip",
+        extra={"tag": "livestream", "track": track_id, "comment": ""},
+    )
+
+
+async def create_playing_track(
+    wallet_id: str, price_msat: int = 1_000_000
+) -> tuple[Livestream, Producer, Track]:
+    """
+    Livestream with one producer and one track that is currently playing. The
+    producer is inserted directly so the tests don't need the core database.
+    """
+    ls = await create_livestream(wallet_id)
+    producer = Producer(
+        id=urlsafe_short_hash(),
+        livestream=ls.id,
+        user=urlsafe_short_hash(),
+        wallet=urlsafe_short_hash(),
+        name="Satoshi",
+    )
+    await db.insert("livestream.producers", producer)
+    track = await create_track(
+        ls.id,
+        producer,
+        CreateTrack(
+            name="Genesis",
+            download_url="https://example.com/genesis.flac",
+            price_msat=price_msat,
+        ),
+    )
+    await update_current_track(ls.id, track.id)
+    return ls, producer, track
@@ -0,0 +1,430 @@
+import asyncio
+import csv
+import io
+import json
+from hashlib import sha256
+from time import time
+
+import pytest
+from lnbits.bolt11 import decode as bolt11_decode
+from lnbits.helpers import urlsafe_short_hash
+
+from .. import views_lnurl
+from ..admission import RateLimiter
+from ..crud import (
+    create_producer,
+    create_track,
+    delete_track_from_livestream,
+    get_track,
+    resolve_livestream_id,
+    update_track,
+)
+from ..migrations import _backfill_track_metadata
+from ..models import CreateTrack
+from ..tasks import on_invoice_paid
+from .helpers import create_playing_track, fake_create_invoice, fake_tip
+
+
+@pytest.mark.asyncio
+async def test_overview_etag(client, wallet_id):
+    await create_playing_track(wallet_id)
+    headers = {"X-Api-Key": wallet_id}
+
+    res = await client.get("/livestream/api/v1/livestream", headers=headers)
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+
+    res = await client.get(
+        "/livestream/api/v1/livestream", headers={**headers, "If-None-Match": etag}
+    )
+    assert res.status_code == 304
+
+    await client.put("/livestream/api/v1/livestream/fee/20", headers=headers)
+    res = await client.get(
+        "/livestream/api/v1/livestream/summary",
+        headers={**headers, "If-None-Match": etag},
+    )
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+    assert res.json()["livestream"]["fee_pct"] == 20
+
+
+@pytest.mark.asyncio
+async def test_tracks_keyset_pagination(client, wallet_id):
+    ls, producer, _ = await create_playing_track(wallet_id)
+    for n in range(4):
+        await create_track(ls.id, producer, CreateTrack(name=f"Track {n}"))
+
+    seen: list[str] = []
+    params: dict = {"limit": 2}
+    while True:
+        res = await client.get(
+            "/livestream/api/v1/livestream/tracks",
+            headers={"X-Api-Key": wallet_id},
+            params=params,
+        )
+        page = res.json()
+        assert len(page["data"]) <= 2
+        seen += [track["id"] for track in page["data"]]
+        if not page["next"]:
+            break
+        params["after"] = page["next"]
+    assert len(seen) == 5
+    assert seen == sorted(seen)
+
+
+@pytest.mark.asyncio
+async def test_bulk_import_csv(client, fake_accounts, wallet_id):
+    await create_playing_track(wallet_id)  # producer "Satoshi"
+    csv = (
+        "name,producer,price_msat,download_url\n"
+        "Block 1,satoshi,1000,\n"
+        "Block 2,Hal,,https://example.com/2.flac\n"
+        ",Hal,,\n"
+        "Block 3,HAL,-5,\n"
+        "Block 4,hal,0,\n"
+    )
+    res = await client.post(
+        "/livestream/api/v1/livestream/tracks/import",
+        headers={"X-Api-Key": wallet_id, "Content-Type": "text/csv"},
+        content=csv,
+    )
+    assert res.status_code == 200
+    report = res.json()
+    assert [track["name"] for track in report["tracks"]] == [
+        "Block 1",
+        "Block 2",
+        "Block 4",
+    ]
+    assert report["producers_created"] == 1
+    # wallets are only created on the first payout
+    assert len(fake_accounts) == 0
+    assert [error["row"] for error in report["errors"]] == [3, 4]
+
+    res = await client.get(
+        "/livestream/api/v1/livestream", headers={"X-Api-Key": wallet_id}
+    )
+    assert len(res.json()["tracks"]) == 4
+    assert len(res.json()["producers"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_tip_leaderboard_and_stats(
+    client, count_queries, fake_invoices, wallet_id
+):
+    ls, producer, track = await create_playing_track(wallet_id)
+    other = await create_track(ls.id, producer, CreateTrack(name="Block 2"))
+    for track_id, amount in ((track.id, 1_000_000), (other.id, 3_000_000)):
+        tip = await fake_tip(ls.wallet, track_id, amount)
+        await on_invoice_paid(tip)
+    await on_invoice_paid(tip)  # replays are counted once
+
+    headers = {"X-Api-Key": wallet_id}
+    count_queries.statements.clear()
+    res = await client.get("/livestream/api/v1/livestream/leaderboard", headers=headers)
+    assert [(row["name"], row["count"], row["total_msat"]) for row in res.json()] == [
+        ("Block 2", 1, 3_000_000),
+        ("Genesis", 1, 1_000_000),
+    ]
+    # the livestream lookup and one read of the counters
+    assert count_queries.count == 2
+
+    res = await client.get(
+        "/livestream/api/v1/livestream/leaderboard",
+        headers=headers,
+        params={"scope": "producer", "since": int(time()) - 60},
+    )
+    assert [(row["id"], row["total_msat"]) for row in res.json()] == [
+        (producer.id, 4_000_000)
+    ]
+
+    res = await client.get("/livestream/api/v1/livestream/stats", headers=headers)
+    stats = res.json()
+    assert stats["total"]["count"] == 2
+    assert stats["total"]["total_msat"] == 4_000_000
+    assert sum(bucket["total_msat"] for bucket in stats["hourly"]) == 4_000_000
+
+
+@pytest.mark.asyncio
+async def test_metrics(client, fake_invoices, wallet_id):
+    _, _, track = await create_playing_track(wallet_id)
+    await client.get(f"/livestream/lnurl/cb/{track.id}", params={"amount": 2_000_000})
+
+    res = await client.get(
+        "/livestream/api/v1/livestream/metrics", headers={"X-Api-Key": wallet_id}
+    )
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain")
+    lines = res.text.splitlines()
+    for stage in ("db", "metadata", "create_invoice", "serialize"):
+        labels = f'handler="lnurl_callback",stage="{stage}"'
+        assert any(
+            line.startswith(f"livestream_stage_seconds_count{{{labels}}}")
+            for line in lines
+        )
+    assert any(
+        line.startswith('livestream_crud_seconds_bucket{function="get_track_context"')
+        and 'le="+Inf"' in line
+        for line in lines
+    )
+    assert "# TYPE livestream_split_queue_depth gauge" in lines
+
+
+@pytest.mark.asyncio
+async def test_stored_metadata_follows_track_updates(client, fake_invoices, wallet_id):
+    _, producer, track = await create_playing_track(wallet_id)
+    track.name = "Exodus"
+    await update_track(track, producer)
+
+    metadata = (await client.get(f"/livestream/lnurl/t/{track.id}")).json()["metadata"]
+    assert "'Exodus', from Satoshi." in metadata
+    res = await client.get(
+        f"/livestream/lnurl/cb/{track.id}", params={"amount": 2_000_000}
+    )
+    invoice = bolt11_decode(res.json()["pr"])
+    assert invoice.description_hash == sha256(metadata.encode()).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_metadata_hash_matches_stripped_names(client, fake_invoices, wallet_id):
+    ls, producer, _ = await create_playing_track(wallet_id)
+    track = await create_track(
+        ls.id, producer, CreateTrack(name="Intro <live> &amp; more")
+    )
+
+    metadata = (await client.get(f"/livestream/lnurl/t/{track.id}")).json()["metadata"]
+    assert "'Intro   more', from Satoshi." in metadata
+    assert track.metadata == metadata
+    res = await client.get(
+        f"/livestream/lnurl/cb/{track.id}", params={"amount": 2_000_000}
+    )
+    invoice = bolt11_decode(res.json()["pr"])
+    assert invoice.description_hash == sha256(metadata.encode()).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_track_metadata_backfill(database, wallet_id):
+    _, _, track = await create_playing_track(wallet_id)
+    await database.execute(
+        """
+        UPDATE livestream.tracks SET metadata = NULL, description_hash = NULL
+        WHERE id = :id
+        """,
+        {"id": track.id},
+    )
+    async with database.connect() as conn:
+        await _backfill_track_metadata(conn)
+
+    backfilled = await get_track(track.id)
+    assert backfilled
+    assert backfilled.metadata == track.metadata
+    assert backfilled.description_hash == track.description_hash
+
+
+@pytest.mark.asyncio
+async def test_callback_retries_are_coalesced(client, fake_invoices, wallet_id):
+    created, _ = fake_invoices
+    _, _, track = await create_playing_track(wallet_id)
+    url = f"/livestream/lnurl/cb/{track.id}"
+    params = {"amount": 2_000_000, "comment": "encore", "nonce": "n1"}
+
+    first, retry = [(await client.get(url, params=params)).json() for _ in range(2)]
+    assert first["pr"] == retry["pr"]
+    assert len(created) == 1
+
+    other = (await client.get(url, params={**params, "nonce": "n2"})).json()
+    assert other["pr"] != first["pr"]
+    assert len(created) == 2
+
+
+@pytest.mark.asyncio
+async def test_payers_sharing_an_address_get_their_own_invoices(
+    client, fake_invoices, wallet_id
+):
+    created, _ = fake_invoices
+    _, _, track = await create_playing_track(wallet_id)
+    url = f"/livestream/lnurl/cb/{track.id}"
+
+    # two listeners on the venue's network, tipping the same amount
+    first, second = [
+        (await client.get(url, params={"amount": 2_000_000})).json() for _ in range(2)
+    ]
+    assert first["pr"] != second["pr"]
+    assert len(created) == 2
+
+
+@pytest.mark.asyncio
+async def test_callback_admission_control(
+    client, fake_invoices, monkeypatch, wallet_id
+):
+    monkeypatch.setattr(views_lnurl, "client_limiter", RateLimiter(rate=0.01, burst=2))
+    _, _, track = await create_playing_track(wallet_id)
+
+    responses = [
+        (
+            await client.get(
+                f"/livestream/lnurl/cb/{track.id}",
+                params={"amount": 2_000_000, "comment": f"tip {n}"},
+            )
+        ).json()
+        for n in range(3)
+    ]
+    assert [res.get("status") for res in responses] == [None, None, "ERROR"]
+    assert "try again" in responses[2]["reason"]
+
+
+@pytest.mark.asyncio
+async def test_callback_limit_keys_on_the_forwarded_client(
+    client, fake_invoices, monkeypatch, wallet_id
+):
+    from lnbits.settings import settings
+
+    monkeypatch.setattr(views_lnurl, "client_limiter", RateLimiter(rate=0.01, burst=1))
+    _, _, track = await create_playing_track(wallet_id)
+
+    async def tip(forwarded_for: str) -> dict:
+        res = await client.get(
+            f"/livestream/lnurl/cb/{track.id}",
+            params={"amount": 2_000_000},
+            headers={"X-Forwarded-For": forwarded_for},
+        )
+        return res.json()
+
+    # the test client connects from 127.0.0.1, as a local reverse proxy would
+    monkeypatch.setattr(settings, "forwarded_allow_ips", "127.0.0.1")
+    assert "pr" in await tip("203.0.113.1")
+    assert "pr" in await tip("203.0.113.2, 127.0.0.1")
+    assert (await tip("203.0.113.1"))["status"] == "ERROR"
+
+    # headers of untrusted peers are ignored
+    monkeypatch.setattr(settings, "forwarded_allow_ips", "192.0.2.1")
+    views_lnurl.client_limiter.clear()
+    assert "pr" in await tip("203.0.113.3")
+    assert (await tip("203.0.113.4"))["status"] == "ERROR"
+
+
+@pytest.mark.asyncio
+async def test_tip_report_export(
+    client, fake_accounts, fake_invoices, monkeypatch, wallet_id
+):
+    from .. import views_api
+
+    monkeypatch.setattr(views_api, "REPORT_PAGE_SIZE", 2)
+    ls, producer, track = await create_playing_track(wallet_id)
+    other = await create_track(
+        ls.id,
+        await create_producer(ls.id, "Hal"),
+        CreateTrack(name="Block 2"),
+    )
+    for track_id in (track.id, other.id, track.id):
+        await on_invoice_paid(await fake_tip(ls.wallet, track_id, 1_000_000))
+
+    headers = {"X-Api-Key": wallet_id}
+    res = await client.get("/livestream/api/v1/livestream/report", headers=headers)
+    assert res.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(res.text)))
+    assert [row["track_name"] for row in rows].count("Genesis") == 2
+    assert len(rows) == 3
+    assert rows[0]["gross_msat"] == "1000000"
+    assert int(rows[0]["fee_msat"]) + int(rows[0]["producer_share_msat"]) == 1_000_000
+
+    res = await client.get(
+        "/livestream/api/v1/livestream/report",
+        headers=headers,
+        params={"format": "ndjson", "producer_id": producer.id},
+    )
+    records = [json.loads(line) for line in res.text.splitlines()]
+    assert len(records) == 2
+    assert {record["producer_name"] for record in records} == {"Satoshi"}
+
+
+@pytest.mark.asyncio
+async def test_tip_report_is_safe_to_open(
+    client, fake_accounts, fake_invoices, wallet_id
+):
+    ls, _, track = await create_playing_track(wallet_id)
+    comment = '=HYPERLINK("https://evil.example", "claim")'
+    tip = await fake_create_invoice(
+        wallet_id=ls.wallet,
+        amount=1000,
+        extra={"tag": "livestream", "track": track.id, "comment": comment},
+    )
+    await on_invoice_paid(tip)
+
+    headers = {"X-Api-Key": wallet_id}
+    res = await client.get("/livestream/api/v1/livestream/report", headers=headers)
+    rows = list(csv.DictReader(io.StringIO(res.text)))
+    assert rows[0]["comment"] == "'" + comment
+    res = await client.get(
+        "/livestream/api/v1/livestream/report",
+        headers=headers,
+        params={"format": "ndjson"},
+    )
+    assert json.loads(res.text)["comment"] == comment
+
+    for producer_id in ('x"; filename="evil', "x\r\nSet-Cookie: a=b"):
+        res = await client.get(
+            "/livestream/api/v1/livestream/report",
+            headers=headers,
+            params={"producer_id": producer_id},
+        )
+        assert res.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_track_search(client, wallet_id):
+    ls, satoshi, genesis = await create_playing_track(wallet_id)
+    hal = await create_producer(ls.id, "Hal Finney")
+    running = await create_track(ls.id, hal, CreateTrack(name="Running bitcoin"))
+    blocks = await create_track(ls.id, satoshi, CreateTrack(name="Block Reward Blues"))
+    deleted = await create_track(ls.id, hal, CreateTrack(name="Genesis Remix"))
+    await delete_track_from_livestream(ls.id, deleted.id)
+    genesis.name = "Genesis Block"
+    await update_track(genesis, satoshi)
+    # other livestreams are not searched
+    await create_playing_track(urlsafe_short_hash())
+
+    async def search(q: str, **params) -> dict:
+        res = await client.get(
+            "/livestream/api/v1/livestream/tracks/search",
+            headers={"X-Api-Key": wallet_id},
+            params={"q": q, **params},
+        )
+        assert res.status_code == 200
+        return res.json()
+
+    def ids(page: dict) -> list[str]:
+        return [track["id"] for track in page["data"]]
+
+    assert ids(await search("gen")) == [genesis.id]
+    assert ids(await search("RUN BIT")) == [running.id]
+    assert set(ids(await search("sato"))) == {genesis.id, blocks.id}
+    # a match in the name ranks above a match of the producer
+    ode = await create_track(ls.id, satoshi, CreateTrack(name="Ode to Hal"))
+    assert ids(await search("hal")) == [ode.id, running.id]
+
+    first = await search("b", limit=1)
+    assert first["next_offset"] == 1
+    second = await search("b", limit=1, offset=1)
+    assert ids(first) != ids(second)
+    assert ids(await search("?!")) == []
+
+
+@pytest.mark.asyncio
+async def test_livestream_resolved_once_per_wallet(client, count_queries, database):
+    wallet = urlsafe_short_hash()
+    ids = await asyncio.gather(*(resolve_livestream_id(wallet) for _ in range(5)))
+    assert len(set(ids)) == 1
+    rows = await database.fetchall(
+        "SELECT id FROM livestream.livestreams WHERE wallet = :wallet",
+        {"wallet": wallet},
+    )
+    assert [row["id"] for row in rows] == ids[:1]
+
+    count_queries.statements.clear()
+    res = await client.get(
+        "/livestream/api/v1/livestream/setlist", headers={"X-Api-Key": wallet}
+    )
+    assert res.status_code == 200
+    # only the set list, the livestream id comes from the cache
+    assert count_queries.count == 1
@@ -0,0 +1,75 @@
+import pytest
+
+from ..cache import LRUCache, pay_response_cache
+from ..crud import (
+    create_track,
+    delete_track_from_livestream,
+    update_current_track,
+    update_track,
+)
+from ..models import CreateTrack
+from .helpers import create_playing_track
+
+
+def test_lru_eviction_and_counters():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 2, "misses": 1}
+
+
+def test_stale_set_is_dropped_after_invalidation():
+    cache: LRUCache[tuple[str, str], int] = LRUCache()
+    epoch = cache.epoch
+    cache.evict(lambda key: key[0] == "ls")
+    cache.set(("ls", "http://host/"), 1, epoch)
+    assert cache.get(("ls", "http://host/")) is None
+
+
+async def _lnurl_livestream(client, ls_id: str) -> dict:
+    res = await client.get(f"/livestream/lnurl/{ls_id}")
+    return {"status": res.status_code, **res.json()}
+
+
+@pytest.mark.asyncio
+async def test_now_playing_lnurl_is_cached(client, count_queries, wallet_id):
+    ls, _, _ = await create_playing_track(wallet_id)
+    await _lnurl_livestream(client, ls.id)
+
+    count_queries.statements.clear()
+    res = await _lnurl_livestream(client, ls.id)
+    assert "Genesis" in res["metadata"]
+    # only the revision check, the response comes from the cache
+    assert count_queries.count == 1
+    assert "SELECT revision" in count_queries.statements[0]
+
+
+@pytest.mark.asyncio
+async def test_now_playing_lnurl_follows_changes(client, wallet_id):
+    ls, producer, track = await create_playing_track(wallet_id)
+    key = (ls.id, "https://example.com/")
+
+    async def metadata() -> str:
+        res = await _lnurl_livestream(client, ls.id)
+        assert pay_response_cache.get(key)
+        return res["metadata"]
+
+    assert "Genesis" in await metadata()
+    track.name = "Exodus"
+    await update_track(track, producer)
+    assert pay_response_cache.get(key) is None
+    assert "Exodus" in await metadata()
+
+    other = await create_track(ls.id, producer, CreateTrack(name="Block 2"))
+    await update_current_track(ls.id, other.id)
+    assert pay_response_cache.get(key) is None
+    assert "Block 2" in await metadata()
+
+    await delete_track_from_livestream(ls.id, other.id)
+    assert pay_response_cache.get(key) is None
+    res = await _lnurl_livestream(client, ls.id)
+    assert res["status"] == 404
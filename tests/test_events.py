@@ -0,0 +1,53 @@
+import pytest
+
+from .. import tasks
+from ..crud import create_track, db, update_current_track
+from ..events import LivestreamEventHub, event_hub
+from ..models import CreateTrack
+from .helpers import create_playing_track
+
+
+@pytest.mark.asyncio
+async def test_fan_out_and_slow_consumer_eviction():
+    hub = LivestreamEventHub(queue_size=2)
+    fast = hub.stream("ls", first="hello")
+    assert await fast.__anext__() == "hello"
+    slow = hub.subscribe("ls")
+
+    hub.publish("ls", "tip", {"amount_msat": 1000})
+    assert await fast.__anext__() == 'event: tip\ndata: {"amount_msat": 1000}\n\n'
+
+    hub.publish("ls", "tip", {"amount_msat": 2000})
+    hub.publish("ls", "tip", {"amount_msat": 3000})  # slow queue is full now
+    assert hub.stats() == {"livestreams": 1, "subscribers": 1, "evicted": 1}
+    assert slow.get_nowait() is None
+
+    await fast.aclose()
+    assert hub.stats()["subscribers"] == 0
+
+
+@pytest.mark.asyncio
+async def test_track_changes_of_other_processes_are_polled(database, wallet_id):
+    ls, producer, track = await create_playing_track(wallet_id)
+    other = await create_track(ls.id, producer, CreateTrack(name="Exodus"))
+    stream = event_hub.stream(ls.id, "first", track.id)
+    assert await stream.__anext__() == "first"
+    try:
+        assert await tasks.announce_track_changes() == 0
+
+        # as another process would, without this process' hub
+        await db.execute(
+            "UPDATE livestream.livestreams SET current_track = :track WHERE id = :id",
+            {"track": other.id, "id": ls.id},
+        )
+        assert await tasks.announce_track_changes() == 1
+        assert '"name": "Exodus"' in await stream.__anext__()
+        assert await tasks.announce_track_changes() == 0
+
+        # changes made in this process are announced once, right away
+        await update_current_track(ls.id, None)
+        assert '"track": null' in await stream.__anext__()
+        assert await tasks.announce_track_changes() == 0
+    finally:
+        await stream.aclose()
+    assert ls.id not in event_hub.announced
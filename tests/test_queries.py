@@ -0,0 +1,226 @@
+import pytest
+from lnbits.helpers import urlsafe_short_hash
+
+from ..crud import create_track, db
+from ..models import CreateTrack
+from ..tasks import on_invoice_paid
+from ..tokens import _b64encode, _sign
+from .helpers import create_playing_track, fake_tip
+
+
+@pytest.mark.asyncio
+async def test_lnurl_track_is_one_query(client, count_queries, wallet_id):
+    _, _, track = await create_playing_track(wallet_id)
+
+    count_queries.statements.clear()
+    res = await client.get(f"/livestream/lnurl/t/{track.id}")
+    assert res.status_code == 200
+    assert "Satoshi" in res.json()["metadata"]
+    assert count_queries.count == 1
+
+
+@pytest.mark.asyncio
+async def test_lnurl_callback_is_one_query(
+    client, count_queries, fake_invoices, wallet_id
+):
+    _, _, track = await create_playing_track(wallet_id)
+
+    count_queries.statements.clear()
+    res = await client.get(
+        f"/livestream/lnurl/cb/{track.id}", params={"amount": 2_000_000}
+    )
+    assert res.status_code == 200
+    body = res.json()
+    assert body["pr"].startswith("lnbc")
+    assert body["successAction"]["tag"] == "url"
+    assert count_queries.count == 1
+
+
+@pytest.mark.asyncio
+async def test_track_download_is_one_query(
+    client, count_queries, monkeypatch, wallet_id
+):
+    from .. import views
+
+    ls, _, track = await create_playing_track(wallet_id)
+    tip = await fake_tip(ls.wallet, track.id, 2_000_000)
+
+    async def get_wallet_payment(wallet_id, payment_hash):
+        assert (wallet_id, payment_hash) == (ls.wallet, tip.payment_hash)
+        return tip.copy(update={"status": "success"})
+
+    monkeypatch.setattr(views, "get_wallet_payment", get_wallet_payment)
+
+    count_queries.statements.clear()
+    res = await client.get(
+        f"/livestream/track/{track.id}", params={"p": tip.payment_hash}
+    )
+    assert res.status_code == 307
+    assert res.headers["location"] == track.download_url
+    assert count_queries.count == 1
+
+
+@pytest.mark.asyncio
+async def test_signed_download_confirms_payment_once(
+    client, count_queries, fake_invoices, monkeypatch, wallet_id
+):
+    from .. import views
+
+    ls, _, track = await create_playing_track(wallet_id)
+    res = await client.get(
+        f"/livestream/lnurl/cb/{track.id}", params={"amount": 2_000_000}
+    )
+    url = res.json()["successAction"]["url"]
+    created, _ = fake_invoices
+    lookups = []
+
+    async def get_wallet_payment(wallet_id, payment_hash):
+        lookups.append((wallet_id, payment_hash))
+        return created[-1].copy(update={"status": "success"})
+
+    monkeypatch.setattr(views, "get_wallet_payment", get_wallet_payment)
+
+    count_queries.statements.clear()
+    for _ in range(3):
+        res = await client.get(url)
+        assert res.status_code == 307
+        assert res.headers["location"] == track.download_url
+    assert count_queries.count == 0
+    assert lookups == [(ls.wallet, created[-1].payment_hash)]
+
+    res = await client.get(url.replace(track.id, "other", 1))
+    assert res.status_code == 403
+    res = await client.get(url[:-1] + ("B" if url.endswith("A") else "A"))
+    assert res.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_download_checks_the_paid_wallet(client, monkeypatch, wallet_id):
+    from .. import views
+
+    ls, _, track = await create_playing_track(wallet_id)
+    _, _, other = await create_playing_track(urlsafe_short_hash())
+    tip = await fake_tip(ls.wallet, track.id, 2_000_000)
+
+    async def get_wallet_payment(wallet_id, payment_hash):
+        if wallet_id == ls.wallet:
+            return tip.copy(update={"status": "success"})
+        return None
+
+    monkeypatch.setattr(views, "get_wallet_payment", get_wallet_payment)
+
+    params = {"p": tip.payment_hash}
+    res = await client.get(f"/livestream/track/{track.id}", params=params)
+    assert res.status_code == 307
+    # the confirmed hash doesn't unlock the tracks of another livestream
+    res = await client.get(f"/livestream/track/{other.id}", params=params)
+    assert res.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_failed_payments_unlock_no_download(client, monkeypatch, wallet_id):
+    from .. import views
+
+    ls, _, track = await create_playing_track(wallet_id)
+    tip = await fake_tip(ls.wallet, track.id, 2_000_000)
+    status = "failed"
+
+    async def get_wallet_payment(wallet_id, payment_hash):
+        return tip.copy(update={"status": status})
+
+    monkeypatch.setattr(views, "get_wallet_payment", get_wallet_payment)
+
+    params = {"p": tip.payment_hash}
+    res = await client.get(f"/livestream/track/{track.id}", params=params)
+    assert res.status_code == 402
+    # and the failure isn't remembered as a confirmation
+    status = "success"
+    res = await client.get(f"/livestream/track/{track.id}", params=params)
+    assert res.status_code == 307
+
+
+@pytest.mark.asyncio
+async def test_malformed_download_tokens(client, wallet_id):
+    _, _, track = await create_playing_track(wallet_id)
+    payload = _b64encode(b"[1, 2]")
+    for token in ("a.\u00e9", "\u00e9.a", f"{payload}.{_sign(payload)}"):
+        res = await client.get(f"/livestream/track/{track.id}", params={"t": token})
+        assert res.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_on_invoice_paid_queries(count_queries, fake_invoices, wallet_id):
+    ls, producer, track = await create_playing_track(wallet_id)
+    created, paid = fake_invoices
+
+    count_queries.statements.clear()
+    await on_invoice_paid(await fake_tip(ls.wallet, track.id, 1_000_000))
+    # the track context, the tip with its counters and payout in one
+    # transaction, storing the producer invoice and marking the payout paid
+    assert count_queries.count == 6
+    assert created[-1].wallet_id == producer.wallet
+    assert paid[-1]["wallet_id"] == ls.wallet
+
+
+@pytest.mark.asyncio
+async def test_qr_images_are_rendered_once(client, count_queries, wallet_id):
+    ls, _, track = await create_playing_track(wallet_id)
+
+    count_queries.statements.clear()
+    res = await client.get(f"/livestream/qr/{ls.id}")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "image/svg+xml"
+    assert "immutable" in res.headers["cache-control"]
+    assert count_queries.count == 1
+
+    etag = res.headers["ETag"]
+    res = await client.get(f"/livestream/qr/{ls.id}", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+
+    res = await client.get(f"/livestream/qr/t/{track.id}", params={"format": "png"})
+    assert res.status_code == 200
+    assert res.content.startswith(b"\x89PNG")
+    res = await client.get(f"/livestream/qr/t/{track.id}", params={"format": "png"})
+    assert res.status_code == 200
+    assert count_queries.count == 2
+
+    res = await client.get("/livestream/qr/t/unknown")
+    assert res.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_caches_see_changes_of_other_workers(client, count_queries, wallet_id):
+    ls, producer, track = await create_playing_track(wallet_id)
+    other = await create_track(ls.id, producer, CreateTrack(name="Block 2"))
+    await client.get(f"/livestream/lnurl/{ls.id}")
+    await client.get(f"/livestream/lnurl/t/{track.id}")
+
+    count_queries.statements.clear()
+    res = await client.get(f"/livestream/lnurl/{ls.id}")
+    assert res.json()["callback"].endswith(track.id)
+    res = await client.get(f"/livestream/lnurl/t/{track.id}")
+    assert res.json()["minSendable"] == 100_000
+    # warm caches only read the revision
+    assert count_queries.count == 2
+
+    # changes made by another process don't evict the caches of this one
+    await db.execute(
+        """
+        UPDATE livestream.livestreams
+        SET current_track = :track, revision = revision + 1 WHERE id = :id
+        """,
+        {"track": other.id, "id": ls.id},
+    )
+    res = await client.get(f"/livestream/lnurl/{ls.id}")
+    assert res.json()["callback"].endswith(other.id)
+
+    await db.execute(
+        "UPDATE livestream.tracks SET price_msat = 50000 WHERE id = :id",
+        {"id": track.id},
+    )
+    await db.execute(
+        "UPDATE livestream.livestreams SET revision = revision + 1 WHERE id = :id",
+        {"id": ls.id},
+    )
+    res = await client.get(f"/livestream/lnurl/t/{track.id}")
+    assert res.json()["minSendable"] == 50_000
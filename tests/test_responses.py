@@ -0,0 +1,129 @@
+import json
+from typing import Optional, Union
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from lnurl import LnurlErrorResponse, LnurlPayActionResponse, LnurlPayResponse
+from lnurl.models import UrlAction
+from lnurl.types import (
+    ClearnetUrl,
+    DebugUrl,
+    LightningInvoice,
+    LnurlPayMetadata,
+    Max144Str,
+    MilliSatoshi,
+    OnionUrl,
+)
+from pydantic import ValidationError, parse_obj_as
+
+from ..crud import get_track_context
+from ..responses import (
+    check_url,
+    encode_json,
+    error_response,
+    pay_action_response,
+    pay_response,
+)
+from .helpers import create_playing_track, fake_create_invoice
+
+URLS = [
+    "https://example.com/livestream/lnurl/cb/abc",
+    "http://127.0.0.1:5000/livestream/lnurl/cb/abc",
+    "http://lnbitsyvdeoaxnurazrgzpq2ykkmftwrv2ylrgt6p6dsknxepqt3id.onion/cb/x",
+]
+METADATA = [
+    json.dumps([["text/plain", "'Genesis', from Satoshi."]]),
+    json.dumps([["text/plain", "'Ünïcödé \"quoted\" ☕', from \\ back\\slash."]]),
+]
+
+
+def _model_bytes(content: dict) -> bytes:
+    # what FastAPI sent when the handlers returned the models' dicts
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def _url(url: str):
+    return parse_obj_as(Union[DebugUrl, OnionUrl, ClearnetUrl], url)  # type: ignore
+
+
+@pytest.mark.parametrize("url", URLS)
+@pytest.mark.parametrize("metadata", METADATA)
+@pytest.mark.parametrize("sendable", [(1, 5_000_000), (100_000, 50_000_000)])
+def test_pay_response_matches_models(url, metadata, sendable):
+    model = LnurlPayResponse(
+        callback=_url(url),
+        minSendable=MilliSatoshi(sendable[0]),
+        maxSendable=MilliSatoshi(sendable[1]),
+        metadata=LnurlPayMetadata(metadata),
+    ).dict()
+    model["commentAllowed"] = 300
+
+    fast = pay_response(url, *sendable, metadata)
+    assert encode_json(fast).encode() == _model_bytes(model)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("success_url", [None, URLS[0] + "?t=eyJ0.c2ln", URLS[1]])
+async def test_pay_action_response_matches_models(success_url: Optional[str]):
+    payment = await fake_create_invoice(wallet_id="wallet", amount=21)
+    success_action = None
+    if success_url:
+        success_action = UrlAction(
+            url=_url(success_url), description=Max144Str("Download the track.")
+        )
+    model = LnurlPayActionResponse(
+        pr=parse_obj_as(LightningInvoice, LightningInvoice(payment.bolt11)),
+        successAction=success_action,
+        routes=[],
+    ).dict()
+
+    fast = pay_action_response(payment.bolt11, success_url, "Download the track.")
+    assert encode_json(fast).encode() == _model_bytes(model)
+
+
+@pytest.mark.parametrize(
+    "reason", ["Track not found.", "\n    Amount 1 is smaller than\n    minimum 2.\n"]
+)
+def test_error_response_matches_models(reason: str):
+    model = LnurlErrorResponse(reason=reason).dict()
+    assert encode_json(error_response(reason)).encode() == _model_bytes(model)
+
+
+def test_check_url_follows_the_models():
+    assert check_url(URLS[0], "https://example.com/") == URLS[0]
+    # rewritten by the model, so never marked as checked
+    idn = "https://bücher.example/livestream/lnurl/cb/abc"
+    assert check_url(idn, "https://bücher.example/") == str(_url(idn))
+    with pytest.raises(ValidationError):
+        check_url("http://example.com/lnurl/cb/abc", "http://example.com/")
+
+
+@pytest.mark.asyncio
+async def test_lnurl_endpoints_match_models(client, fake_invoices, wallet_id):
+    ls, _, track = await create_playing_track(wallet_id)
+    ctx = await get_track_context(track.id)
+    assert ctx
+    callback = f"https://example.com/livestream/lnurl/cb/{track.id}"
+    model = LnurlPayResponse(
+        callback=_url(callback),
+        minSendable=MilliSatoshi(track.min_sendable),
+        maxSendable=MilliSatoshi(track.max_sendable),
+        metadata=ctx.track.lnurlpay_metadata_for(ctx.producer),
+    ).dict()
+    model["commentAllowed"] = 300
+
+    for url in (f"/livestream/lnurl/{ls.id}", f"/livestream/lnurl/t/{track.id}"):
+        res = await client.get(url)
+        assert res.headers["content-type"] == "application/json"
+        assert res.content == _model_bytes(model)
+
+    res = await client.get(callback, params={"amount": 1})
+    assert res.content == _model_bytes(
+        LnurlErrorResponse(
+            reason=f"""
+            Amount 0 is smaller than
+            minimum {track.min_sendable}.
+            """
+        ).dict()
+    )
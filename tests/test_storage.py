@@ -0,0 +1,161 @@
+import os
+
+import pytest
+
+from .. import storage
+from ..crud import create_track, get_track
+from ..models import CreateTrack
+from ..storage import (
+    FileTooLargeError,
+    TrackFileResponse,
+    download_slots,
+    store_track_file,
+    track_path,
+)
+from .helpers import create_playing_track
+
+DATA = os.urandom(3 * 1024 * 1024 + 17)
+
+
+@pytest.fixture
+def storage_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, "STORAGE_DIR", tmp_path)
+    return tmp_path
+
+
+async def _chunks(data: bytes, size: int = 1000):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+@pytest.mark.asyncio
+async def test_hosted_track_download(
+    client, fake_invoices, monkeypatch, storage_dir, wallet_id
+):
+    from .. import views
+
+    ls, producer, _ = await create_playing_track(wallet_id)
+    track = await create_track(
+        ls.id, producer, CreateTrack(name="Live", price_msat=1_000_000)
+    )
+    headers = {"X-Api-Key": wallet_id}
+    res = await client.put(
+        f"/livestream/api/v1/livestream/tracks/{track.id}/file",
+        headers=headers,
+        params={"filename": "C:\\sets\\live.flac"},
+        content=_chunks(DATA),
+    )
+    assert res.status_code == 200
+    assert (res.json()["file_name"], res.json()["file_size"]) == (
+        "live.flac",
+        len(DATA),
+    )
+    assert track_path(track.id).read_bytes() == DATA
+    assert [path.name for path in storage_dir.iterdir()] == [track.id]
+
+    lnurl = (await client.get(f"/livestream/lnurl/t/{track.id}")).json()
+    assert "you can download it" in lnurl["metadata"]
+    res = await client.get(
+        f"/livestream/lnurl/cb/{track.id}", params={"amount": 2_000_000}
+    )
+    url = res.json()["successAction"]["url"]
+    created, _ = fake_invoices
+
+    async def get_wallet_payment(wallet_id, payment_hash):
+        return created[-1].copy(update={"status": "success"})
+
+    monkeypatch.setattr(views, "get_wallet_payment", get_wallet_payment)
+
+    res = await client.get(url)
+    assert res.status_code == 200
+    assert res.content == DATA
+    assert res.headers["content-disposition"] == 'attachment; filename="live.flac"'
+    assert res.headers["accept-ranges"] == "bytes"
+    etag = res.headers["etag"]
+
+    # resuming an interrupted download
+    res = await client.get(url, headers={"Range": "bytes=1000000-", "If-Range": etag})
+    assert res.status_code == 206
+    assert res.content == DATA[1_000_000:]
+    assert res.headers["content-range"] == f"bytes 1000000-{len(DATA) - 1}/{len(DATA)}"
+    res = await client.get(url, headers={"Range": "bytes=10-", "If-Range": '"old"'})
+    assert res.status_code == 200
+    res = await client.get(url, headers={"Range": f"bytes={len(DATA)}-"})
+    assert res.status_code == 416
+    res = await client.head(url)
+    assert res.status_code == 200
+    assert res.headers["content-length"] == str(len(DATA))
+    assert download_slots.active == 0
+
+    for _ in range(download_slots.per_track):
+        assert download_slots.acquire(track.id)
+    res = await client.get(url)
+    assert res.status_code == 503
+    assert res.headers["retry-after"] == str(storage.DOWNLOAD_RETRY_AFTER)
+    for _ in range(download_slots.per_track):
+        download_slots.release(track.id)
+
+    res = await client.delete(
+        f"/livestream/api/v1/livestream/tracks/{track.id}", headers=headers
+    )
+    assert not track_path(track.id).exists()
+    assert (await client.get(url)).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_track_file_upload_limits(client, monkeypatch, storage_dir, wallet_id):
+    monkeypatch.setattr(storage, "MAX_FILE_SIZE", 1000)
+    with pytest.raises(FileTooLargeError):
+        await store_track_file("track", _chunks(DATA[:1001], 100))
+    # the partial upload is removed
+    assert list(storage_dir.iterdir()) == []
+
+    _, _, track = await create_playing_track(wallet_id)
+    res = await client.put(
+        f"/livestream/api/v1/livestream/tracks/{track.id}/file",
+        headers={"X-Api-Key": "other wallet"},
+        params={"filename": "genesis.flac"},
+        content=b"flac",
+    )
+    assert res.status_code == 404
+    res = await client.put(
+        f"/livestream/api/v1/livestream/tracks/{track.id}/file",
+        headers={"X-Api-Key": wallet_id, "Content-Length": "lots"},
+        params={"filename": "genesis.flac"},
+        content=b"",
+    )
+    assert res.status_code == 400
+    stored = await get_track(track.id)
+    assert stored
+    assert stored.file_name is None
+
+
+@pytest.mark.asyncio
+async def test_zerocopy_send(storage_dir):
+    path = storage_dir / "track"
+    path.write_bytes(DATA)
+    released = []
+    response = TrackFileResponse(path, "track.flac", lambda: released.append(True))
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "headers": [(b"range", b"bytes=10-19")],
+        "extensions": {storage.ZEROCOPY_SEND: {}},
+    }
+    messages = []
+
+    async def send(message):
+        if message["type"] == storage.ZEROCOPY_SEND:
+            # the server would sendfile from the open file
+            fd = message["file"].fileno()
+            message = {
+                **message,
+                "sent": os.pread(fd, message["count"], message["offset"]),
+            }
+        messages.append(message)
+
+    await response(scope, None, send)  # type: ignore
+    start, body = messages
+    assert start["status"] == 206
+    assert (body["offset"], body["count"], body["sent"]) == (10, 10, DATA[10:20])
+    assert released == [True]
@@ -0,0 +1,426 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from .. import tasks
+from ..crud import (
+    create_producer,
+    create_track,
+    db,
+    get_ledger_entries,
+    get_livestream,
+    get_payout,
+    get_producer,
+    get_set_list,
+    provision_producer_wallet,
+    release_orphaned_ledger_entries,
+    update_livestream_settlement,
+)
+from ..events import event_hub
+from ..models import (
+    CreateTrack,
+    Livestream,
+    Producer,
+    Track,
+    TrackContext,
+    UpdateSettlement,
+)
+from .helpers import create_playing_track, fake_tip
+
+
+def _ctx(producer: str) -> TrackContext:
+    return TrackContext(
+        track=Track(id=f"t-{producer}", livestream="ls", producer=producer, name="x"),
+        producer=Producer(
+            id=producer, livestream="ls", user="u", wallet=f"w-{producer}", name="x"
+        ),
+        livestream=Livestream(id="ls", wallet="w"),
+    )
+
+
+@pytest.mark.asyncio
+async def test_split_pool_orders_per_producer_and_isolates_failures(monkeypatch):
+    done: list[tuple[str, int]] = []
+
+    async def split_payment(payment, ctx):
+        n = payment.extra["n"]
+        if n == 2:
+            raise ValueError("boom")
+        # later splits finish faster, so only the sharding keeps them ordered
+        await asyncio.sleep(0.01 * (5 - n))
+        done.append((ctx.track.producer, n))
+
+    monkeypatch.setattr(tasks, "split_payment", split_payment)
+    pool = tasks.SplitWorkerPool(workers=4, queue_size=10)
+    pool.start()
+    for n in range(5):
+        for producer in ("alice", "bob"):
+            tip = await fake_tip("w", f"t-{producer}", 1_000_000)
+            tip.extra["n"] = n
+            assert pool.submit(tip, _ctx(producer))
+    await pool.join()
+    await pool.stop()
+
+    for producer in ("alice", "bob"):
+        assert [n for p, n in done if p == producer] == [0, 1, 3, 4]
+    stats = pool.stats()
+    assert stats.processed == 8
+    assert stats.failed == 2
+    assert stats.in_flight == 0
+    assert stats.queue_depth == 0
+
+
+@pytest.mark.asyncio
+async def test_full_split_queue_overflows_in_order(database, monkeypatch, wallet_id):
+    ls, _, track = await create_playing_track(wallet_id)
+    done: list[str] = []
+    scans = []
+
+    async def split_payment(payment, ctx):
+        done.append(payment.payment_hash)
+
+    async def catch_up_unsplit_tips():
+        scans.append(True)
+        return 0
+
+    async def get_wallet_payment(wallet_id, payment_hash):
+        return next(tip for tip in tips if tip.payment_hash == payment_hash)
+
+    monkeypatch.setattr(tasks, "split_payment", split_payment)
+    monkeypatch.setattr(tasks, "catch_up_unsplit_tips", catch_up_unsplit_tips)
+    monkeypatch.setattr(tasks, "get_wallet_payment", get_wallet_payment)
+    pool = tasks.SplitWorkerPool(workers=2, queue_size=1, overflow_size=2)
+    monkeypatch.setattr(tasks, "split_pool", pool)
+    tips = [await fake_tip(ls.wallet, track.id, 1_000_000) for _ in range(4)]
+    ctx = await tasks.load_split_context(tips[0])
+    assert ctx
+
+    # not started, so the shard fills up: one queued, two waiting by hash
+    assert [pool.submit(tip, ctx) for tip in tips] == [True, True, True, False]
+    stats = pool.stats()
+    assert (stats.queue_depth, stats.overflow_depth) == (1, 2)
+    assert (stats.overflowed, stats.spilled) == (2, 1)
+
+    pool.start()
+    await pool.join()
+    await pool.stop()
+    # the waiting splits were reloaded behind the queued one
+    assert done == [tip.payment_hash for tip in tips[:3]]
+    assert pool.stats().overflow_depth == 0
+
+    # only the split that didn't fit the overflow is left to the scan
+    assert await tasks.catch_up_spilled_splits(0) == 1
+    assert await tasks.catch_up_spilled_splits(1) == 1
+    assert len(scans) == 1
+
+
+@pytest.mark.asyncio
+async def test_netted_settlement_pays_one_sum(database, fake_invoices, wallet_id):
+    ls, producer, track = await create_playing_track(wallet_id)
+    await update_livestream_settlement(
+        ls.id, UpdateSettlement(settlement="netted", payout_threshold_msat=1_500_000)
+    )
+    created, paid = fake_invoices
+
+    tip = await fake_tip(ls.wallet, track.id, 1_000_000)
+    await tasks.on_invoice_paid(tip)
+    await tasks.on_invoice_paid(tip)  # replays don't accrue twice
+    await tasks.settle_netted_payouts()
+    assert paid == []  # 900 sats are below the threshold
+
+    await tasks.on_invoice_paid(await fake_tip(ls.wallet, track.id, 1_000_000))
+    await tasks.settle_netted_payouts()
+    assert len(paid) == 1
+    assert paid[0]["wallet_id"] == ls.wallet
+    assert created[-1].wallet_id == producer.wallet
+    assert created[-1].amount == 1_800_000
+
+    entries = await get_ledger_entries(ls.id, producer.id)
+    assert len(entries) == 2
+    assert all(entry.payout for entry in entries)
+    payout = await get_payout(entries[0].payout or "")
+    assert payout and payout.status == "paid"
+
+
+@pytest.mark.asyncio
+async def test_netted_payouts_survive_restarts(
+    database, fake_invoices, monkeypatch, wallet_id
+):
+    ls, producer, track = await create_playing_track(wallet_id)
+    await update_livestream_settlement(
+        ls.id, UpdateSettlement(settlement="netted", payout_threshold_msat=1000)
+    )
+    _, paid = fake_invoices
+    await tasks.on_invoice_paid(await fake_tip(ls.wallet, track.id, 1_000_500))
+    share = sum(entry.amount_msat for entry in await get_ledger_entries(ls.id))
+
+    async def crash(payout, producer=None):
+        raise SystemExit("restart")
+
+    # the process stops between claiming the entries and paying them
+    pay_payout = tasks.pay_payout
+    monkeypatch.setattr(tasks, "pay_payout", crash)
+    with pytest.raises(SystemExit):
+        await tasks.settle_netted_payouts()
+    monkeypatch.setattr(tasks, "pay_payout", pay_payout)
+    assert paid == []
+
+    entries = await get_ledger_entries(ls.id, producer.id)
+    payout = await get_payout(next(entry.payout for entry in entries if entry.payout))
+    assert payout and payout.status == "pending"
+    assert payout.amount_msat == share - share % 1000
+    claimed = [entry.amount_msat for entry in entries if entry.payout == payout.id]
+    assert sum(claimed) == payout.amount_msat
+    # the msat remainder waits for the next payout
+    assert [entry.amount_msat for entry in entries if not entry.payout] == [
+        share % 1000
+    ]
+
+    # the outbox pays it once the lease of the crashed process ran out
+    monkeypatch.setattr(tasks, "time", lambda: payout.created_at + tasks.PAYOUT_LEASE)
+    await tasks.retry_due_payouts()
+    assert len(paid) == 1
+    paid_payout = await get_payout(payout.id)
+    assert paid_payout and paid_payout.status == "paid"
+
+
+@pytest.mark.asyncio
+async def test_stranded_ledger_entries_are_released(database, wallet_id):
+    ls, producer, track = await create_playing_track(wallet_id)
+    await update_livestream_settlement(ls.id, UpdateSettlement(settlement="netted"))
+    await tasks.on_invoice_paid(await fake_tip(ls.wallet, track.id, 1_000_000))
+    await db.execute(
+        "UPDATE livestream.ledger SET payout = 'lost' WHERE livestream = :ls",
+        {"ls": ls.id},
+    )
+
+    assert await release_orphaned_ledger_entries() == 1
+    entries = await get_ledger_entries(ls.id, producer.id)
+    assert [entry.payout for entry in entries] == [None]
+
+
+@pytest.mark.asyncio
+async def test_replayed_tips_are_announced_once(database, fake_invoices, wallet_id):
+    ls, _, track = await create_playing_track(wallet_id)
+    events = event_hub.subscribe(ls.id)
+    try:
+        tip = await fake_tip(ls.wallet, track.id, 1_000_000)
+        for _ in range(2):
+            await tasks.on_invoice_paid(tip)
+        assert events.qsize() == 1
+        assert '"name": "Genesis"' in (events.get_nowait() or "")
+    finally:
+        event_hub.unsubscribe(ls.id, events)
+
+
+@pytest.mark.asyncio
+async def test_first_payout_provisions_one_wallet(
+    database, fake_accounts, fake_invoices, wallet_id
+):
+    ls, *_ = await create_playing_track(wallet_id)
+    producer = await create_producer(ls.id, "Hal")
+    assert producer.wallet is None
+    track = await create_track(ls.id, producer, CreateTrack(name="Block 1"))
+    created, paid = fake_invoices
+
+    tips = [await fake_tip(ls.wallet, track.id, 1_000_000) for _ in range(3)]
+    await asyncio.gather(*(tasks.on_invoice_paid(tip) for tip in tips))
+
+    assert len(fake_accounts) == 1
+    provisioned = await get_producer(producer.id)
+    assert provisioned and provisioned.wallet == fake_accounts[0].id
+    assert {invoice.wallet_id for invoice in created[-3:]} == {provisioned.wallet}
+    assert len(paid) == 3
+
+
+@pytest.mark.asyncio
+async def test_racing_processes_provision_one_wallet(
+    database, fake_accounts, monkeypatch, wallet_id
+):
+    from .. import crud
+
+    class PerProcessLocks(dict):
+        # every call acts like another process, with a lock of its own
+        def get(self, key, default=None):
+            return None
+
+    monkeypatch.setattr(crud, "_provision_locks", PerProcessLocks())
+    ls, *_ = await create_playing_track(wallet_id)
+    producer = await create_producer(ls.id, "Hal")
+    created: list[str] = []
+    barrier = asyncio.Barrier(3)
+    get_wallets, create_wallet = crud.get_wallets, crud.create_wallet
+
+    async def get_wallets_together(user_id, deleted=None):
+        # all three look for a wallet before any of them creates one
+        found = await get_wallets(user_id, deleted)
+        await barrier.wait()
+        return found
+
+    async def create_counted_wallet(**kwargs):
+        wallet = await create_wallet(**kwargs)
+        created.append(wallet.id)
+        return wallet
+
+    monkeypatch.setattr(crud, "get_wallets", get_wallets_together)
+    monkeypatch.setattr(crud, "create_wallet", create_counted_wallet)
+
+    results = await asyncio.gather(
+        *(provision_producer_wallet(producer) for _ in range(3))
+    )
+    stored = await get_producer(producer.id)
+    assert stored and stored.wallet
+    assert {result.wallet for result in results} == {stored.wallet}
+    # the losing wallets were deleted from the producer's account
+    assert len(created) == 3
+    assert [wallet.id for wallet in fake_accounts] == [stored.wallet]
+    assert {result.user for result in results} == {stored.user}
+
+
+@pytest.mark.asyncio
+async def test_provision_reuses_a_wallet_left_behind(
+    database, fake_accounts, wallet_id
+):
+    ls, *_ = await create_playing_track(wallet_id)
+    producer = await create_producer(ls.id, "Hal")
+    first = await provision_producer_wallet(producer)
+    # as if the process died after creating the wallet, before storing it
+    await db.execute(
+        "UPDATE livestream.producers SET wallet = NULL WHERE id = :id",
+        {"id": producer.id},
+    )
+
+    again = await provision_producer_wallet(producer)
+    assert (again.user, again.wallet) == (first.user, first.wallet)
+    assert len(fake_accounts) == 1
+
+
+@pytest.mark.asyncio
+async def test_scheduler_applies_latest_due_entry_once(client, wallet_id):
+    ls, producer, first = await create_playing_track(wallet_id)
+    second = await create_track(ls.id, producer, CreateTrack(name="Block 2"))
+    third = await create_track(ls.id, producer, CreateTrack(name="Block 3"))
+    res = await client.put(
+        "/livestream/api/v1/livestream/setlist",
+        headers={"X-Api-Key": wallet_id},
+        json={
+            "start": 1000,
+            "tracks": [
+                {"track_id": third.id, "offset": 120},
+                {"track_id": second.id, "offset": 60},
+                {"track_id": first.id, "offset": 0},
+            ],
+        },
+    )
+    assert [entry["track"] for entry in res.json()] == [first.id, second.id, third.id]
+
+    # a fresh scheduler resumes from the database, like after a restart
+    scheduler = tasks.TrackScheduler()
+    await scheduler.reload()
+    other = tasks.TrackScheduler()
+    await other.reload()
+
+    await scheduler.apply_due(1061)  # the first entry was missed
+    await other.apply_due(1061)  # and the other process finds nothing to do
+    livestream = await get_livestream(ls.id)
+    assert livestream and livestream.current_track == second.id
+    assert [entry.track for entry in await get_set_list(ls.id)] == [third.id]
+
+    await scheduler.apply_due(1200)
+    livestream = await get_livestream(ls.id)
+    assert livestream and livestream.current_track == third.id
+    assert await get_set_list(ls.id) == []
+
+
+async def _make_due(payout_id: str):
+    await db.execute(
+        """
+        UPDATE livestream.payouts SET next_attempt_at = 0, status = 'pending'
+        WHERE id = :id
+        """,
+        {"id": payout_id},
+    )
+
+
+@pytest.mark.asyncio
+async def test_failed_payout_is_retried_and_never_paid_twice(
+    database, fake_invoices, monkeypatch, wallet_id
+):
+    ls, producer, track = await create_playing_track(wallet_id)
+    created, paid = fake_invoices
+    pay_invoice = tasks.pay_invoice
+
+    async def offline(**_):
+        raise ConnectionError("node offline")
+
+    monkeypatch.setattr(tasks, "pay_invoice", offline)
+    tip = await fake_tip(ls.wallet, track.id, 1_000_000)
+    with pytest.raises(ConnectionError):
+        await tasks.on_invoice_paid(tip)
+    await tasks.on_invoice_paid(tip)  # replays leave the outbox alone
+
+    payout = await get_payout(tip.payment_hash)
+    assert payout and payout.status == "pending" and payout.attempts == 1
+    assert payout.error == "node offline"
+    assert payout.producer_wallet == producer.wallet
+    await tasks.retry_due_payouts()  # backing off
+
+    monkeypatch.setattr(tasks, "pay_invoice", pay_invoice)
+    await _make_due(tip.payment_hash)
+    await tasks.retry_due_payouts()
+    payout = await get_payout(tip.payment_hash)
+    assert payout and payout.status == "paid"
+    assert len(paid) == 1
+    # the retry paid the invoice of the first attempt
+    assert len([p for p in created if p.wallet_id == producer.wallet]) == 1
+
+    # a payout that was paid but not marked, e.g. after a crash, isn't paid again
+    await _make_due(tip.payment_hash)
+    await tasks.retry_due_payouts()
+    payout = await get_payout(tip.payment_hash)
+    assert payout and payout.status == "paid"
+    assert len(paid) == 1
+
+
+@pytest.mark.asyncio
+async def test_catch_up_splits_missed_tips_once(
+    database, fake_invoices, monkeypatch, wallet_id
+):
+    ls, _, track = await create_playing_track(wallet_id)
+    created, paid = fake_invoices
+    seen = await fake_tip(ls.wallet, track.id, 1_000_000)
+    await tasks.on_invoice_paid(seen)
+    missed = await fake_tip(ls.wallet, track.id, 2_000_000)
+
+    async def get_payments(*, wallet_id: str, **_):
+        if wallet_id != ls.wallet:
+            return []
+        return [p.copy(update={"status": "success"}) for p in (seen, missed)]
+
+    monkeypatch.setattr(tasks, "get_payments", get_payments)
+    assert await tasks.catch_up_unsplit_tips() == 1
+    assert await tasks.catch_up_unsplit_tips() == 0
+    assert len(paid) == 2
+    payout = await get_payout(missed.payment_hash)
+    assert payout and payout.status == "paid" and payout.received_msat == 2_000_000
+
+
+@pytest.mark.asyncio
+async def test_late_splits_keep_the_payment_time(database, fake_invoices, wallet_id):
+    ls, _, track = await create_playing_track(wallet_id)
+    paid_at = datetime.now(timezone.utc) - timedelta(hours=5)
+    instant = await fake_tip(ls.wallet, track.id, 1_000_000)
+    await tasks.on_invoice_paid(instant.copy(update={"time": paid_at}))
+    await update_livestream_settlement(ls.id, UpdateSettlement(settlement="netted"))
+    netted = await fake_tip(ls.wallet, track.id, 1_000_000)
+    await tasks.on_invoice_paid(netted.copy(update={"time": paid_at}))
+
+    tips = await db.fetchall(
+        "SELECT created_at FROM livestream.tips WHERE livestream = :ls", {"ls": ls.id}
+    )
+    expected = int(paid_at.timestamp())
+    assert [tip["created_at"] for tip in tips] == [expected, expected]
+    payout = await get_payout(instant.payment_hash)
+    assert payout and payout.created_at == expected
+    assert [entry.created_at for entry in await get_ledger_entries(ls.id)] == [expected]
@@ -0,0 +1,79 @@
+import base64
+import hashlib
+import hmac
+import json
+from time import time
+from typing import Optional
+
+from lnbits.settings import settings
+from pydantic import BaseModel
+
+# how long the download link of a success action stays valid, in seconds
+DOWNLOAD_TOKEN_TTL = 7 * 24 * 60 * 60
+
+
+class DownloadToken(BaseModel):
+    """
+    Everything the download redirect needs, so a valid token can be served
+    without loading the track or the livestream.
+    """
+
+    track: str
+    payment_hash: str
+    wallet: str
+    download_url: str
+    expires: int
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    key = hashlib.sha256(
+        f"livestream-download:{settings.auth_secret_key}".encode()
+    ).digest()
+    digest = hmac.new(key, payload.encode(), hashlib.sha256).digest()
+    return _b64encode(digest[:16])
+
+
+def sign_download_token(
+    track: str,
+    payment_hash: str,
+    wallet: str,
+    download_url: str,
+    ttl: int = DOWNLOAD_TOKEN_TTL,
+) -> str:
+    fields = [track, payment_hash, wallet, download_url, int(time()) + ttl]
+    payload = _b64encode(json.dumps(fields, separators=(",", ":")).encode())
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_download_token(token: str) -> Optional[DownloadToken]:
+    """
+    Returns the token's content, or None if it was tampered with or expired.
+    """
+    payload, _, signature = token.partition(".")
+    # as bytes, compare_digest refuses non-ASCII strings
+    if not hmac.compare_digest(signature.encode(), _sign(payload).encode()):
+        return None
+    try:
+        track, payment_hash, wallet, download_url, expires = json.loads(
+            _b64decode(payload)
+        )
+        download_token = DownloadToken(
+            track=track,
+            payment_hash=payment_hash,
+            wallet=wallet,
+            download_url=download_url,
+            expires=expires,
+        )
+    except (TypeError, ValueError):
+        return None
+    if download_token.expires < time():
+        return None
+    return download_token
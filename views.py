@@ -1,6 +1,8 @@
+import hashlib
 from http import HTTPStatus
+from typing import Literal, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
 from lnbits.core.crud import get_wallet_payment
 from lnbits.core.models import User
@@ -8,10 +10,30 @@ from lnbits.decorators import check_user_exists
 from lnbits.helpers import template_renderer
 from starlette.datastructures import URL
 
-from .crud import get_livestream_by_track, get_track
+from .cache import confirmed_payments, qr_cache
+from .crud import (
+    get_fresh_track_context,
+    get_livestream,
+    get_track,
+    get_track_context,
+)
+from .models import Track
+from .qrcodes import MEDIA_TYPES, render_qr
+from .storage import (
+    DOWNLOAD_RETRY_AFTER,
+    TrackFileResponse,
+    download_slots,
+    track_path,
+)
+from .tokens import verify_download_token
 
 livestream_generic_router = APIRouter()
 
+# the LNURL of an id never changes on the same host, neither does its QR code
+QR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+QrFormat = Literal["svg", "png"]
+
 
 def livestream_renderer():
     return template_renderer(["livestream/templates"])
@@ -24,26 +46,138 @@ async def index(request: Request, user: User = Depends(check_user_exists)):
     )
 
 
-@livestream_generic_router.get(
-    "/track/{track_id}", name="livestream.track_redirect_download"
+@livestream_generic_router.api_route(
+    "/track/{track_id}",
+    methods=["GET", "HEAD"],
+    name="livestream.track_redirect_download",
 )
-async def track_redirect_download(track_id, p: str = Query(...)):
-    payment_hash = p
-    track = await get_track(track_id)
-    ls = await get_livestream_by_track(track_id)
-    assert ls
-    payment = await get_wallet_payment(ls.wallet, payment_hash)
+async def track_redirect_download(
+    track_id: str, t: Optional[str] = Query(None), p: Optional[str] = Query(None)
+):
+    if t:
+        token = verify_download_token(t)
+        if not token or token.track != track_id:
+            raise HTTPException(
+                status_code=HTTPStatus.FORBIDDEN,
+                detail="This download link is invalid or has expired.",
+            )
+        await _check_paid(token.wallet, token.payment_hash)
+        if token.download_url:
+            return RedirectResponse(url=URL(token.download_url))
+        # the file is hosted here, its name comes with the track
+        ctx = await get_fresh_track_context(track_id)
+        return _track_file_response(ctx.track if ctx else None, track_id)
 
-    if not payment:
+    # links handed out before download tokens carry the raw payment hash
+    if not p:
         raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND,
-            detail=f"Couldn't find the payment {payment_hash}.",
+            status_code=HTTPStatus.BAD_REQUEST, detail="Missing download token."
         )
-    if not track:
+    ctx = await get_track_context(track_id)
+    if not ctx:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail=f"Couldn't find the track {track_id}.",
         )
+    await _check_paid(ctx.livestream.wallet, p)
+    if ctx.track.download_url:
+        return RedirectResponse(url=URL(ctx.track.download_url))
+    return _track_file_response(ctx.track, track_id)
+
+
+def _track_file_response(track: Optional[Track], track_id: str) -> TrackFileResponse:
+    path = track_path(track_id)
+    if not track or not track.file_name or not path.is_file():
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Couldn't find a download of the track {track_id}.",
+        )
+    if not download_slots.acquire(track_id):
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail="This track is being downloaded a lot, please try again shortly.",
+            headers={"Retry-After": str(DOWNLOAD_RETRY_AFTER)},
+        )
+    return TrackFileResponse(
+        path, track.file_name, lambda: download_slots.release(track_id)
+    )
+
+
+@livestream_generic_router.get(
+    "/qr/{ls_id}",
+    name="livestream.qr_livestream",
+    responses={304: {"description": "Not modified since the given ETag."}},
+)
+async def qr_livestream(
+    ls_id: str,
+    request: Request,
+    fmt: QrFormat = Query("svg", alias="format"),
+    scale: int = Query(8, ge=1, le=32),
+):
+    key = (ls_id, str(request.base_url), fmt, scale)
+    cached = qr_cache.get(key)
+    if cached is None:
+        ls = await get_livestream(ls_id)
+        if not ls:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail=f"Couldn't find the livestream {ls_id}.",
+            )
+        cached = _render_qr(ls.lnurl(request), fmt, scale)
+        qr_cache.set(key, cached)
+    return _qr_response(request, cached, fmt)
+
+
+@livestream_generic_router.get(
+    "/qr/t/{track_id}",
+    name="livestream.qr_track",
+    responses={304: {"description": "Not modified since the given ETag."}},
+)
+async def qr_track(
+    track_id: str,
+    request: Request,
+    fmt: QrFormat = Query("svg", alias="format"),
+    scale: int = Query(8, ge=1, le=32),
+):
+    key = (track_id, str(request.base_url), fmt, scale)
+    cached = qr_cache.get(key)
+    if cached is None:
+        track = await get_track(track_id)
+        if not track:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail=f"Couldn't find the track {track_id}.",
+            )
+        cached = _render_qr(track.lnurl(request), fmt, scale)
+        qr_cache.set(key, cached)
+    return _qr_response(request, cached, fmt)
+
+
+def _render_qr(lnurl: str, fmt: str, scale: int) -> tuple[str, bytes]:
+    # uppercase fits the alphanumeric mode of QR codes, which gives fewer modules
+    image = render_qr(f"lightning:{lnurl}".upper(), fmt, scale)
+    return f'"{hashlib.sha256(image).hexdigest()[:32]}"', image
+
+
+def _qr_response(request: Request, cached: tuple[str, bytes], fmt: str):
+    etag, image = cached
+    headers = {"ETag": etag, "Cache-Control": QR_CACHE_CONTROL}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return Response(content=image, media_type=MEDIA_TYPES[fmt], headers=headers)
+
+
+async def _check_paid(wallet_id: str, payment_hash: str) -> None:
+    # a settled payment stays settled, so it is only looked up once
+    if confirmed_payments.get((wallet_id, payment_hash)):
+        return
+
+    payment = await get_wallet_payment(wallet_id, payment_hash)
+    if not payment:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Couldn't find the payment {payment_hash}.",
+        )
 
     if payment.pending:
         raise HTTPException(
@@ -53,6 +187,9 @@ async def track_redirect_download(track_id, p: str = Query(...)):
                 "Please try again in a minute."
             ),
         )
-
-    assert track.download_url
-    return RedirectResponse(url=URL(track.download_url))
+    if not payment.success:
+        raise HTTPException(
+            status_code=HTTPStatus.PAYMENT_REQUIRED,
+            detail=f"Payment {payment_hash} failed.",
+        )
+    confirmed_payments.set((wallet_id, payment_hash), True)
@@ -1,32 +1,127 @@
+import csv
+import io
+import json
+from collections.abc import AsyncIterator
+from datetime import datetime, timezone
 from http import HTTPStatus
+from pathlib import Path
+from time import time
+from typing import Literal, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from lnbits.core.models import WalletTypeInfo
 from lnbits.decorators import require_admin_key, require_invoice_key
+from lnbits.helpers import urlsafe_short_hash
+from pydantic import ValidationError
 
+from .cache import (
+    confirmed_payments,
+    invoice_requests,
+    pay_response_cache,
+    track_contexts,
+)
 from .crud import (
+    TIP_STATS_BUCKET,
     create_producer,
     create_track,
+    create_tracks,
     delete_track_from_livestream,
+    get_leaderboard,
+    get_ledger_entries,
+    get_livestream,
     get_or_create_livestream_by_wallet,
+    get_payouts,
     get_producer,
     get_producers,
+    get_producers_page,
+    get_set_list,
+    get_tip_report_page,
+    get_tip_stats,
     get_track,
+    get_track_context,
     get_tracks,
+    get_tracks_page,
+    replace_set_list,
+    resolve_livestream_id,
+    search_tracks,
     update_current_track,
     update_livestream_fee,
+    update_livestream_settlement,
     update_track,
 )
-from .models import CreateTrack, LivestreamOverview
+from .events import event_hub, format_sse
+from .metrics import metrics
+from .models import (
+    CreateSetList,
+    CreateTrack,
+    ImportReport,
+    ImportRowError,
+    ImportTrack,
+    LedgerEntry,
+    Livestream,
+    LivestreamOverview,
+    LivestreamSummary,
+    LivestreamTipStats,
+    NowPlaying,
+    Payout,
+    Producer,
+    ProducerPage,
+    SetListEntry,
+    TipReportRow,
+    TipStats,
+    Track,
+    TrackPage,
+    TrackSearchPage,
+    UpdateSettlement,
+)
+from .storage import (
+    MAX_FILE_SIZE,
+    FileTooLargeError,
+    download_slots,
+    remove_track_file,
+    store_track_file,
+)
+from .tasks import split_pool, track_scheduler
+from .views_lnurl import client_limiter, livestream_limiter
 
 livestream_api_router = APIRouter()
 
+MAX_IMPORT_ROWS = 5000
+MAX_STATS_HOURS = 31 * 24
+MAX_SET_LIST_ENTRIES = 1000
+REPORT_PAGE_SIZE = 500
+
+
+def _etag(ls: Livestream) -> str:
+    return f'W/"{ls.id}-{ls.revision}"'
+
+
+def _not_modified(req: Request, response: Response, etag: str) -> Optional[Response]:
+    # browsers revalidate on every request, and a match costs no database scan
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in req.headers.get("if-none-match", ""):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return None
 
-@livestream_api_router.get("/api/v1/livestream")
+
+@livestream_api_router.get(
+    "/api/v1/livestream",
+    response_model=LivestreamOverview,
+    responses={304: {"description": "Not modified since the given ETag."}},
+)
 async def api_livestream_from_wallet(
-    req: Request, key_info: WalletTypeInfo = Depends(require_invoice_key)
-) -> LivestreamOverview:
+    req: Request,
+    response: Response,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+):
     ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
+    etag = _etag(ls)
+    not_modified = _not_modified(req, response, etag)
+    if not_modified:
+        return not_modified
+
     tracks = await get_tracks(ls.id)
     producers = await get_producers(ls.id)
     overview = LivestreamOverview(
@@ -38,23 +133,441 @@ async def api_livestream_from_wallet(
     return overview
 
 
+@livestream_api_router.get(
+    "/api/v1/livestream/summary",
+    response_model=LivestreamSummary,
+    responses={304: {"description": "Not modified since the given ETag."}},
+)
+async def api_livestream_summary(
+    req: Request,
+    response: Response,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+):
+    ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
+    etag = _etag(ls)
+    not_modified = _not_modified(req, response, etag)
+    if not_modified:
+        return not_modified
+
+    return LivestreamSummary(lnurl=str(ls.lnurl(request=req)), livestream=ls)
+
+
+@livestream_api_router.get(
+    "/api/v1/livestream/tracks",
+    response_model=TrackPage,
+    responses={304: {"description": "Not modified since the given ETag."}},
+)
+async def api_list_tracks(
+    req: Request,
+    response: Response,
+    after: Optional[str] = Query(None, description="id of the last track seen"),
+    limit: int = Query(100, ge=1, le=1000),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+):
+    ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
+    etag = _etag(ls)
+    not_modified = _not_modified(req, response, etag)
+    if not_modified:
+        return not_modified
+
+    tracks = await get_tracks_page(ls.id, after, limit + 1)
+    return TrackPage(
+        data=tracks[:limit], next=tracks[limit - 1].id if len(tracks) > limit else None
+    )
+
+
+@livestream_api_router.get("/api/v1/livestream/tracks/search")
+async def api_search_tracks(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> TrackSearchPage:
+    """
+    Tracks whose name or producer starts with the words of `q`, best
+    matches first.
+    """
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    tracks = await search_tracks(ls_id, q, limit + 1, offset)
+    return TrackSearchPage(
+        data=tracks[:limit],
+        next_offset=offset + limit if len(tracks) > limit else None,
+    )
+
+
+@livestream_api_router.get(
+    "/api/v1/livestream/producers",
+    response_model=ProducerPage,
+    responses={304: {"description": "Not modified since the given ETag."}},
+)
+async def api_list_producers(
+    req: Request,
+    response: Response,
+    after: Optional[str] = Query(None, description="id of the last producer seen"),
+    limit: int = Query(100, ge=1, le=1000),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+):
+    ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
+    etag = _etag(ls)
+    not_modified = _not_modified(req, response, etag)
+    if not_modified:
+        return not_modified
+
+    producers = await get_producers_page(ls.id, after, limit + 1)
+    return ProducerPage(
+        data=producers[:limit],
+        next=producers[limit - 1].id if len(producers) > limit else None,
+    )
+
+
+@livestream_api_router.get("/api/v1/livestream/{ls_id}/events")
+async def api_livestream_events(ls_id: str):
+    """
+    Server-Sent Events with the now-playing track ("track") and incoming
+    tips ("tip"), for stream overlays. Starts with the current track.
+    """
+    ls = await get_livestream(ls_id)
+    if not ls:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Livestream not found."
+        )
+    ctx = await get_track_context(ls.current_track) if ls.current_track else None
+    first = format_sse("track", NowPlaying.from_context(ctx).dict())
+    return StreamingResponse(
+        event_hub.stream(ls.id, first, ls.current_track),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @livestream_api_router.put("/api/v1/livestream/track/{track_id}")
 async def api_update_track(
     track_id: str, key_info: WalletTypeInfo = Depends(require_admin_key)
 ):
-    ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
     track = await get_track(track_id)
     if not track:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Track not found.")
-    await update_current_track(ls.id, track.id)
+    await update_current_track(ls_id, track.id)
 
 
 @livestream_api_router.put("/api/v1/livestream/fee/{fee_pct}")
 async def api_update_fee(
     fee_pct, key_info: WalletTypeInfo = Depends(require_admin_key)
 ):
-    ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
-    await update_livestream_fee(ls.id, int(fee_pct))
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    await update_livestream_fee(ls_id, int(fee_pct))
+
+
+@livestream_api_router.put("/api/v1/livestream/settlement")
+async def api_update_settlement(
+    data: UpdateSettlement, key_info: WalletTypeInfo = Depends(require_admin_key)
+):
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    await update_livestream_settlement(ls_id, data)
+
+
+@livestream_api_router.get("/api/v1/livestream/ledger")
+async def api_get_ledger(
+    producer_id: Optional[str] = Query(None),
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> list[LedgerEntry]:
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    return await get_ledger_entries(ls_id, producer_id, limit, offset)
+
+
+@livestream_api_router.get("/api/v1/livestream/payouts")
+async def api_get_payouts(
+    status: Optional[Literal["pending", "paid", "failed"]] = Query(None),
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> list[Payout]:
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    return await get_payouts(ls_id, status, limit, offset)
+
+
+@livestream_api_router.get("/api/v1/livestream/setlist")
+async def api_get_set_list(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> list[SetListEntry]:
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    return await get_set_list(ls_id)
+
+
+@livestream_api_router.put("/api/v1/livestream/setlist")
+async def api_update_set_list(
+    data: CreateSetList, key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> list[SetListEntry]:
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    if len(data.tracks) > MAX_SET_LIST_ENTRIES:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"A set list can have at most {MAX_SET_LIST_ENTRIES} tracks.",
+        )
+    track_ids = {track.id for track in await get_tracks(ls_id)}
+    unknown = [item.track_id for item in data.tracks if item.track_id not in track_ids]
+    if unknown:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Tracks not found: {', '.join(unknown)}.",
+        )
+
+    start = data.start or int(time())
+    entries = [
+        SetListEntry(
+            id=urlsafe_short_hash(),
+            livestream=ls_id,
+            track=item.track_id,
+            starts_at=start + item.offset,
+        )
+        for item in data.tracks
+    ]
+    await replace_set_list(ls_id, entries)
+    track_scheduler.schedule(entries)
+    return sorted(entries, key=lambda entry: entry.starts_at)
+
+
+@livestream_api_router.delete("/api/v1/livestream/setlist")
+async def api_delete_set_list(key_info: WalletTypeInfo = Depends(require_admin_key)):
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    await replace_set_list(ls_id, [])
+
+
+@livestream_api_router.get("/api/v1/livestream/metrics")
+async def api_get_metrics(key_info: WalletTypeInfo = Depends(require_admin_key)):
+    """
+    Latency histograms and queue, cache and stream stats of this process in
+    the Prometheus text format.
+    """
+    pool = split_pool.stats()
+    hub = event_hub.stats()
+    samples = [
+        (
+            "livestream_split_queue_depth",
+            "gauge",
+            "Splits waiting for a worker.",
+            pool.queue_depth,
+        ),
+        (
+            "livestream_split_overflow_depth",
+            "gauge",
+            "Splits waiting by payment hash for room in a full queue.",
+            pool.overflow_depth,
+        ),
+        ("livestream_split_in_flight", "gauge", "Splits being paid.", pool.in_flight),
+        ("livestream_splits_total", "counter", "Splits completed.", pool.processed),
+        (
+            "livestream_split_failures_total",
+            "counter",
+            "Splits that failed.",
+            pool.failed,
+        ),
+        (
+            "livestream_splits_overflowed_total",
+            "counter",
+            "Splits that found their queue full.",
+            pool.overflowed,
+        ),
+        (
+            "livestream_splits_spilled_total",
+            "counter",
+            "Splits left to the catch-up scan by a full overflow.",
+            pool.spilled,
+        ),
+        (
+            "livestream_event_subscribers",
+            "gauge",
+            "Open event streams.",
+            hub["subscribers"],
+        ),
+        (
+            "livestream_event_evictions_total",
+            "counter",
+            "Event streams dropped for being too slow.",
+            hub["evicted"],
+        ),
+        (
+            "livestream_set_list_pending",
+            "gauge",
+            "Scheduled set list entries.",
+            len(track_scheduler.heap),
+        ),
+        (
+            "livestream_callback_throttled_livestream_total",
+            "counter",
+            "Callbacks refused by the per-livestream limit.",
+            livestream_limiter.throttled,
+        ),
+        (
+            "livestream_callback_throttled_client_total",
+            "counter",
+            "Callbacks refused by the per-client limit.",
+            client_limiter.throttled,
+        ),
+        (
+            "livestream_downloads_active",
+            "gauge",
+            "Track files being downloaded.",
+            download_slots.active,
+        ),
+        (
+            "livestream_downloads_refused_total",
+            "counter",
+            "Downloads refused by the per-track limit.",
+            download_slots.refused,
+        ),
+    ]
+    for name, cache in (
+        ("pay_response_cache", pay_response_cache),
+        ("confirmed_payments_cache", confirmed_payments),
+        ("invoice_requests_cache", invoice_requests),
+        ("track_context_cache", track_contexts),
+    ):
+        stats = cache.stats()
+        samples += [
+            (f"livestream_{name}_size", "gauge", "Cached entries.", stats["size"]),
+            (f"livestream_{name}_hits_total", "counter", "Cache hits.", stats["hits"]),
+            (
+                f"livestream_{name}_misses_total",
+                "counter",
+                "Cache misses.",
+                stats["misses"],
+            ),
+        ]
+    return Response(
+        content=metrics.render(samples),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@livestream_api_router.get("/api/v1/livestream/leaderboard")
+async def api_get_leaderboard(
+    scope: Literal["track", "producer"] = Query("track"),
+    since: Optional[int] = Query(None, ge=1),
+    limit: int = Query(10, ge=1, le=100),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> list[TipStats]:
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    return await get_leaderboard(ls_id, scope, since, limit)
+
+
+@livestream_api_router.get("/api/v1/livestream/stats")
+async def api_get_tip_stats(
+    since: Optional[int] = Query(None, ge=0),
+    until: Optional[int] = Query(None, ge=0),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> LivestreamTipStats:
+    until = until or int(time())
+    since = since if since is not None else until - 24 * TIP_STATS_BUCKET
+    if until - since > MAX_STATS_HOURS * TIP_STATS_BUCKET:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Stats are limited to {MAX_STATS_HOURS} hours at once.",
+        )
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    return await get_tip_stats(ls_id, since, until)
+
+
+REPORT_COLUMNS = [
+    "time",
+    "payment_hash",
+    "track",
+    "track_name",
+    "producer",
+    "producer_name",
+    "gross_msat",
+    "fee_msat",
+    "producer_share_msat",
+    "comment",
+]
+
+# leading characters that make spreadsheets read a cell as a formula
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _report_record(row: TipReportRow) -> list:
+    return [
+        datetime.fromtimestamp(row.created_at, timezone.utc).isoformat(),
+        row.id,
+        row.track,
+        row.track_name,
+        row.producer,
+        row.producer_name,
+        row.amount_msat,
+        row.fee_msat,
+        row.share_msat,
+        row.comment,
+    ]
+
+
+def _csv_cell(value):
+    # names and comments come from payers, keep them text in spreadsheets
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+async def _report_lines(
+    ls_id: str,
+    fmt: str,
+    producer_id: Optional[str],
+    since: int,
+    until: Optional[int],
+) -> AsyncIterator[str]:
+    # one page of tips in memory at a time, however long the report
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(REPORT_COLUMNS)
+    after = None
+    while True:
+        rows = await get_tip_report_page(
+            ls_id, producer_id, since, until, after, REPORT_PAGE_SIZE
+        )
+        for row in rows:
+            if fmt == "csv":
+                writer.writerow([_csv_cell(value) for value in _report_record(row)])
+            else:
+                record = dict(zip(REPORT_COLUMNS, _report_record(row)))
+                buffer.write(json.dumps(record) + "\n")
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        if len(rows) < REPORT_PAGE_SIZE:
+            return
+        after = (rows[-1].created_at, rows[-1].id)
+
+
+@livestream_api_router.get("/api/v1/livestream/report")
+async def api_get_report(
+    fmt: Literal["csv", "ndjson"] = Query("csv", alias="format"),
+    producer_id: Optional[str] = Query(None),
+    since: int = Query(0, ge=0),
+    until: Optional[int] = Query(None, ge=0),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+):
+    """
+    Every tip of the livestream, or of one producer, with its gross amount,
+    fee and producer share, streamed as CSV or newline delimited JSON.
+    """
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    if producer_id:
+        producer = await get_producer(producer_id)
+        if not producer or producer.livestream != ls_id:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail=f"Producer with id: {producer_id} not found.",
+            )
+    name = f"livestream-{ls_id}{'-' + producer_id if producer_id else ''}-tips"
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _report_lines(ls_id, fmt, producer_id, since, until),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
+    )
 
 
 async def _check_producer(livestream_id, data: CreateTrack):
@@ -78,9 +591,105 @@ async def _check_producer(livestream_id, data: CreateTrack):
 async def api_add_tracks(
     data: CreateTrack, key_info: WalletTypeInfo = Depends(require_admin_key)
 ):
-    ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
-    producer = await _check_producer(ls.id, data)
-    return await create_track(ls.id, producer.id, data)
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    producer = await _check_producer(ls_id, data)
+    return await create_track(ls_id, producer, data)
+
+
+def _parse_import(body: bytes, content_type: str) -> list:
+    if content_type.startswith("text/csv"):
+        reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig")))
+        # empty cells fall back to the defaults
+        return [
+            {key.strip(): value for key, value in row.items() if key and value}
+            for row in reader
+        ]
+    rows = json.loads(body)
+    if not isinstance(rows, list):
+        raise ValueError("Expected a list of tracks.")
+    return rows
+
+
+@livestream_api_router.post(
+    "/api/v1/livestream/tracks/import",
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "type": "array",
+                        "items": ImportTrack.schema(),
+                    }
+                },
+                "text/csv": {"schema": {"type": "string"}},
+            },
+        }
+    },
+)
+async def api_import_tracks(
+    req: Request, key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> ImportReport:
+    """
+    Adds many tracks at once from a JSON list or a CSV file with the columns
+    name, producer, price_msat and download_url. Valid rows are inserted in
+    one transaction, invalid rows are reported back by their 1-based number.
+    """
+    try:
+        rows = _parse_import(await req.body(), req.headers.get("content-type", ""))
+    except (ValueError, csv.Error) as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
+    if len(rows) > MAX_IMPORT_ROWS:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Can import at most {MAX_IMPORT_ROWS} tracks at once.",
+        )
+
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    errors: list[ImportRowError] = []
+    valid: list[tuple[int, ImportTrack]] = []
+    for number, row in enumerate(rows, start=1):
+        try:
+            valid.append((number, ImportTrack.parse_obj(row)))
+        except ValidationError as exc:
+            error = "; ".join(
+                f"{'.'.join(map(str, err['loc']))}: {err['msg']}"
+                for err in exc.errors()
+            )
+            errors.append(ImportRowError(row=number, error=error))
+
+    # one pass over the existing producers, then each missing one is created once
+    producers = {
+        producer.name.lower(): producer for producer in await get_producers(ls_id)
+    }
+    producers_created = 0
+    tracks: list[tuple[Producer, CreateTrack]] = []
+    for number, item in valid:
+        key = item.producer.lower()
+        if key not in producers:
+            try:
+                producers[key] = await create_producer(ls_id, item.producer)
+                producers_created += 1
+            except Exception as exc:
+                errors.append(ImportRowError(row=number, error=str(exc)))
+                continue
+        tracks.append(
+            (
+                producers[key],
+                CreateTrack(
+                    name=item.name,
+                    download_url=item.download_url,
+                    price_msat=item.price_msat,
+                ),
+            )
+        )
+
+    return ImportReport(
+        tracks=await create_tracks(ls_id, tracks),
+        producers_created=producers_created,
+        errors=sorted(errors, key=lambda error: error.row),
+    )
 
 
 @livestream_api_router.put("/api/v1/livestream/track/{track_id}")
@@ -89,11 +698,11 @@ async def api_update_tracks(
     data: CreateTrack,
     key_info: WalletTypeInfo = Depends(require_admin_key),
 ):
-    ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
     track = await get_track(track_id)
     if not track:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Track not found.")
-    producer = await _check_producer(ls.id, data)
+    producer = await _check_producer(ls_id, data)
 
     if data.download_url:
         track.download_url = data.download_url
@@ -103,12 +712,73 @@ async def api_update_tracks(
     track.name = data.name
     track.producer = producer.id
 
-    return await update_track(track)
+    return await update_track(track, producer)
 
 
 @livestream_api_router.delete("/api/v1/livestream/tracks/{track_id}")
 async def api_delete_track(
     track_id: str, key_info: WalletTypeInfo = Depends(require_admin_key)
 ):
-    ls = await get_or_create_livestream_by_wallet(key_info.wallet.id)
-    await delete_track_from_livestream(ls.id, track_id)
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    if await delete_track_from_livestream(ls_id, track_id):
+        remove_track_file(track_id)
+
+
+async def _own_track(ls_id: str, track_id: str) -> Track:
+    track = await get_track(track_id)
+    if not track or track.livestream != ls_id:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Track not found.")
+    return track
+
+
+@livestream_api_router.put("/api/v1/livestream/tracks/{track_id}/file")
+async def api_upload_track_file(
+    track_id: str,
+    request: Request,
+    filename: str = Query(..., min_length=1, max_length=255),
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> Track:
+    """
+    Stores the request body as the track's file, which paying listeners then
+    download from this extension. The body is the raw file, named by
+    `filename`, and is written to disk as it arrives.
+    """
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    track = await _own_track(ls_id, track_id)
+    name = Path(filename.replace("\\", "/")).name
+    if not name:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Invalid file name."
+        )
+    try:
+        content_length = int(request.headers.get("content-length", 0))
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Invalid Content-Length."
+        ) from exc
+    if content_length > MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Track files can't be larger than {MAX_FILE_SIZE} bytes.",
+        )
+    try:
+        size = await store_track_file(track_id, request.stream())
+    except FileTooLargeError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.REQUEST_ENTITY_TOO_LARGE, detail=str(exc)
+        ) from exc
+
+    track.file_name, track.file_size = name, size
+    return await update_track(track, await get_producer(track.producer))
+
+
+@livestream_api_router.delete("/api/v1/livestream/tracks/{track_id}/file")
+async def api_delete_track_file(
+    track_id: str, key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> Track:
+    ls_id = await resolve_livestream_id(key_info.wallet.id)
+    track = await _own_track(ls_id, track_id)
+    track.file_name, track.file_size = None, None
+    track = await update_track(track, await get_producer(track.producer))
+    remove_track_file(track_id)
+    return track
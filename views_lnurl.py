@@ -1,142 +1,231 @@
+import asyncio
 import math
 from http import HTTPStatus
-from typing import Union
+from typing import Optional
 
-from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from lnbits.core.models import Payment
 from lnbits.core.services import create_invoice
-from lnurl import (
-    LnurlErrorResponse,
-    LnurlPayActionResponse,
-    LnurlPayResponse,
-)
-from lnurl.types import ClearnetUrl, DebugUrl, LightningInvoice, MilliSatoshi, OnionUrl
-from pydantic import parse_obj_as
 
-from .crud import get_livestream, get_livestream_by_track, get_track
+from .admission import RateLimiter, admit, client_address
+from .cache import invoice_requests, pay_response_cache
+from .crud import (
+    get_fresh_track_context,
+    get_livestream,
+    get_livestream_revision,
+    get_track_context,
+)
+from .metrics import metrics
+from .models import TrackContext
+from .responses import (
+    check_url,
+    encode_json,
+    error_response,
+    json_response,
+    pay_action_response,
+    pay_response,
+)
+from .tokens import sign_download_token
 
 livestream_lnurl_router = APIRouter()
 
+# admission control of the callback, which creates an invoice on the backing
+# wallet: invoices per second and burst size, per livestream and per client
+CALLBACK_LIVESTREAM_RATE = 50
+CALLBACK_LIVESTREAM_BURST = 500
+# clients are told apart by address only, which a whole venue behind one NAT
+# shares, so their limit leaves room for a crowd and only stops a single
+# client from taking the livestream's budget
+CALLBACK_CLIENT_RATE = 5
+CALLBACK_CLIENT_BURST = 50
+
+livestream_limiter = RateLimiter(CALLBACK_LIVESTREAM_RATE, CALLBACK_LIVESTREAM_BURST)
+client_limiter = RateLimiter(CALLBACK_CLIENT_RATE, CALLBACK_CLIENT_BURST)
+
 
 @livestream_lnurl_router.get("/lnurl/{ls_id}", name="livestream.lnurl_livestream")
 async def lnurl_livestream(ls_id: str, request: Request):
-    ls = await get_livestream(ls_id)
+    cache_key = (ls_id, str(request.base_url))
+    with metrics.span("lnurl_livestream", "cache"):
+        cached = pay_response_cache.get(cache_key)
+    if cached:
+        revision, body = cached
+        # another worker may have switched the track
+        with metrics.span("lnurl_livestream", "revision"):
+            current = await get_livestream_revision(ls_id)
+        if current == revision:
+            return json_response(body)
+    epoch = pay_response_cache.epoch
+
+    with metrics.span("lnurl_livestream", "db"):
+        ls = await get_livestream(ls_id)
+        ctx = None
+        if ls and ls.current_track:
+            ctx = await get_track_context(ls.current_track)
+
     if not ls:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Livestream not found."
         )
-
     if not ls.current_track:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="This livestream is offline."
         )
-    track = await get_track(ls.current_track)
-    if not track:
+    if not ctx:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Track not found.")
 
-    url = parse_obj_as(
-        Union[DebugUrl, OnionUrl, ClearnetUrl],  # type: ignore
-        request.url_for("livestream.lnurl_track", track_id=track.id),
-    )
-
-    resp = LnurlPayResponse(
-        callback=url,
-        minSendable=MilliSatoshi(track.min_sendable),
-        maxSendable=MilliSatoshi(track.max_sendable),
-        metadata=await track.lnurlpay_metadata(),
-    )
+    with metrics.span("lnurl_livestream", "serialize"):
+        body = _pay_response(request, ctx)
+    pay_response_cache.set(cache_key, (ls.revision, body), epoch)
+    return json_response(body)
 
-    params = resp.dict()
-    params["commentAllowed"] = 300
 
-    return params
+def _pay_response(request: Request, ctx: TrackContext) -> str:
+    track = ctx.track
+    callback = check_url(
+        str(request.url_for("livestream.lnurl_callback", track_id=track.id)),
+        str(request.base_url),
+    )
+    return encode_json(
+        pay_response(callback, track.min_sendable, track.max_sendable, ctx.metadata)
+    )
 
 
 @livestream_lnurl_router.get("/lnurl/t/{track_id}", name="livestream.lnurl_track")
 async def lnurl_track(track_id, request: Request):
-    track = await get_track(track_id)
-    if not track:
+    with metrics.span("lnurl_track", "db"):
+        ctx = await get_fresh_track_context(track_id)
+    if not ctx:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Track not found.")
-
-    url = parse_obj_as(
-        Union[DebugUrl, OnionUrl, ClearnetUrl],  # type: ignore
-        request.url_for("livestream.lnurl_track", track_id=track.id),
-    )
-    resp = LnurlPayResponse(
-        callback=url,
-        minSendable=MilliSatoshi(track.min_sendable),
-        maxSendable=MilliSatoshi(track.max_sendable),
-        metadata=await track.lnurlpay_metadata(),
-    )
-
-    params = resp.dict()
-    params["commentAllowed"] = 300
-
-    return params
+    with metrics.span("lnurl_track", "serialize"):
+        return json_response(_pay_response(request, ctx))
 
 
 @livestream_lnurl_router.get("/lnurl/cb/{track_id}", name="livestream.lnurl_callback")
 async def lnurl_callback(
-    track_id, request: Request, amount: int = Query(...), comment: str = Query("")
+    track_id,
+    request: Request,
+    amount: int = Query(...),
+    comment: str = Query(""),
+    nonce: str = Query("", max_length=64),
 ):
-    track = await get_track(track_id)
-    if not track:
+    # wallets that send a nonce with the tip get the invoice issued, or being
+    # issued, for their first request when they retry it. Without one, equal
+    # tips can't be told from retries, so every request gets its own invoice.
+    client = client_address(request)
+    key = (client, track_id, amount, comment, nonce) if nonce else None
+    pending = invoice_requests.get(key) if key else None
+    if key and pending:
+        return await _await_invoice(key, pending)
+
+    with metrics.span("lnurl_callback", "db"):
+        ctx = await get_fresh_track_context(track_id)
+    if not ctx:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Track not found.")
+    track, ls = ctx.track, ctx.livestream
 
     amount_received = int(amount or 0)
 
     if amount_received < track.min_sendable:
-        return LnurlErrorResponse(
-            reason=f"""
+        return json_response(
+            error_response(
+                f"""
             Amount {round(amount_received / 1000)} is smaller than
             minimum {math.floor(track.min_sendable)}.
             """
-        ).dict()
+            )
+        )
     elif track.max_sendable < amount_received:
-        return LnurlErrorResponse(
-            reason=f"""
+        return json_response(
+            error_response(
+                f"""
             Amount {round(amount_received / 1000)} is greater than
             maximum {math.floor(track.max_sendable)}.
             """
-        ).dict()
+            )
+        )
 
     if len(comment or "") > 300:
-        return LnurlErrorResponse(
-            reason=f"""
+        return json_response(
+            error_response(
+                f"""
             Got a comment with {len(comment)} characters,
             but can only accept 300
             """
-        ).dict()
-
-    ls = await get_livestream_by_track(track_id)
-    assert ls
+            )
+        )
 
-    extra_amount = amount_received - int(amount_received * (100 - ls.fee_pct) / 100)
+    retry_in = admit((livestream_limiter, ls.id), (client_limiter, client))
+    if retry_in is not None:
+        return json_response(
+            error_response(
+                "Too many tips at once, please try again in "
+                f"{math.ceil(retry_in)} seconds."
+            )
+        )
 
-    payment = await create_invoice(
-        wallet_id=ls.wallet,
-        amount=int(amount_received / 1000),
-        memo=await track.fullname(),
-        unhashed_description=(await track.lnurlpay_metadata()).encode(),
-        extra={
-            "tag": "livestream",
-            "track": track.id,
-            "comment": comment,
-            "amount": int(extra_amount / 1000),
-        },
+    pending = asyncio.ensure_future(
+        _issue_invoice(request, ctx, amount_received, comment)
     )
+    if key:
+        invoice_requests.set(key, pending)
+    return await _await_invoice(key, pending)
+
+
+async def _await_invoice(
+    key: Optional[tuple[str, str, int, str, str]], pending: asyncio.Future
+) -> Response:
+    try:
+        # a client that disconnects doesn't cancel the invoice of its retries
+        return json_response(await asyncio.shield(pending))
+    except Exception:
+        if key:
+            invoice_requests.invalidate(key)
+        raise
+
+
+async def _issue_invoice(
+    request: Request, ctx: TrackContext, amount_received: int, comment: str
+) -> str:
+    track, ls = ctx.track, ctx.livestream
+    extra_amount = amount_received - int(amount_received * (100 - ls.fee_pct) / 100)
 
-    assert track.price_msat
-    if amount_received < track.price_msat:
-        success_action = None
-    else:
-        url = request.url_for("livestream.track_download", track_id=track.id)
-        url_with_query = f"{url}?p={payment.payment_hash}"
-        success_action = parse_obj_as(
-            Union[DebugUrl, OnionUrl, ClearnetUrl],  # type: ignore
-            url_with_query,
+    with metrics.span("lnurl_callback", "metadata"):
+        memo = ctx.fullname
+        description, description_hash = ctx.description
+
+    with metrics.span("lnurl_callback", "create_invoice"):
+        payment = await create_invoice(
+            wallet_id=ls.wallet,
+            amount=int(amount_received / 1000),
+            memo=memo,
+            # the hash spares backends that take it from hashing the metadata,
+            # the rest need the metadata itself
+            description_hash=description_hash,
+            unhashed_description=description,
+            extra={
+                "tag": "livestream",
+                "track": track.id,
+                "comment": comment,
+                "amount": int(extra_amount / 1000),
+            },
         )
 
-    invoice = parse_obj_as(LightningInvoice, LightningInvoice(payment.bolt11))
-    resp = LnurlPayActionResponse(pr=invoice, successAction=success_action, routes=[])
+    with metrics.span("lnurl_callback", "serialize"):
+        return _pay_action_response(request, ctx, payment, amount_received)
 
-    return resp.dict()
+
+def _pay_action_response(
+    request: Request, ctx: TrackContext, payment: Payment, amount: int
+) -> str:
+    track, ls = ctx.track, ctx.livestream
+    success_url = None
+    if track.downloadable and amount >= track.price_msat:
+        url = request.url_for("livestream.track_redirect_download", track_id=track.id)
+        token = sign_download_token(
+            track.id, payment.payment_hash, ls.wallet, track.download_url or ""
+        )
+        success_url = check_url(f"{url}?t={token}", str(request.base_url))
+    return encode_json(
+        pay_action_response(payment.bolt11, success_url, "Download the track.")
+    )